@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+
+from aiogram import types
+
+from states import redis
+
+# Telegram присылает альбом отдельными обновлениями с общим media_group_id, обычно в пределах секунды.
+# Альбом считается собранным, когда за MEDIA_GROUP_WINDOW не пришло ни одной новой части
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', 1.0))
+MEDIA_GROUP_MAX_WAIT = float(os.getenv('MEDIA_GROUP_MAX_WAIT', 5))
+MEDIA_GROUP_TTL = 120
+
+
+async def collect_media_group(message: types.Message):
+    """Добавляет сообщение в альбом.
+
+    Части альбома могут прийти на разные реплики, поэтому они копятся в Redis. Обрабатывает альбом
+    реплика, получившая первую часть: она ждет окончания альбома и получает все сообщения по порядку.
+    Остальным возвращается None. Часть, пришедшая после того, как альбом уже собран,
+    возвращается одна: на нее отвечают отдельно.
+    """
+    key = f"media_group:{message.media_group_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, message.model_dump_json(exclude_none=True))
+        pipe.expire(key, MEDIA_GROUP_TTL)
+        pipe.set(f"{key}:owner", 1, nx=True, ex=MEDIA_GROUP_TTL)
+        pipe.exists(f"{key}:collected")
+        received, _, owner, collected = await pipe.execute()
+    if collected:
+        # Часть опоздала больше чем на MEDIA_GROUP_MAX_WAIT: ответ на альбом ее уже не увидит
+        logging.warning(f"Media group {message.media_group_id}: message {message.message_id} "
+                        f"arrived after the album was collected, answering it separately")
+        await redis.delete(key)
+        return [message]
+    if not owner:
+        return None
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MEDIA_GROUP_MAX_WAIT
+    while loop.time() < deadline:
+        await asyncio.sleep(min(MEDIA_GROUP_WINDOW, max(0.0, deadline - loop.time())))
+        size = await redis.llen(key)
+        if size == received:
+            break
+        received = size
+
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        pipe.set(f"{key}:collected", 1, ex=MEDIA_GROUP_TTL)
+        items, _, _ = await pipe.execute()
+    messages = [types.Message.model_validate_json(item).as_(message.bot) for item in items]
+    return sorted(messages, key=lambda m: m.message_id)
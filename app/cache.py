@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+
+from metrics import RESPONSE_CACHE_LOOKUPS
+from states import redis
+
+# Кэш ответов на первый ход беседы: одинаковые задания из одного курса не идут в LLM повторно
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+
+CACHE_PREFIX = "response_cache"
+# Время последнего обращения к каждой записи, по нему вытесняются самые старые
+CACHE_LRU = f"{CACHE_PREFIX}:lru"
+CACHE_STATS = f"{CACHE_PREFIX}:stats"
+
+_WHITESPACE = re.compile(r'\s+')
+_EDGE_PUNCTUATION = '.,!?;:…"\'«»() '
+
+
+def normalize_prompt(prompt):
+    # Регистр, пробелы и знаки по краям не меняют смысла вопроса
+    prompt = unicodedata.normalize('NFKC', prompt or "").casefold()
+    return _WHITESPACE.sub(' ', prompt).strip(_EDGE_PUNCTUATION)
+
+
+def response_cache_key(model, prompt, file_sha256=""):
+    digest = hashlib.sha256("\0".join((model, normalize_prompt(prompt), file_sha256)).encode()).hexdigest()
+    return f"{CACHE_PREFIX}:{digest}"
+
+
+async def get_cached_response(key):
+    response = await redis.get(key)
+    async with redis.pipeline(transaction=False) as pipe:
+        if response is None:
+            pipe.hincrby(CACHE_STATS, "misses", 1)
+        else:
+            pipe.hincrby(CACHE_STATS, "hits", 1)
+            pipe.zadd(CACHE_LRU, {key: time.time()})
+        await pipe.execute()
+    RESPONSE_CACHE_LOOKUPS.labels("miss" if response is None else "hit").inc()
+    if response is None:
+        return None
+    logging.info(f"Response cache hit: {key}")
+    return response.decode()
+
+
+async def cache_response(key, response):
+    now = time.time()
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.set(key, response, ex=RESPONSE_CACHE_TTL)
+        pipe.zadd(CACHE_LRU, {key: now})
+        # Записи, к которым не обращались дольше TTL, уже удалены Redis
+        pipe.zremrangebyscore(CACHE_LRU, "-inf", now - RESPONSE_CACHE_TTL)
+        pipe.hincrby(CACHE_STATS, "stores", 1)
+        pipe.zcard(CACHE_LRU)
+        size = (await pipe.execute())[-1]
+
+    if size > RESPONSE_CACHE_MAX_ENTRIES:
+        evicted = [key for key, _ in await redis.zpopmin(CACHE_LRU, size - RESPONSE_CACHE_MAX_ENTRIES)]
+        if evicted:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*evicted)
+                pipe.hincrby(CACHE_STATS, "evictions", len(evicted))
+                await pipe.execute()
+
+
+async def response_cache_stats():
+    stats = {key.decode(): int(value) for key, value in (await redis.hgetall(CACHE_STATS)).items()}
+    stats["entries"] = await redis.zcard(CACHE_LRU)
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    stats["hit_rate"] = round(stats.get("hits", 0) / lookups, 3) if lookups else 0.0
+    return stats
+
+
+async def purge_response_cache():
+    """Удаляет все закэшированные ответы, статистика сохраняется. Возвращает число удаленных записей."""
+    deleted = 0
+    batch = []
+    async for key in redis.scan_iter(match=f"{CACHE_PREFIX}:*", count=500):
+        if key.decode() in (CACHE_STATS, CACHE_LRU):
+            continue
+        batch.append(key)
+        if len(batch) >= 500:
+            deleted += await redis.delete(*batch)
+            batch = []
+    if batch:
+        deleted += await redis.delete(*batch)
+    await redis.delete(CACHE_LRU)
+    return deleted
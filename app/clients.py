@@ -1,44 +1,197 @@
+import asyncio
+import logging
 import os
+import time
+from collections import OrderedDict
 
-import google.generativeai as genai
 import httpx
-import requests
-from dotenv import load_dotenv
-from groq import AsyncGroq
 
-load_dotenv()
+from config import config, SYSTEM_MESSAGE
+from metrics import GROQ_TRANSPORT, GROQ_TRANSPORT_SWITCHES
 
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+
+REACHABILITY_URL = os.getenv('REACHABILITY_URL', "https://console.groq.com")
+REACHABILITY_INTERVAL = float(os.getenv('REACHABILITY_INTERVAL', 60))
+REACHABILITY_TTL = float(os.getenv('REACHABILITY_TTL', 300))
+REACHABILITY_TIMEOUT = float(os.getenv('REACHABILITY_TIMEOUT', 10))
+GEMINI_CACHED_CLIENTS = int(os.getenv('GEMINI_CACHED_CLIENTS', 256))
+
+# Клиенты создаются один раз на процесс и переиспользуются между сообщениями.
+# Ключ реестра - (модель или провайдер, прокси)
+_clients = {}
+_http_clients = {}
+_cached_gemini_clients = OrderedDict()
+
+# Результат последней проверки доступности Groq напрямую (без прокси)
+transport = {"mode": "direct", "checked_at": 0.0, "switches": 0}
+GROQ_TRANSPORT.labels("direct").set(1)
+GROQ_TRANSPORT.labels("proxy").set(0)
+_monitor_task = None
+_refresh_task = None
+
+# SDK провайдеров тяжелые и импортируются при первом обращении, а не при старте бота
+_genai = None
+_AsyncGroq = None
+_preload_task = None
+
+
+def gemini_sdk():
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=config.gemini_api_key)
+        _genai = genai
+    return _genai
+
+
+def groq_sdk():
+    global _AsyncGroq
+    if _AsyncGroq is None:
+        from groq import AsyncGroq
+        _AsyncGroq = AsyncGroq
+    return _AsyncGroq
+
+
+async def preload_sdks():
+    # После старта SDK подгружаются в фоновом потоке, чтобы первому сообщению не пришлось их ждать
+    global _preload_task
+    if _preload_task is None:
+        _preload_task = asyncio.create_task(asyncio.to_thread(lambda: (gemini_sdk(), groq_sdk())))
+
+
+def _get_http_client(proxy=None):
+    http_client = _http_clients.get(proxy)
+    if http_client is None:
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                              max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                              keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+        http_client = httpx.AsyncClient(proxy=proxy, limits=limits)
+        _http_clients[proxy] = http_client
+    return http_client
+
+
+def _get_groq_client(proxy=None):
+    # Для Groq модель передается в каждом запросе, поэтому клиент общий для всех моделей
+    key = ("groq", proxy)
+    if key not in _clients:
+        # Повторы и переход на другую модель делает router
+        _clients[key] = groq_sdk()(api_key=config.groq_api_key,
+                                   http_client=_get_http_client(proxy), max_retries=0)
+    return _clients[key]
+
+
+def _gemini_generation_config(genai):
+    return genai.GenerationConfig(
+        temperature=1,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=8192,
+        response_mime_type="text/plain"
+    )
+
+
+def _get_gemini_client(model):
+    key = (model, None)
+    if key not in _clients:
+        genai = gemini_sdk()
+        _clients[key] = genai.GenerativeModel(
+            model_name=model,
+            generation_config=_gemini_generation_config(genai),
+            system_instruction=SYSTEM_MESSAGE
+        )
+    return _clients[key]
 
-async def get_client_for_model(model):
-    from main import SYSTEM_MESSAGE
 
-    response = requests.get("https://console.groq.com", timeout=10)
-    if response.status_code == 403:
-        proxy = os.getenv('PROXY')
-        async_client = httpx.AsyncClient(proxy=proxy)
-        groq_client = AsyncGroq(api_key=os.getenv(
-            'GROQ_API_KEY'), http_client=async_client)
-    else:
-        groq_client = AsyncGroq(api_key=os.getenv('GROQ_API_KEY'))
+async def get_cached_gemini_client(cache_name):
+    """Модель поверх кэша контекста Gemini: system instruction и начало истории уже в кэше."""
+    client = _cached_gemini_clients.pop(cache_name, None)
+    if client is None:
+        genai = gemini_sdk()
+        # По имени кэша SDK сначала запрашивает его описание - это сетевой вызов
+        client = await asyncio.to_thread(genai.GenerativeModel.from_cached_content, cache_name,
+                                         generation_config=_gemini_generation_config(genai))
+    # Кэши живут недолго, держим только недавно использованные
+    _cached_gemini_clients[cache_name] = client
+    while len(_cached_gemini_clients) > GEMINI_CACHED_CLIENTS:
+        _cached_gemini_clients.popitem(last=False)
+    return client
+
+
+async def is_geo_blocked(url=REACHABILITY_URL):
+    # None - проверка не удалась, результат неизвестен
+    try:
+        response = await _get_http_client().get(url, timeout=REACHABILITY_TIMEOUT)
+    except httpx.HTTPError as e:
+        logging.warning(f"Reachability probe failed: {e}")
+        return None
+    return response.status_code == 403 or "geo-blocked" in response.text.lower()
+
+
+async def check_reachability(url=REACHABILITY_URL):
+    blocked = await is_geo_blocked(url)
+    if blocked is None:
+        # Не меняем транспорт, если проверка не удалась: следующая попытка по расписанию
+        return transport["mode"]
+
+    mode = "proxy" if blocked and config.proxy else "direct"
+    if mode != transport["mode"]:
+        logging.info(f"Groq transport switched: {transport['mode']} -> {mode}")
+        transport["switches"] += 1
+        GROQ_TRANSPORT_SWITCHES.inc()
+    transport["mode"] = mode
+    GROQ_TRANSPORT.labels(mode).set(1)
+    GROQ_TRANSPORT.labels("proxy" if mode == "direct" else "direct").set(0)
+    transport["checked_at"] = time.monotonic()
+    return mode
+
+
+async def reachability_monitor(interval=REACHABILITY_INTERVAL, url=REACHABILITY_URL):
+    while True:
+        await check_reachability(url)
+        await asyncio.sleep(interval)
+
+
+async def start_reachability_monitor():
+    # Хук запуска асинхронный: синхронные хуки aiogram вызывает в отдельном потоке, без event loop
+    global _monitor_task
+    if _monitor_task is None or _monitor_task.done():
+        _monitor_task = asyncio.create_task(reachability_monitor())
+
+
+def get_proxy():
+    global _refresh_task
+    # Хендлер никогда не ждет проверку: устаревший результат обновляется в фоне
+    if time.monotonic() - transport["checked_at"] > REACHABILITY_TTL:
+        if _refresh_task is None or _refresh_task.done():
+            _refresh_task = asyncio.create_task(check_reachability())
+    return config.proxy if transport["mode"] == "proxy" else None
+
+
+def provider_for_model(model):
+    return "gemini" if "gemini" in model else "groq"
+
+
+async def get_client_for_model(model):
+    proxy = get_proxy()
 
     try:
         if "gemini" in model:
-            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-            generation_config = genai.GenerationConfig(
-                temperature=1,
-                top_p=0.95,
-                top_k=40,
-                max_output_tokens=8192,
-                response_mime_type="text/plain"
-            )
-            gemini_client = genai.GenerativeModel(
-                model_name=model,
-                generation_config=generation_config,
-                system_instruction=SYSTEM_MESSAGE
-            )
-            return gemini_client
+            return _get_gemini_client(model)
         else:
-            return groq_client
+            return _get_groq_client(proxy)
     except ValueError:
         raise ValueError(f"Unknown model: {model}")
+
+
+async def close_clients():
+    for task in (_monitor_task, _refresh_task, _preload_task):
+        if task is not None:
+            task.cancel()
+    for http_client in _http_clients.values():
+        await http_client.aclose()
+    _http_clients.clear()
+    _clients.clear()
+    _cached_gemini_clients.clear()
@@ -0,0 +1,57 @@
+import os
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+# .env читается один раз на процесс. main импортирует config раньше остальных модулей,
+# поэтому их настройки из os.getenv уже видят значения из .env
+load_dotenv()
+
+SYSTEM_MESSAGE = ('''
+    Ты ассистент, которого зовут StudentLLMAbot. Твоя основная задача - помогать студентам с учебой.
+    Думай, перед тем, как отвечать. Отвечай всегда на русском языке, если тебя не попросили специально помочь с предметом на английском.
+''')
+
+
+def _split(value):
+    return tuple(item.strip() for item in (value or '').split(',') if item.strip())
+
+
+@dataclass(frozen=True)
+class Config:
+    """Общие для нескольких модулей настройки: ключи, адреса и список моделей.
+
+    Настройки отдельных подсистем (лимиты, таймауты) остаются константами в своих модулях.
+    """
+
+    telegram_bot_token: str = None
+    api_server_url: str = None
+    redis_url: str = None
+    model_choices: tuple = ()
+    groq_api_key: str = None
+    gemini_api_key: str = None
+    proxy: str = None
+    ilovepdf_pub_key: str = None
+    # Telegram ID через запятую, для служебных команд
+    admin_ids: frozenset = frozenset()
+
+    @property
+    def default_model(self):
+        return self.model_choices[0]
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        return cls(
+            telegram_bot_token=env.get('TELEGRAM_BOT_TOKEN'),
+            api_server_url=env.get('API_SERVER_URL'),
+            redis_url=env.get('REDIS_URL'),
+            model_choices=_split(env.get('MODEL_CHOICES')),
+            groq_api_key=env.get('GROQ_API_KEY'),
+            gemini_api_key=env.get('GEMINI_API_KEY'),
+            proxy=env.get('PROXY'),
+            ilovepdf_pub_key=env.get('ILOVEPDF_PUB_KEY'),
+            admin_ids=frozenset(_split(env.get('ADMIN_IDS'))),
+        )
+
+
+config = Config.from_env()
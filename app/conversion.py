@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+
+from config import config
+from files import run_blocking
+from metrics import stage
+
+# Основной движок и запасные через запятую: "libreoffice,ilovepdf"
+PDF_CONVERTERS = [name.strip() for name in os.getenv('PDF_CONVERTERS', 'libreoffice,ilovepdf').split(',')
+                  if name.strip()]
+CONVERT_CONCURRENCY = int(os.getenv('CONVERT_CONCURRENCY', 2))
+CONVERT_TIMEOUT = float(os.getenv('CONVERT_TIMEOUT', 120))
+LIBREOFFICE_WORKERS = int(os.getenv('LIBREOFFICE_WORKERS', 2))
+LIBREOFFICE_BINARY = os.getenv('LIBREOFFICE_BINARY', 'soffice')
+UNOCONV_BINARY = os.getenv('UNOCONV_BINARY', 'unoconv')
+LIBREOFFICE_BASE_PORT = int(os.getenv('LIBREOFFICE_BASE_PORT', 2002))
+LIBREOFFICE_START_TIMEOUT = float(os.getenv('LIBREOFFICE_START_TIMEOUT', 60))
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ILovePdfConverter:
+    """Конвертация через API iLovePDF: загрузка, обработка, скачивание и удаление задачи."""
+
+    name = "ilovepdf"
+
+    def __init__(self, concurrency=CONVERT_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def available(self):
+        return bool(config.ilovepdf_pub_key)
+
+    @staticmethod
+    def _convert(path, output_dir):
+        # Запасной движок: SDK загружается только при первой конвертации через него
+        from pylovepdf.tools.officepdf import OfficeToPdf
+
+        task = OfficeToPdf(public_key=config.ilovepdf_pub_key, verify_ssl=False, proxies=None)
+        task.add_file(file_path=path)
+        task.debug = False
+        task.set_output_folder(output_dir)
+        task.execute()
+        converted_pdf = task.download()
+        task.delete_current_task()
+        return converted_pdf
+
+    async def convert(self, path, output_dir):
+        async with self._semaphore:
+            return await run_blocking(self._convert, path, output_dir)
+
+    async def close(self):
+        pass
+
+
+class LibreOfficeWorker:
+    """Один запущенный заранее soffice, принимающий задания от unoconv через UNO-сокет."""
+
+    def __init__(self, index, binary, unoconv, port):
+        self.index = index
+        self.binary = binary
+        self.unoconv = unoconv
+        self.port = port
+        # Свой профиль на процесс: два soffice с одним профилем мешают друг другу
+        self.profile = tempfile.mkdtemp(prefix=f"lo_worker_{index}_")
+        self.process = None
+
+    @property
+    def connection(self):
+        return f"socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+
+    async def start(self):
+        if self.process is not None and self.process.returncode is None:
+            return
+        self.process = await asyncio.create_subprocess_exec(
+            self.binary, "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+            f"--accept={self.connection}", f"-env:UserInstallation=file://{self.profile}",
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        deadline = asyncio.get_running_loop().time() + LIBREOFFICE_START_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                break
+            except OSError:
+                if self.process.returncode is not None or asyncio.get_running_loop().time() > deadline:
+                    await self.stop()
+                    raise ConversionError(f"LibreOffice worker {self.index} did not start")
+                await asyncio.sleep(0.2)
+        logging.info(f"LibreOffice worker {self.index} listening on port {self.port}")
+
+    async def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def convert(self, path, output_dir, timeout):
+        await self.start()
+        process = await asyncio.create_subprocess_exec(
+            self.unoconv, f"--connection={self.connection}", "--format=pdf", f"--output={output_dir}/", path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            # Зависший документ держит soffice, следующему заданию нужен свежий процесс
+            await self.stop()
+            raise ConversionError(f"Conversion of {os.path.basename(path)} timed out after {timeout:.0f}s")
+        if process.returncode:
+            raise ConversionError(f"unoconv exited with {process.returncode}: {stderr.decode(errors='replace')}")
+
+
+class LibreOfficeConverter:
+    """Локальная конвертация пулом прогретых процессов LibreOffice.
+
+    Задания ждут свободный процесс в очереди; документ, не успевший за timeout,
+    прерывается вместе со своим процессом, который перезапускается при следующем задании.
+    """
+
+    name = "libreoffice"
+
+    def __init__(self, workers=LIBREOFFICE_WORKERS, binary=LIBREOFFICE_BINARY, unoconv=UNOCONV_BINARY,
+                 base_port=LIBREOFFICE_BASE_PORT, timeout=CONVERT_TIMEOUT):
+        self.binary = binary
+        self.unoconv = unoconv
+        self.timeout = timeout
+        self.workers = [LibreOfficeWorker(i, binary, unoconv, base_port + i) for i in range(workers)]
+        self._idle = None
+
+    def available(self):
+        return bool(shutil.which(self.binary) and shutil.which(self.unoconv))
+
+    def _queue(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self.workers:
+                self._idle.put_nowait(worker)
+        return self._idle
+
+    async def start(self):
+        # Прогрев при запуске бота: первый документ не ждет старта LibreOffice
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+
+    async def convert(self, path, output_dir):
+        idle = self._queue()
+        worker = await idle.get()
+        try:
+            await worker.convert(path, output_dir, self.timeout)
+        finally:
+            idle.put_nowait(worker)
+        pdf_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".pdf")
+        if not os.path.exists(pdf_path):
+            raise ConversionError(f"LibreOffice produced no PDF for {os.path.basename(path)}")
+        return pdf_path
+
+    async def close(self):
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        for worker in self.workers:
+            shutil.rmtree(worker.profile, ignore_errors=True)
+
+
+CONVERTER_TYPES = {converter.name: converter for converter in (LibreOfficeConverter, ILovePdfConverter)}
+_converters = {}
+
+
+def get_converters(names=None):
+    """Доступные движки в порядке предпочтения, экземпляры создаются один раз на процесс."""
+    converters = []
+    for name in names or PDF_CONVERTERS:
+        if name not in _converters:
+            _converters[name] = CONVERTER_TYPES[name]()
+        if _converters[name].available():
+            converters.append(_converters[name])
+    return converters
+
+
+async def start_converters():
+    for converter in get_converters():
+        if hasattr(converter, "start"):
+            try:
+                await converter.start()
+            except ConversionError as e:
+                logging.warning(f"{converter.name} warm-up failed: {e}")
+
+
+async def close_converters():
+    for converter in _converters.values():
+        await converter.close()
+
+
+async def convert_to_pdf(file, converters=None):
+    """Конвертирует file["name"] из папки file["path"] в PDF рядом с ним.
+
+    Движки пробуются по очереди, пока один не справится. Возвращает имя PDF-файла.
+    """
+    path = os.path.join(file["path"], file["name"])
+    errors = []
+    for converter in converters or get_converters():
+        try:
+            with stage(f"pdf_conversion_{converter.name}"):
+                return os.path.basename(await converter.convert(path, file["path"]))
+        except Exception as e:
+            logging.warning(f"PDF conversion with {converter.name} failed: {e}")
+            errors.append(f"{converter.name}: {e}")
+    raise ConversionError("Не удалось сконвертировать файл в PDF. " + "; ".join(errors or ["нет доступных движков"]))
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+from metrics import stage
+from states import redis, pack, unpack, CHARS_PER_TOKEN, CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGETS
+
+# Текст из PDF, DOCX и текстовых файлов извлекается локально и попадает в контекст любой модели,
+# в том числе Groq. Gemini с Files API остается для сканов, документов с картинками и формулами
+TEXT_EXTRACTION = os.getenv('TEXT_EXTRACTION', '1') == '1'
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 2))
+# Документы длиннее не дочитываются и уходят в Gemini при любом бюджете модели
+TEXT_INLINE_MAX_TOKENS = int(os.getenv('TEXT_INLINE_MAX_TOKENS', 4000))
+# Доля бюджета истории модели под текст всех документов хода: остальное - последующим вопросам и ответам,
+# иначе fit_to_budget вытеснит документ из истории на следующем же ходу
+TEXT_CONTEXT_SHARE = float(os.getenv('TEXT_CONTEXT_SHARE', 0.5))
+TEXT_CHUNK_TOKENS = int(os.getenv('TEXT_CHUNK_TOKENS', 1000))
+# Меньше символов на страницу - скан, текст в нем только на картинке
+EXTRACT_MIN_CHARS_PER_PAGE = int(os.getenv('EXTRACT_MIN_CHARS_PER_PAGE', 200))
+# Больше картинок - задания, скорее всего, на них, а не в тексте
+EXTRACT_MAX_IMAGES = int(os.getenv('EXTRACT_MAX_IMAGES', 3))
+EXTRACT_MAX_BYTES = int(os.getenv('EXTRACT_MAX_BYTES', 20 * 1024 * 1024))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', 30))
+EXTRACT_CACHE_TTL = int(os.getenv('EXTRACT_CACHE_TTL', 30 * 24 * 3600))
+
+TEXT_EXTENSIONS = (".txt", ".md", ".csv", ".py", ".c", ".cpp", ".java", ".js", ".html", ".json", ".tex")
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MATH = "{http://schemas.openxmlformats.org/officeDocument/2006/math}oMath"
+
+_pool = None
+
+
+class NeedsGemini(Exception):
+    """Документ читается, но текста из него недостаточно для ответа."""
+
+
+def extraction_kind(file):
+    """pdf, docx или text, если текст файла можно извлечь локально, иначе None."""
+    name = (file.get("name") or "").lower()
+    mimetype = file.get("mimetype") or ""
+    if name.endswith(".pdf") or mimetype == "application/pdf":
+        return "pdf"
+    if name.endswith(".docx"):
+        return "docx"
+    if name.endswith(TEXT_EXTENSIONS) or mimetype.startswith("text/"):
+        return "text"
+    return None
+
+
+def count_tokens(text, chars_per_token=CHARS_PER_TOKEN):
+    # Та же оценка, что у бюджета истории в states.estimate_tokens
+    return len(text) // chars_per_token + 1 if text else 0
+
+
+def chunk_text(text, max_tokens=TEXT_CHUNK_TOKENS, chars_per_token=CHARS_PER_TOKEN):
+    """Делит текст на части не длиннее max_tokens, по возможности по границам абзацев."""
+    limit = max_tokens * chars_per_token
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n"):
+        while len(paragraph) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:limit])
+            paragraph = paragraph[limit:]
+        if current and len(current) + len(paragraph) + 1 > limit:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n{paragraph}" if current else paragraph
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+def _pdf_pages(path):
+    # pypdf нужен только для PDF и импортируется в процессе пула
+    from pypdf import PdfReader
+
+    images = set()
+    for page in PdfReader(path).pages:
+        try:
+            xobjects = page["/Resources"].get_object().get("/XObject") or {}
+            for ref in xobjects.get_object().values():
+                if ref.get_object().get("/Subtype") == "/Image":
+                    # Один логотип на всех страницах - одна картинка
+                    images.add(getattr(ref, "idnum", id(ref)))
+        except (KeyError, AttributeError):
+            pass
+        yield page.extract_text() or "", len(images)
+
+
+def _docx_pages(path):
+    with zipfile.ZipFile(path) as docx:
+        images = sum(1 for name in docx.namelist() if name.startswith("word/media/"))
+        with docx.open("word/document.xml") as f:
+            root = ElementTree.parse(f).getroot()
+    if root.find(f".//{_MATH}") is not None:
+        # Формулы Word в тексте теряются, их читает Gemini по PDF
+        raise NeedsGemini("math")
+    paragraphs = []
+    for paragraph in root.iter(f"{_W}p"):
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == f"{_W}t":
+                parts.append(node.text or "")
+            elif node.tag == f"{_W}tab":
+                parts.append("\t")
+            elif node.tag in (f"{_W}br", f"{_W}cr"):
+                parts.append("\n")
+        paragraphs.append("".join(parts))
+    # В DOCX нет страниц, документ читается целиком
+    yield "\n".join(paragraphs), images
+
+
+def _text_pages(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    for encoding in ("utf-8", "cp1251"):
+        try:
+            yield data.decode(encoding), 0
+            return
+        except UnicodeDecodeError:
+            continue
+    yield data.decode("utf-8", errors="replace"), 0
+
+
+_READERS = {"pdf": _pdf_pages, "docx": _docx_pages, "text": _text_pages}
+
+
+def extract_document(path, kind, max_tokens=TEXT_INLINE_MAX_TOKENS, chunk_tokens=TEXT_CHUNK_TOKENS,
+                     min_chars_per_page=EXTRACT_MIN_CHARS_PER_PAGE, max_images=EXTRACT_MAX_IMAGES,
+                     chars_per_token=CHARS_PER_TOKEN):
+    """Выполняется в процессе пула. Возвращает решение о маршруте документа.
+
+    {"route": "text", "chunks", "tokens", "pages"} - текст помещается в контекст;
+    {"route": "gemini", "reason", "pages"} - документ нужно отдать Gemini целиком.
+    Чтение останавливается, как только текст перестает помещаться в max_tokens.
+    """
+    pages = []
+    chars = 0
+    images = 0
+    try:
+        for text, images in _READERS[kind](path):
+            text = text.strip()
+            pages.append(text)
+            chars += len(text) + 2
+            if chars // chars_per_token > max_tokens:
+                return {"route": "gemini", "reason": "too_large", "pages": len(pages)}
+    except NeedsGemini as e:
+        return {"route": "gemini", "reason": str(e), "pages": len(pages)}
+    except Exception as e:
+        return {"route": "gemini", "reason": "error", "error": str(e), "pages": len(pages)}
+
+    text = "\n\n".join(page for page in pages if page)
+    if images > max_images:
+        return {"route": "gemini", "reason": "images", "pages": len(pages)}
+    if kind == "pdf" and len(text) < min_chars_per_page * max(1, len(pages)):
+        return {"route": "gemini", "reason": "scanned", "pages": len(pages)}
+    if not text:
+        return {"route": "gemini", "reason": "empty", "pages": len(pages)}
+    return {"route": "text", "chunks": chunk_text(text, chunk_tokens, chars_per_token),
+            "tokens": count_tokens(text, chars_per_token), "pages": len(pages)}
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # fork, а не spawn: процесс spawn заново импортирует main как __mp_main__ вместе с aiogram.
+        # Пул создается при старте бота, до обработки обновлений
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=context)
+    return _pool
+
+
+async def start_extraction_pool():
+    if TEXT_EXTRACTION:
+        # Пул с fork запускает все процессы при первой задаче
+        await asyncio.wrap_future(_get_pool().submit(count_tokens, ""))
+
+
+async def close_extraction_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def is_extracted_text(uploaded):
+    return isinstance(uploaded, dict) and uploaded.get("route") == "text"
+
+
+async def extract_text(path, file):
+    """Текст документа или решение отдать его Gemini; результат кэшируется по sha256 файла.
+
+    Возвращает None, если локально документ не читается и извлечение не пробовалось.
+    """
+    kind = extraction_kind(file)
+    if not TEXT_EXTRACTION or kind is None or (file.get("size") or 0) > EXTRACT_MAX_BYTES:
+        return None
+    key = f"text:{file['sha256']}"
+    cached = await redis.get(key)
+    if cached:
+        return unpack(cached)
+
+    loop = asyncio.get_running_loop()
+    try:
+        with stage("text_extraction"):
+            result = await asyncio.wait_for(loop.run_in_executor(_get_pool(), extract_document, path, kind),
+                                            EXTRACT_TIMEOUT)
+    except Exception as e:
+        # Сломанный пул или зависший разбор: документ идет в Gemini обычным путем
+        logging.warning(f"Text extraction failed for {file.get('name')}: {e!r}")
+        return None
+    logging.info(f"Extracted {file.get('name')}: {result['route']} {result.get('reason', '')} "
+                 f"{result.get('tokens', 0)} tokens, {result['pages']} pages")
+    await redis.set(key, pack(result), ex=EXTRACT_CACHE_TTL)
+    return result
+
+
+def text_allowance(model):
+    """Место под текст документов одного хода в истории модели: {"tokens": N}, общее для всех частей альбома."""
+    budget = CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+    return {"tokens": min(TEXT_INLINE_MAX_TOKENS, int(budget * TEXT_CONTEXT_SHARE))}
+
+
+def reserve_text(allowance, name, extracted):
+    """Занимает место под текст документа. False - текст не помещается, документ нужно отдать Gemini."""
+    # Считается так же, как fit_to_budget посчитает реплику: вместе с заголовками частей
+    tokens = count_tokens(document_prompt("", [(name, extracted)]))
+    if tokens > allowance["tokens"]:
+        return False
+    allowance["tokens"] -= tokens
+    return True
+
+
+def document_prompt(caption, documents):
+    """Сообщение для модели: подпись и текст документов [(имя, результат extract_text)].
+
+    Части длинного документа пронумерованы, чтобы модель и пользователь могли на них ссылаться.
+    """
+    parts = [caption]
+    for name, extracted in documents:
+        chunks = extracted["chunks"]
+        for index, chunk in enumerate(chunks, 1):
+            title = f"Документ {name}" + (f", часть {index} из {len(chunks)}" if len(chunks) > 1 else "")
+            parts.append(f"{title}:\n\"\"\"\n{chunk}\n\"\"\"")
+    return "\n\n".join(parts)
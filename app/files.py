@@ -1,29 +1,125 @@
+import asyncio
+import functools
+import hashlib
+import io
+import logging
 import os
+import shutil
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import google.generativeai as genai
-from dotenv import load_dotenv
-from pylovepdf.tools.officepdf import OfficeToPdf
+from clients import gemini_sdk
+from config import config
+from metrics import stage, observe
+from states import GEMINI_FILE_TTL, GEMINI_FILE_TTL_MARGIN
 
-load_dotenv()
+FILE_WORKERS = int(os.getenv('FILE_WORKERS', 8))
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+FILE_ACTIVE_TIMEOUT = float(os.getenv('FILE_ACTIVE_TIMEOUT', 300))
+FILE_POLL_INITIAL_DELAY = float(os.getenv('FILE_POLL_INITIAL_DELAY', 1))
+FILE_POLL_MAX_DELAY = float(os.getenv('FILE_POLL_MAX_DELAY', 10))
+GEMINI_FILE_CACHE_SIZE = int(os.getenv('GEMINI_FILE_CACHE_SIZE', 1000))
+# Фото до INLINE_IMAGE_MAX_BYTES уходят в запрос к Gemini байтами, без загрузки в Files API и ожидания
+# обработки; крупнее - обычным путем. 0 - всегда через Files API
+INLINE_IMAGE_MAX_BYTES = int(os.getenv('INLINE_IMAGE_MAX_BYTES', 4 * 1024 * 1024))
+# Большая сторона после уменьшения; Gemini все равно режет изображение на фрагменты по 768 точек
+INLINE_IMAGE_MAX_SIDE = int(os.getenv('INLINE_IMAGE_MAX_SIDE', 1536))
+INLINE_IMAGE_QUALITY = int(os.getenv('INLINE_IMAGE_QUALITY', 85))
 
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+# Все блокирующие вызовы SDK выполняются в отдельном пуле потоков,
+# чтобы не останавливать event loop бота на время загрузки или конвертации
+_executor = ThreadPoolExecutor(max_workers=FILE_WORKERS, thread_name_prefix="files")
+_upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
 
+# Активные файлы Gemini по имени: (файл, когда перестать им пользоваться)
+_gemini_files = {}
 
-async def convert_to_pdf(file):
-    t = OfficeToPdf(public_key=os.getenv("ILOVEPDF_PUB_KEY"),
-                    verify_ssl=False, proxies=None)
-    t.add_file(file_path=os.path.join(file["path"], file["name"]))
-    t.debug = False
-    t.set_output_folder(file['path'])
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-    t.execute()
+# Том, общий с локальным Bot API сервером: файлы не копируются, а переименовываются
+BOT_API_ROOT = (r"\\wsl.localhost\docker-desktop-data\data\docker\volumes\telegram-bot-api-data\_data"
+                if os.name == "nt" else "/var/lib/telegram-bot-api")
+STAGING_DIR = "staging"
 
-    converted_pdf = t.download()
 
-    t.delete_current_task()
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
 
-    return os.path.basename(converted_pdf)
+
+def bot_api_dir():
+    return os.path.join(BOT_API_ROOT, config.telegram_bot_token)
+
+
+def staging_root():
+    return os.path.join(bot_api_dir(), STAGING_DIR)
+
+
+def _make_staging_dir(user_id):
+    os.makedirs(staging_root(), exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{user_id}_", dir=staging_root())
+
+
+async def create_staging_dir(user_id):
+    # Уникальная папка на каждый запрос: параллельные загрузки одного пользователя
+    # не удаляют файлы друг друга
+    return await run_blocking(_make_staging_dir, user_id)
+
+
+async def remove_staging_dir(path):
+    await run_blocking(shutil.rmtree, path, ignore_errors=True)
+
+
+def stage_telegram_file(file_path, staging_dir, name):
+    # file_path - путь внутри Bot API сервера: <token>/<documents|photos>/<file>
+    folder, src_name = os.path.split(file_path)
+    src = os.path.join(bot_api_dir(), os.path.basename(folder), src_name)
+    dest = os.path.join(staging_dir, os.path.basename(name))
+    os.replace(src, dest)
+    return dest
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss в килобайтах на Linux: максимум процесса за все время, он не уменьшается
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    # Текущий RSS процесса: в отличие от ru_maxrss, показывает рост памяти за время загрузки
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def log_rss(name, size, rss_before):
+    rss_after = current_rss_mb()
+    if rss_after is None or rss_before is None:
+        return
+    # Загрузки идут параллельно: изменение RSS относится ко всему процессу, а не только к этому файлу
+    peak = peak_rss_mb()
+    peak = f", process peak {peak:.1f} MB" if peak is not None else ""
+    logging.info(f"Processed {name} ({size} bytes): process RSS {rss_before:.1f} -> {rss_after:.1f} MB{peak}")
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def file_sha256(path):
+    return await run_blocking(_file_sha256, path)
 
 
 async def upload_to_gemini(path, mime_type=None):
@@ -31,16 +127,78 @@ async def upload_to_gemini(path, mime_type=None):
 
     See https://ai.google.dev/gemini-api/docs/prompting_with_media
     """
-    file = genai.upload_file(path, mime_type=mime_type)
-    print(f"Uploaded file '{file.display_name}' as: {file.uri}")
+    async with _upload_semaphore:
+        with stage("gemini_upload"):
+            file = await run_blocking(lambda: gemini_sdk().upload_file(path, mime_type=mime_type))
+    logging.info(f"Uploaded file '{file.display_name}' as: {file.uri}")
     return file
 
 
+def _prepare_inline_image(path, max_side, quality):
+    # Pillow нужен только для фото, поэтому импортируется в потоке пула при первом из них
+    from PIL import Image, ImageOps
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    with Image.open(path) as image:
+        if max(image.size) <= max_side and image.format in ("JPEG", "PNG", "WEBP"):
+            # Уже подходящего размера: отправляем как есть, без потери качества
+            return {"mime_type": Image.MIME[image.format], "data": data}
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+
+def inline_image_allowed(file):
+    return 0 < (file.get("size") or 0) <= INLINE_IMAGE_MAX_BYTES
+
+
+async def prepare_inline_image(path, max_side=INLINE_IMAGE_MAX_SIDE, quality=INLINE_IMAGE_QUALITY):
+    """Изображение для передачи в запросе к Gemini: {"mime_type", "data"}.
+
+    Большие изображения уменьшаются до max_side по большей стороне и пережимаются в JPEG
+    в пуле потоков.
+    """
+    with stage("image_prepare"):
+        return await run_blocking(_prepare_inline_image, path, max_side, quality)
+
+
+def gemini_expiration(file):
+    expiration_time = getattr(file, "expiration_time", None)
+    return expiration_time.timestamp() if expiration_time else None
+
+
+def cache_gemini_file(file):
+    now = time.time()
+    if len(_gemini_files) >= GEMINI_FILE_CACHE_SIZE:
+        for name, (_, expires_at) in list(_gemini_files.items()):
+            if expires_at <= now:
+                del _gemini_files[name]
+        while len(_gemini_files) >= GEMINI_FILE_CACHE_SIZE:
+            del _gemini_files[next(iter(_gemini_files))]
+    expires_at = (gemini_expiration(file) or now + GEMINI_FILE_TTL) - GEMINI_FILE_TTL_MARGIN
+    _gemini_files[file.name] = (file, expires_at)
+
+
 async def get_from_gemini(name):
-    file = genai.get_file(name)
+    cached = _gemini_files.get(name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    file = await run_blocking(lambda: gemini_sdk().get_file(name))
+    if file.state.name == "ACTIVE":
+        cache_gemini_file(file)
     return file
 
 
+async def delete_from_gemini(name):
+    _gemini_files.pop(name, None)
+    await run_blocking(lambda: gemini_sdk().delete_file(name))
+
+
 async def wait_for_files_active(files):
     """Waits for the given files to be active.
 
@@ -48,25 +206,30 @@ async def wait_for_files_active(files):
     used as prompt inputs. The status can be seen by querying the file's "state"
     field.
 
-    This implementation uses a simple blocking polling loop. Production code
-    should probably employ a more sophisticated approach.
+    Polling uses exponential backoff and gives up after FILE_ACTIVE_TIMEOUT
+    seconds for all files together.
     """
-    print(files)
-    print("Waiting for file processing...")
+    logging.debug(f"Waiting for processing of {[file.name for file in files]}")
+    started = time.monotonic()
+    deadline = time.monotonic() + FILE_ACTIVE_TIMEOUT
     for name in (file.name for file in files):
-        file = genai.get_file(name)
+        delay = FILE_POLL_INITIAL_DELAY
+        file = await run_blocking(lambda: gemini_sdk().get_file(name))
         while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(10)
-            file = genai.get_file(name)
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"File {file.name} is still processing after {FILE_ACTIVE_TIMEOUT:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, FILE_POLL_MAX_DELAY)
+            file = await run_blocking(lambda: gemini_sdk().get_file(name))
         if file.state.name != "ACTIVE":
             raise Exception(f"File {file.name} failed to process")
-    print("...all files ready")
-    print()
+        cache_gemini_file(file)
+    observe("gemini_activation", time.monotonic() - started)
 
 
 async def list_gemini_files():
-    files = genai.list_files()
+    # list_files лениво листает страницы, поэтому итерация тоже уходит в пул
+    files = await run_blocking(lambda: list(gemini_sdk().list_files()))
     # for f in files:
     #     print(f)
     return files
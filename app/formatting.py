@@ -1,63 +1,389 @@
-from aiogram.utils.formatting import Pre, as_marked_list, Code, Text, Bold
-from dotenv import load_dotenv
+import re
 
-load_dotenv()
+# Символы, которые MarkdownV2 требует экранировать вне сущностей
+SPECIAL_CHARS = '_*[]()~`>#+-=|{}.!\\'
+_ESCAPE = str.maketrans({c: '\\' + c for c in SPECIAL_CHARS})
+# Внутри pre и code экранируются только ` и \
+_ESCAPE_CODE = str.maketrans({'`': '\\`', '\\': '\\\\'})
+# Внутри (...) ссылки экранируются только ) и \
+_ESCAPE_URL = str.maketrans({')': '\\)', '\\': '\\\\'})
+
+_INLINE_MARKUP = re.compile(r'[\\`*_~\[]')
+_LINK = re.compile(r'\[([^\]\n]{1,500})\]\(((?:https?://|mailto:|tg://)[^\s)]{1,2000})\)')
+_HEADER = re.compile(r'#{1,6}\s+(.+)')
+_BULLET = re.compile(r'(\s*)[*+-]\s+(.*)')
+_ORDERED = re.compile(r'(\s*)(\d{1,9})([.)])\s+(.*)')
+_QUOTE = re.compile(r'>\s?(.*)')
+_RULE = re.compile(r'(?:-{3,}|\*{3,}|_{3,})')
+_LANGUAGE = re.compile(r'[\w+#.-]*')
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Разметка LLM -> разметка MarkdownV2
+_ENTITY_MARKUP = {'bold': '*', 'italic': '_', 'strike': '~'}
+
+
+def escape(text: str) -> str:
+    return text.translate(_ESCAPE)
+
+
+def _render_inline(text: str, drop_bold: bool = False) -> str:
+    """Inline-разметка одной строки.
+
+    Разделители складываются в стек и становятся разметкой только когда найдена
+    пара; незакрытые к концу строки выводятся как экранированный текст. Поэтому
+    результат всегда корректен, в том числе для незаконченного ответа при стриминге.
+    """
+    tokens = []
+    stack = []
+    plain_start = 0
+    i = 0
+    n = len(text)
+    # Длины серий обратных кавычек, для которых закрывающей серии дальше нет
+    unclosed_code = set()
+
+    def delimiter(kind, ch, run_start, run_end, literal):
+        # Разделитель может открыть сущность, если за ним не пробел, и закрыть, если перед ним не пробел
+        can_open = run_end < n and not text[run_end].isspace()
+        can_close = run_start > 0 and not text[run_start - 1].isspace()
+        if ch == '_':
+            # snake_case не курсив
+            can_open = can_open and (run_start == 0 or not text[run_start - 1].isalnum())
+            can_close = can_close and (run_end == n or not text[run_end].isalnum())
+
+        token = [kind, literal, False]
+        if can_close and any(tokens[index][0] == kind for index in stack):
+            # Все незакрытые разделители внутри закрываемой сущности остаются текстом
+            while True:
+                opener = tokens[stack.pop()]
+                if opener[0] == kind:
+                    break
+            opener[2] = token[2] = True
+        elif can_open:
+            stack.append(len(tokens))
+        tokens.append(token)
+
+    while True:
+        match = _INLINE_MARKUP.search(text, i)
+        if match is None:
+            break
+        i = match.start()
+        ch = text[i]
+        if i > plain_start:
+            tokens.append(escape(text[plain_start:i]))
+
+        if ch == '\\':
+            # Экранирование из исходного Markdown
+            if i + 1 < n and text[i + 1] in SPECIAL_CHARS:
+                tokens.append(escape(text[i + 1]))
+                i += 2
+            else:
+                tokens.append('\\\\')
+                i += 1
+        elif ch == '`':
+            run_end = i
+            while run_end < n and text[run_end] == '`':
+                run_end += 1
+            run = run_end - i
+            close = -1 if run in unclosed_code else text.find('`' * run, run_end)
+            if close == -1:
+                unclosed_code.add(run)
+                tokens.append(escape(text[i:run_end]))
+                i = run_end
+            else:
+                tokens.append('`' + text[run_end:close].translate(_ESCAPE_CODE) + '`')
+                i = close + run
+        elif ch == '[':
+            link = _LINK.match(text, i)
+            if link:
+                tokens.append('[' + escape(link[1]) + '](' + link[2].translate(_ESCAPE_URL) + ')')
+                i = link.end()
+            else:
+                tokens.append('\\[')
+                i += 1
+        else:
+            run_end = i
+            while run_end < n and text[run_end] == ch:
+                run_end += 1
+            if ch == '~':
+                if run_end - i >= 2:
+                    delimiter('strike', ch, i, i + 2, '\\~\\~')
+                    run_end = i + 2
+                else:
+                    tokens.append('\\~')
+            else:
+                # *** открывает жирный и курсив; при закрытии сначала закрывается курсив
+                pos = i
+                while pos < run_end:
+                    left = run_end - pos
+                    top = tokens[stack[-1]][0] if stack else None
+                    if left >= 2 and not (top == 'italic' and left % 2 == 1):
+                        delimiter('bold', ch, pos, pos + 2, escape(ch * 2))
+                        pos += 2
+                    else:
+                        delimiter('italic', ch, pos, pos + 1, escape(ch))
+                        pos += 1
+            i = run_end
+        plain_start = i
+
+    if plain_start < n:
+        tokens.append(escape(text[plain_start:]))
+
+    parts = []
+    # Для открытых сущностей - позиция открывающего разделителя в parts и его текст
+    opened = {}
+    italic_closed_at = None
+    for token in tokens:
+        if isinstance(token, str):
+            parts.append(token)
+        elif not token[2]:
+            parts.append(token[1])
+        elif token[0] == 'bold' and drop_bold:
+            continue
+        elif token[0] in opened:
+            kind = token[0]
+            start, literal = opened.pop(kind)
+            if start == len(parts) - 1:
+                # Пустая сущность остается текстом: из одной разметки сообщение не собрать
+                parts[-1] = literal + token[1]
+                continue
+            parts.append(_ENTITY_MARKUP[kind])
+            if kind == 'italic':
+                italic_closed_at = len(parts) - 1
+        elif token[0] == 'italic' and italic_closed_at == len(parts) - 1:
+            # "__" в MarkdownV2 - подчеркивание: курсив сразу после курсива продолжает его.
+            # Разделитель-пустой жирный внутри жирного текста был бы вложенным жирным
+            parts.pop()
+            opened['italic'] = (None, token[1])
+        else:
+            opened[token[0]] = (len(parts), token[1])
+            parts.append(_ENTITY_MARKUP[token[0]])
+    return ''.join(parts)
+
+
+def _render_line(line: str) -> str:
+    stripped = line.strip()
+    if not stripped:
+        return ''
+    if _RULE.fullmatch(stripped):
+        return '————————'
+    header = _HEADER.fullmatch(stripped)
+    if header:
+        return '*' + _render_inline(header[1].strip(), drop_bold=True) + '*'
+    bullet = _BULLET.fullmatch(line)
+    if bullet:
+        return bullet[1] + '• ' + _render_inline(bullet[2])
+    ordered = _ORDERED.fullmatch(line)
+    if ordered:
+        return ordered[1] + ordered[2] + escape(ordered[3]) + ' ' + _render_inline(ordered[4])
+    quote = _QUOTE.fullmatch(stripped)
+    if quote:
+        return '>' + _render_inline(quote[1])
+    return _render_inline(line)
 
 
 def format_message(message: str) -> str:
-    formatted_parts = []
+    """Переводит Markdown из ответа LLM в MarkdownV2 Telegram за один проход по тексту.
+
+    Блоки кода с языком, inline-код, жирный, курсив, зачеркнутый, ссылки,
+    заголовки, списки и цитаты. Незакрытый блок кода закрывается в конце.
+    """
+    lines = []
     inside_code_block = False
-    buffer = []
-    code_block_language = None  # Track the language identifier for the code block
 
     for line in message.splitlines():
-        if line.startswith('```'):
-            # If inside code block, close it
-            if inside_code_block:
-                buffer.append("```")  # Close the current code block
-                formatted_parts.append(("\n".join(buffer)))
-                buffer = []
-            # Toggle code block state
-            inside_code_block = not inside_code_block
-            # Capture the language identifier, if it exists
+        stripped = line.strip()
+        if stripped.startswith('```'):
             if inside_code_block:
-                code_block_language = line.lstrip('`')  # Capture language (e.g., python)
-                buffer.append(f"```{code_block_language}")  # Start the code block with the language
-            else:
-                code_block_language = None  # Reset the language identifier
+                lines.append('```')
+                inside_code_block = False
+                # "```python" сразу после блока - начало следующего блока
+                if stripped == '```':
+                    continue
+            language = _LANGUAGE.match(stripped[3:].strip())[0]
+            lines.append('```' + language)
+            inside_code_block = True
         elif inside_code_block:
-            buffer.append(line)  # Collect lines inside the code block
-        elif line.startswith('*'):
-            clean_line = line.lstrip('*').strip()
-            formatted_parts.append(as_marked_list(clean_line).as_markdown())
+            lines.append(line.translate(_ESCAPE_CODE))
         else:
-            # Handle inline code and escape text
-            formatted_line = ""
-            code = line.split("`")
-            for i, part in enumerate(code):
-                if i % 2 == 0:
-                    # Escape regular text
-                    formatted_line += Text(part).as_markdown()
+            lines.append(_render_line(line))
+
+    if inside_code_block:
+        lines.append('```')
+
+    return '\n'.join(lines)
+
+
+def _link_tail(line: str, start: int):
+    """Для ссылки, открытой "[" на позиции start, - позиция "]" и хвост "](url)"."""
+    i = start + 1
+    while line[i] != ']':
+        i += 2 if line[i] == '\\' else 1
+    end = i + 2
+    while line[end] != ')':
+        end += 2 if line[end] == '\\' else 1
+    return i, line[i:end + 1]
+
+
+def _safe_cuts(line: str, inside_code_block: bool):
+    """Позиции, на которых строку можно разрезать.
+
+    Возвращает три списка по убыванию предпочтения: после пробела вне сущностей,
+    любая позиция вне сущностей и ссылок, любая позиция не внутри экранирования
+    и не в адресе ссылки. В последнем списке вместе с позицией - открытые на ней
+    сущности: разделитель или для ссылки пара ("[", "](url)").
+    """
+    spaces = []
+    outside = []
+    unescaped = []
+    opened = []
+    # Позиции "[" и "]" открытой ссылки: резать можно только внутри ее текста
+    link_start = link_text_end = None
+    i = 0
+    n = len(line)
+    while i < n:
+        if i == link_text_end:
+            # Адрес ссылки не режется: пропускаем "](url)"
+            i += len(opened.pop()[1])
+            link_start = link_text_end = None
+            continue
+        # Сразу после "[" текст ссылки в этой части был бы пустым
+        if link_start is None or i > link_start + 1:
+            unescaped.append((i, tuple(opened)))
+        if not opened:
+            outside.append(i)
+            if i and line[i - 1] == ' ':
+                spaces.append(i)
+        ch = line[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if not inside_code_block:
+            code = opened and opened[-1] == '`'
+            if ch == '`':
+                if code:
+                    opened.pop()
                 else:
-                    # Format as inline code
-                    formatted_line += Code(part).as_markdown()
-            formatted_parts.append(formatted_line)
-
-    # Add any remaining text inside a code block and ensure closing "```"
-    if buffer:
-        buffer.append("```")  # Ensure the code block ends properly
-        formatted_parts.append(Pre("\n".join(buffer)).as_markdown())
-
-    bold_formatted_parts = []
-    for lines in formatted_parts:
-        bold_lines = lines.split("\\*\\*")
-        for i, bold_line in enumerate(bold_lines):
-            if i % 2 == 0:
-                bold_formatted_parts.append(bold_line)
-            else:
-                bold_formatted_parts.append(Bold(bold_line).as_markdown())
-        bold_formatted_parts.append("\n")
+                    opened.append('`')
+            elif code:
+                pass
+            elif ch == '[':
+                link_start = i
+                link_text_end, tail = _link_tail(line, i)
+                opened.append(('[', tail))
+            elif ch in '*_~':
+                marker = '__' if line.startswith('__', i) else ch
+                if opened and opened[-1] == marker:
+                    opened.pop()
+                else:
+                    opened.append(marker)
+                i += len(marker)
+                continue
+        i += 1
+    return spaces, outside, unescaped
+
+
+def _closing(opened):
+    return ''.join(entity[1] if isinstance(entity, tuple) else entity for entity in reversed(opened))
+
+
+def _opening(opened):
+    return ''.join(entity[0] if isinstance(entity, tuple) else entity for entity in opened)
+
+
+def _split_long_line(line: str, room: int, inside_code_block: bool):
+    pieces = []
+    while len(line) > room:
+        spaces, outside, unescaped = _safe_cuts(line, inside_code_block)
+        cut = max((c for c in spaces + outside if 0 < c <= room), default=None)
+        if cut is not None:
+            pieces.append(line[:cut])
+            line = line[cut:]
+            continue
+        # Сущность длиннее сообщения: закрываем ее в этой части и открываем заново в следующей.
+        # Ссылка закрывается своим адресом и открывается заново с оставшимся текстом.
+        # Разрез дальше повторно открытых разделителей: иначе следующая часть не короче этой
+        candidates = [(c, o) for c, o in unescaped if len(_opening(o)) < c and c + len(_closing(o)) <= room]
+        if candidates:
+            cut, opened = max(candidates, key=lambda item: item[0])
+            pieces.append(line[:cut] + _closing(opened))
+            line = _opening(opened) + line[cut:]
+            continue
+        # Разметка не помещается даже с одним символом текста: режем как есть
+        cut = max((c for c, _ in unescaped if 0 < c <= room), default=max(room, 1))
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return pieces
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Делит MarkdownV2 на части не длиннее limit, предпочитая границы абзацев и строк.
+
+    Блок кода, попавший на границу, закрывается в одной части и открывается с тем
+    же языком в следующей; экранирование не разрывается.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    current = []
+    # Сколько строк в начале current - повторно открытый блок кода, а не содержимое
+    base = 0
+    size = 0
+    language = None
+    # (номер строки в current, размер части до нее) для последней пустой строки вне кода
+    paragraph_break = None
+
+    def flush(lines, open_language):
+        body = '\n'.join(lines)
+        if open_language is not None:
+            body += '\n```'
+        # Telegram не отправляет пустое сообщение
+        if body.strip():
+            chunks.append(body)
+
+    def reopen():
+        lines = ['```' + language] if language is not None else []
+        return lines, len(lines), len(lines[0]) if lines else 0
+
+    for line in text.split('\n'):
+        is_fence = line.startswith('```')
+        # Место под "\n```", если часть оборвется внутри блока кода
+        reserve = 4 if (language is None) == is_fence else 0
+        if len(current) > base and size + 1 + len(line) + reserve > limit:
+            if paragraph_break and paragraph_break[1] >= limit // 2:
+                index = paragraph_break[0]
+                flush(current[:index], None)
+                current = current[index + 1:]
+                base = 0
+                size = len('\n'.join(current))
+            # Пустой блок не отправляем: открывающая строка переходит в следующую часть. Если первая
+            # строка блока не поместится и туда, она все равно режется - начинаем ее в этой части
+            opening_fence = language is not None and len(current) > base and current[-1].startswith('```')
+            if opening_fence and len(line) <= limit - len(current[-1]) - 1 - reserve:
+                flush(current[:-1], None)
+                current, base, size = reopen()
+            elif not opening_fence and len(current) > base and size + 1 + len(line) + reserve > limit:
+                flush(current, language)
+                current, base, size = reopen()
+            paragraph_break = None
+
+        room = limit - size - (1 if current else 0) - reserve
+        if len(line) > room:
+            pieces = _split_long_line(line, room, language is not None)
+            for piece in pieces[:-1]:
+                flush(current + [piece], language)
+                current, base, size = reopen()
+            line = pieces[-1]
 
-    result = "".join(bold_formatted_parts)
+        if not line and language is None and len(current) > base:
+            paragraph_break = (len(current), size)
+        if is_fence:
+            language = line[3:] if language is None else None
+        size += len(line) + (1 if current else 0)
+        current.append(line)
 
-    return result
+    if len(current) > base:
+        flush(current, language)
+    return chunks
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from clients import gemini_sdk
+from config import SYSTEM_MESSAGE
+from files import get_from_gemini, gemini_expiration, run_blocking
+from metrics import stage
+from states import GEMINI_FILE_TTL_MARGIN
+
+GEMINI_HISTORY_CACHE_SIZE = int(os.getenv('GEMINI_HISTORY_CACHE_SIZE', 1000))
+# Кэш контекста Gemini: начало беседы с документами хранится на стороне Gemini, и следующие ходы
+# не отправляют документ заново. Создается, когда запрос занял не меньше GEMINI_CACHE_MIN_TOKENS
+# (меньше Gemini не кэширует); 0 - не использовать
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CACHE_MIN_TOKENS', 32768))
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', 3600))
+# Не пользуемся кэшем, который вот-вот истечет
+GEMINI_CACHE_MARGIN = int(os.getenv('GEMINI_CACHE_MARGIN', 120))
+# После отказа (модель без поддержки кэша, мало токенов) не пробуем снова какое-то время
+GEMINI_CACHE_RETRY = int(os.getenv('GEMINI_CACHE_RETRY', 3600))
+
+# user_id -> (реплики в формате контекста, они же в формате Gemini, срок годности ссылок на файлы)
+_histories = OrderedDict()
+# Модель -> время, до которого не пытаться создать кэш
+_cache_failures = {}
+
+
+async def to_gemini_turn(turn):
+    if turn["role"] == "assistant":
+        return {"role": "model", "parts": [{"text": turn["content"]}]}
+    if isinstance(turn["content"], list):
+        # Файлы: [имена файлов в Gemini..., подпись]
+        uploaded_files = [await get_from_gemini(name) for name in turn["content"][:-1]]
+        return {"role": "user", "parts": uploaded_files + [turn["content"][-1]]}
+    return {"role": "user", "parts": [{"text": turn["content"]}]}
+
+
+def _reusable_prefix(cached_turns, turns):
+    # Окно контекста сдвигается вперед: ищем, с какой реплики кэш совпадает с началом окна
+    for offset in range(len(cached_turns) + 1):
+        overlap = cached_turns[offset:]
+        if overlap == turns[:len(overlap)]:
+            return offset, len(overlap)
+    return len(cached_turns), 0
+
+
+async def get_gemini_history(user_id, turns):
+    """История для start_chat: меняются только реплики, добавленные с прошлого хода."""
+    cached_turns, cached_history, valid_until = _histories.pop(user_id, ([], [], 0))
+    if valid_until <= time.time():
+        # Gemini удалил какой-то из файлов истории - собираем заново
+        cached_turns, cached_history = [], []
+    offset, reused = _reusable_prefix(cached_turns, turns)
+    history = cached_history[offset:offset + reused]
+    for turn in turns[reused:]:
+        history.append(await to_gemini_turn(turn))
+
+    expirations = [gemini_expiration(part) for turn in history for part in turn["parts"]
+                   if not isinstance(part, (dict, str))]
+    valid_until = min(filter(None, expirations), default=float("inf")) - GEMINI_FILE_TTL_MARGIN
+    _histories[user_id] = (list(turns), history, valid_until)
+    while len(_histories) > GEMINI_HISTORY_CACHE_SIZE:
+        _histories.popitem(last=False)
+    return list(history)
+
+
+def _cached_prefix(turns):
+    # В кэш идет начало истории до последней реплики с файлами включительно
+    for index in range(len(turns) - 1, -1, -1):
+        if isinstance(turns[index]["content"], list):
+            return index + 1
+    return 0
+
+
+def _prefix_key(model, turns):
+    return hashlib.sha256(json.dumps([model, turns], ensure_ascii=False).encode()).hexdigest()
+
+
+def find_context_cache(files, model, turns):
+    """Кэш контекста для начала истории turns: (имя кэша, сколько реплик он покрывает) или None."""
+    prefix = _cached_prefix(turns)
+    if not prefix:
+        return None
+    key = _prefix_key(model, turns[:prefix])
+    for file in files:
+        record = file.get("context_cache")
+        if record and record["key"] == key and record["expires_at"] - GEMINI_CACHE_MARGIN > time.time():
+            return record["name"], prefix
+    return None
+
+
+async def cache_context(model, turns, files, prompt_tokens):
+    """Создает кэш контекста для начала истории с документами, если запрос был достаточно большим.
+
+    Ссылка на кэш сохраняется в записи файла из последней реплики с документами.
+    Возвращает обновленный список файлов или None, если кэш не создавался.
+    """
+    if not GEMINI_CACHE_MIN_TOKENS or prompt_tokens < GEMINI_CACHE_MIN_TOKENS:
+        return None
+    prefix = _cached_prefix(turns)
+    if not prefix or find_context_cache(files, model, turns) or _cache_failures.get(model, 0) > time.time():
+        return None
+    names = set(turns[prefix - 1]["content"][:-1])
+    if not any(file.get("gemini_name") in names for file in files):
+        return None
+
+    contents = [await to_gemini_turn(turn) for turn in turns[:prefix]]
+    try:
+        with stage("gemini_cache_create", model):
+            cache = await run_blocking(lambda: gemini_sdk().caching.CachedContent.create(
+                model=model, system_instruction=SYSTEM_MESSAGE, contents=contents,
+                ttl=timedelta(seconds=GEMINI_CACHE_TTL)))
+    except Exception as e:
+        logging.warning(f"Gemini context cache for {model} not created: {e}")
+        _cache_failures[model] = time.time() + GEMINI_CACHE_RETRY
+        return None
+    logging.info(f"Cached {prefix} turns ({prompt_tokens} tokens) as {cache.name}")
+
+    record = {"name": cache.name, "key": _prefix_key(model, turns[:prefix]),
+              "expires_at": cache.expire_time.timestamp() if cache.expire_time else time.time() + GEMINI_CACHE_TTL}
+    return [dict(file, context_cache=record) if file.get("gemini_name") in names else file for file in files]
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from redis.exceptions import WatchError
+
+from files import run_blocking, list_gemini_files, delete_from_gemini, gemini_expiration, staging_root, bot_api_dir
+from metrics import stage, JANITOR_RECLAIMED, JANITOR_RECLAIMED_BYTES
+from states import redis, pack, unpack, get_indexed_file, GEMINI_FILE_TTL_MARGIN
+
+# Раз в JANITOR_INTERVAL секунд удаляются ненужные файлы Gemini, устаревшие записи о файлах
+# в состоянии пользователей и брошенные локальные файлы; 0 - не запускать
+JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', 3600))
+# Удаление ограничено по скорости, чтобы не отнимать квоту API и Redis у пользователей
+JANITOR_DELETES_PER_SECOND = float(os.getenv('JANITOR_DELETES_PER_SECOND', 2))
+JANITOR_MAX_DELETES = int(os.getenv('JANITOR_MAX_DELETES', 500))
+JANITOR_SCAN_BATCH = int(os.getenv('JANITOR_SCAN_BATCH', 200))
+JANITOR_SCAN_PAUSE = float(os.getenv('JANITOR_SCAN_PAUSE', 0.05))
+# Более новые файлы не трогаем: они могут принадлежать запросу, который еще обрабатывается
+JANITOR_MIN_AGE = float(os.getenv('JANITOR_MIN_AGE', 3600))
+JANITOR_LOCK = "janitor:lock"
+# Папки локального Bot API, из которых бот забирает скачанные файлы
+BOT_API_FOLDERS = ("documents", "photos")
+
+_janitor_task = None
+
+
+async def _scan(pattern):
+    # SCAN пачками с паузой, а не KEYS: Redis не блокируется на время обхода
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match=pattern, count=JANITOR_SCAN_BATCH)
+        if keys:
+            yield keys
+        if not cursor:
+            return
+        await asyncio.sleep(JANITOR_SCAN_PAUSE)
+
+
+def _needs_pruning(files, live, now):
+    for file in files:
+        deleted = file.get("gemini_name") and file["gemini_name"] not in live
+        cache_expired = file.get("context_cache") and file["context_cache"]["expires_at"] <= now
+        if deleted or cache_expired:
+            return True
+    return False
+
+
+async def _missing_files(files, live):
+    # Файл мог быть загружен после получения списка: такие уже есть в индексе
+    missing = set()
+    for file in files:
+        name = file.get("gemini_name")
+        if name and name not in live:
+            indexed = await get_indexed_file(file.get("sha256", ""))
+            if not indexed or indexed["gemini_name"] != name:
+                missing.add(name)
+    return missing
+
+
+def _fresh_files(files, missing, now):
+    """Записи о файлах без удаленных из Gemini файлов и без истекших кэшей контекста."""
+    result = []
+    for file in files:
+        if file.get("gemini_name") in missing:
+            continue
+        cache = file.get("context_cache")
+        if cache and cache["expires_at"] <= now:
+            file = {key: value for key, value in file.items() if key != "context_cache"}
+        result.append(file)
+    return result
+
+
+async def _prune_state(key, live, now):
+    """Переписывает поле files состояния без устаревших записей. Возвращает число удаленных записей."""
+    async with redis.pipeline(transaction=True) as pipe:
+        # Ход пользователя может записать файлы одновременно с нами: тогда запись отменяется
+        await pipe.watch(key)
+        data = await pipe.hget(key, "files")
+        if not data:
+            return 0
+        files = unpack(data)
+        fresh = _fresh_files(files, await _missing_files(files, live), now)
+        if fresh == files:
+            return 0
+        pipe.multi()
+        pipe.hset(key, "files", pack(fresh))
+        try:
+            await pipe.execute()
+        except WatchError:
+            return 0
+    return len(files) - len(fresh)
+
+
+async def collect_references(live, now):
+    """Имена файлов Gemini, на которые ссылаются индекс и состояния пользователей.
+
+    Попутно удаляет из состояний записи о файлах, которых больше нет в Gemini.
+    """
+    referenced = set()
+    async for keys in _scan("file_index:*"):
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hget(key, "gemini_name")
+            names = await pipe.execute()
+        referenced.update(name.decode() for name in names if name)
+
+    pruned = 0
+    async for keys in _scan("*_state"):
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hget(key, "files")
+            values = await pipe.execute()
+        for key, data in zip(keys, values):
+            if not data:
+                continue
+            files = unpack(data)
+            referenced.update(file["gemini_name"] for file in files if file.get("gemini_name"))
+            if _needs_pruning(files, live, now):
+                pruned += await _prune_state(key, live, now)
+    if pruned:
+        JANITOR_RECLAIMED.labels("file_records").inc(pruned)
+    return referenced, pruned
+
+
+def _expired(file, now):
+    expires_at = gemini_expiration(file)
+    return expires_at is not None and expires_at - GEMINI_FILE_TTL_MARGIN <= now
+
+
+def _age(file, now):
+    create_time = getattr(file, "create_time", None)
+    return now - create_time.timestamp() if create_time else 0
+
+
+def _orphaned(file, referenced, now):
+    return file.name not in referenced and _age(file, now) >= JANITOR_MIN_AGE
+
+
+async def clean_gemini_files(now=None):
+    """Удаляет файлы Gemini: сломанные, истекающие и те, на которые никто не ссылается."""
+    now = now or time.time()
+    files = await list_gemini_files()
+    live = {file.name for file in files if file.state.name != "FAILED" and not _expired(file, now)}
+    referenced, pruned = await collect_references(live, now)
+
+    garbage = [file for file in files if file.name not in live or _orphaned(file, referenced, now)]
+    deleted = 0
+    for file in garbage[:JANITOR_MAX_DELETES]:
+        try:
+            await delete_from_gemini(file.name)
+        except Exception as e:
+            logging.warning(f"Janitor cannot delete Gemini file {file.name}: {e}")
+            continue
+        deleted += 1
+        JANITOR_RECLAIMED.labels("gemini_files").inc()
+        JANITOR_RECLAIMED_BYTES.labels("gemini_files").inc(getattr(file, "size_bytes", 0) or 0)
+        await asyncio.sleep(1 / JANITOR_DELETES_PER_SECOND)
+    return {"gemini_files": deleted, "file_records": pruned, "gemini_total": len(files)}
+
+
+def _tree_size(path):
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def _stale_stat(entry, now):
+    # Другая реплика на том же томе могла удалить запись между scandir и stat
+    try:
+        stat = entry.stat()
+    except OSError:
+        return None
+    return stat if now - stat.st_mtime >= JANITOR_MIN_AGE else None
+
+
+def _sweep_local(now):
+    removed = {"staging_dirs": 0, "bot_api_files": 0}
+    freed = {"staging_dirs": 0, "bot_api_files": 0}
+    # Папки запросов удаляются в finally, но остаются, если процесс был остановлен посреди запроса
+    if os.path.isdir(staging_root()):
+        for entry in os.scandir(staging_root()):
+            if not entry.is_dir() or _stale_stat(entry, now) is None:
+                continue
+            size = _tree_size(entry.path)
+            try:
+                shutil.rmtree(entry.path)
+            except OSError:
+                continue
+            freed["staging_dirs"] += size
+            removed["staging_dirs"] += 1
+    # Скачанные, но не перенесенные в папку запроса файлы: ошибка до переноса
+    for folder in BOT_API_FOLDERS:
+        path = os.path.join(bot_api_dir(), folder)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            stat = _stale_stat(entry, now) if entry.is_file() else None
+            if stat is None:
+                continue
+            size = stat.st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            freed["bot_api_files"] += size
+            removed["bot_api_files"] += 1
+    return removed, freed
+
+
+async def sweep_local_files(now=None):
+    """Удаляет брошенные папки запросов и файлы локального Bot API старше JANITOR_MIN_AGE."""
+    removed, freed = await run_blocking(_sweep_local, now or time.time())
+    for kind, count in removed.items():
+        if count:
+            JANITOR_RECLAIMED.labels(kind).inc(count)
+            JANITOR_RECLAIMED_BYTES.labels(kind).inc(freed[kind])
+    return removed
+
+
+async def run_janitor():
+    # Реплики делят один том (PVC bot-data), Gemini и Redis: все это чистит одна реплика за интервал
+    stats = {}
+    with stage("janitor"):
+        if await redis.set(JANITOR_LOCK, 1, nx=True, ex=max(1, int(JANITOR_INTERVAL))):
+            stats.update(await sweep_local_files())
+            stats.update(await clean_gemini_files())
+    logging.info(f"Janitor: {stats}")
+    return stats
+
+
+async def janitor(interval=JANITOR_INTERVAL):
+    while True:
+        try:
+            await run_janitor()
+        except Exception as e:
+            logging.warning(f"Janitor run failed: {e}")
+        await asyncio.sleep(interval)
+
+
+async def start_janitor():
+    global _janitor_task
+    if JANITOR_INTERVAL and (_janitor_task is None or _janitor_task.done()):
+        _janitor_task = asyncio.create_task(janitor())
+
+
+async def stop_janitor():
+    if _janitor_task is not None:
+        _janitor_task.cancel()
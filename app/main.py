@@ -1,35 +1,50 @@
 import asyncio
 import logging
+import math
 import os
-import re
-import shutil
+import time
+from contextlib import asynccontextmanager
 
 from aiogram import Bot, types, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.redis import RedisStorage
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile
-from dotenv import load_dotenv
-
-from clients import get_client_for_model
-from files import convert_to_pdf, upload_to_gemini, wait_for_files_active, get_from_gemini
-from files import list_gemini_files
-from states import redis, save_user_context, get_user_model, get_user_context
-from states import save_user_files, get_user_files
-
-load_dotenv()
-
-logging.basicConfig(level=logging.DEBUG)
-
-SYSTEM_MESSAGE = ('''
-    Ты ассистент, которого зовут StudentLLMAbot. Твоя основная задача - помогать студентам с учебой.
-    Думай, перед тем, как отвечать. Отвечай всегда на русском языке, если тебя не попросили специально помочь с предметом на английском.
-''')
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
+
+# Первым: загружает .env до настроек остальных модулей
+from config import config, SYSTEM_MESSAGE
+from albums import collect_media_group
+from cache import RESPONSE_CACHE, response_cache_key, get_cached_response, cache_response
+from cache import response_cache_stats, purge_response_cache
+from clients import get_client_for_model, close_clients, start_reachability_monitor, provider_for_model
+from clients import preload_sdks, get_cached_gemini_client
+from conversion import convert_to_pdf, start_converters, close_converters
+from extraction import extract_text, is_extracted_text, document_prompt, text_allowance, reserve_text
+from extraction import start_extraction_pool, close_extraction_pool
+from files import upload_to_gemini, wait_for_files_active, get_from_gemini
+from files import file_sha256, gemini_expiration, current_rss_mb, log_rss
+from files import inline_image_allowed, prepare_inline_image
+from files import create_staging_dir, remove_staging_dir, stage_telegram_file
+from formatting import format_message, split_message
+from history import get_gemini_history, find_context_cache, cache_context
+from janitor import start_janitor, stop_janitor
+from metrics import configure_logging, stage, start_metrics_server, METRICS_PORT, SEND_ATTEMPTS, LLM_REQUESTS
+from states import redis, get_user_model, get_user_context, clear_user_context, set_user_model
+from states import load_user_state, save_user_state, get_indexed_file, index_file
+from router import router, ProvidersUnavailable, ROUTER_HEDGE_MAX_CHARS
+from scheduler import scheduler, user_turn, UserBusy, SchedulerOverloaded
+from streaming import StreamingReply, STREAM_RESPONSES
+from usage import check_rate_limit, rate_limit_wait, record_usage, extract_usage
+from usage import get_user_usage, get_usage_summary, format_usage, USER_TOKEN_BUCKET
+from webhook import WEBHOOK_URL, run_webhook, update_guard
+
+configure_logging()
 
 
 class TestState(StatesGroup):
@@ -37,43 +52,26 @@ class TestState(StatesGroup):
 
 
 api_server = TelegramAPIServer.from_base(
-    os.getenv("API_SERVER_URL"), is_local=True)
+    config.api_server_url, is_local=True)
 
-bot = Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'),
+bot = Bot(token=config.telegram_bot_token,
           session=AiohttpSession(api=api_server),
           default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
 dp = Dispatcher(storage=RedisStorage(redis))
 
-MAX_MESSAGE_LENGTH = 4000
-MODEL_CHOICES = os.getenv('MODEL_CHOICES').split(',')
-DEFAULT_MODEL = MODEL_CHOICES[0]
-
-
-async def set_user_model(user_id, model):
-    await redis.set(f"{user_id}_model", model)
-    # При смене модели создаем новый контекст с system message
-    initial_context = [{"role": "system", "content": SYSTEM_MESSAGE}]
-    await save_user_context(user_id, initial_context)
 
-
-async def replace_asterisk(text):
-    # Step 1: Find code blocks and temporarily replace '*' inside them with a placeholder
-    text_with_placeholder = re.sub(r'```.*?```', lambda m: m.group(0).replace('*', '<<ASTERISK>>'), text,
-                                   flags=re.DOTALL)
-
-    # Step 2: Replace only non-double '*' occurrences outside of code blocks
-    text_processed = re.sub(r'(?<!\*)\*(?!\*)', '\\*', text_with_placeholder)
-
-    # Step 3: Restore the placeholders back to '*'
-    result = text_processed.replace('<<ASTERISK>>', '*')
-
-    return result
+def gemini_chunk_text(chunk):
+    # Служебные чанки (например, с finish_reason) не содержат текста
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
 
 
 @dp.message(Command("start"))
 async def start(message: types.Message):
     user_id = str(message.from_user.id)
-    chosen_model = await get_user_model(user_id, default_model=DEFAULT_MODEL)
+    chosen_model = await get_user_model(user_id, default_model=config.default_model)
     text = (f"Привет, {message.from_user.first_name}! Я Student LLMAbot. Твой Telegram ID: {user_id}\n"
             f"Текущая модель: {chosen_model}\nНапиши мне запрос, и я постараюсь помочь!")
     await message.answer(text)
@@ -83,26 +81,16 @@ async def start(message: types.Message):
 async def test_state(message: types.Message, state: FSMContext) -> None:
     await state.clear()
     dl = await bot.get_file(message.document.file_id)
-    print(dl)
-    print(message.document)
-    local_path = f"\\\\wsl.localhost\\docker-desktop-data\\data\\docker\\volumes\\telegram-bot-api-data\\_data\\{os.getenv(
-        "TELEGRAM_BOT_TOKEN")}\\documents\\" if os.name == "nt" else f"/var/lib/telegram-bot-api/{os.getenv("TELEGRAM_BOT_TOKEN")}/documents/"
-
-    src_name = os.path.basename(dl.file_path)
-    dest_folder = f"{local_path}{message.from_user.id}"
-    try:
-        os.mkdir(dest_folder)
-    except FileExistsError:
-        print("Don't need to create folder")
-    shutil.move(local_path + src_name,
-                os.path.join(dest_folder, message.document.file_name))
+    logging.debug(f"{dl!r} {message.document!r}")
+    staging_dir = await create_staging_dir(message.from_user.id)
+    logging.info(f"Staged {stage_telegram_file(dl.file_path, staging_dir, message.document.file_name)}")
 
 
 @dp.message(Command("test"))
 async def test(message: types.Message, state: FSMContext):
     await state.set_state(TestState.test)
     await message.answer(await state.get_state())
-    print(message)
+    logging.debug(repr(message))
 
 
 @dp.message(Command("reset"))
@@ -110,7 +98,7 @@ async def reset(message: types.Message, state: FSMContext):
     text = 'Контекст нашей беседы очищен!'
     try:
         await bot.send_chat_action(message.chat.id, 'typing')
-        await redis.delete(message.from_user.id)
+        await clear_user_context(message.from_user.id)
         await state.clear()
         await message.answer(text)
     except Exception as e:
@@ -121,7 +109,7 @@ async def reset(message: types.Message, state: FSMContext):
 async def choose_model(message: types.Message):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text=model, callback_data=f"set_model:{model}")] for model in
-                         MODEL_CHOICES]
+                         config.model_choices]
     )
     await message.answer("Выбери модель:", reply_markup=keyboard)
 
@@ -135,276 +123,459 @@ async def set_model_callback(query: types.CallbackQuery):
     await query.message.edit_text(f"Текущая модель установлена на '{chosen_model}'.")
 
 
-@dp.message(F.text | F.document | F.photo)
-async def chat_handler(message: types.Message):
-    global lang
+@dp.message(Command("purge_cache"))
+async def purge_cache(message: types.Message):
+    if str(message.from_user.id) not in config.admin_ids:
+        return
+    stats = await response_cache_stats()
+    deleted = await purge_response_cache()
+    await message.answer(f"Кэш ответов очищен, удалено записей: {deleted}\n"
+                         f"Попаданий: {stats.get('hits', 0)}, промахов: {stats.get('misses', 0)}, "
+                         f"доля попаданий: {stats['hit_rate']:.0%}, вытеснено: {stats.get('evictions', 0)}",
+                         parse_mode=None)
+
+
+@dp.message(Command("usage"))
+async def usage(message: types.Message):
     user_id = str(message.from_user.id)
-    context = await get_user_context(user_id, system_message=SYSTEM_MESSAGE)
-    chosen_model = await get_user_model(user_id, default_model=DEFAULT_MODEL)
-    client = await get_client_for_model(chosen_model)
-    uploaded_file = ""
-    status = ""
-    gemini_response = ""
-    gemini_message = ""
-    folder_type = "photos" if message.photo else "documents"
-    local_path = f"\\\\wsl.localhost\\docker-desktop-data\\data\\docker\\volumes\\telegram-bot-api-data\\_data\\{os.getenv(
-        "TELEGRAM_BOT_TOKEN")}\\{folder_type}\\" if os.name == "nt" else f"/var/lib/telegram-bot-api/{os.getenv("TELEGRAM_BOT_TOKEN")}/{folder_type}/"
-
-    # Если есть документ, сначала обрабатываем его через Gemini
-    if message.document or message.photo:
-        await bot.send_chat_action(message.chat.id, 'upload_document')
+    today, month = await get_user_usage(user_id), await get_user_usage(user_id, days=30)
+    text = f"Сегодня:\n{format_usage(today)}\n\nЗа 30 дней:\n{format_usage(month)}"
+    if USER_TOKEN_BUCKET:
+        tokens = await check_rate_limit(user_id)
+        text += f"\n\nДоступно токенов сейчас: {max(0, int(tokens))} из {USER_TOKEN_BUCKET}"
+    await message.answer(text, parse_mode=None)
+
+
+@dp.message(Command("usage_summary"))
+async def usage_summary(message: types.Message):
+    if str(message.from_user.id) not in config.admin_ids:
+        return
+    # /usage_summary 7 - за неделю, по умолчанию за сегодня
+    days = message.text.split()[1:2]
+    days = int(days[0]) if days and days[0].isdigit() else 1
+    models, top_users = await get_usage_summary(days=days)
+    users = "\n".join(f"{user_id}: {tokens}" for user_id, tokens in top_users) or "нет"
+    await message.answer(f"Дней: {days}\n{format_usage(models)}\n\nБольше всего токенов:\n{users}",
+                         parse_mode=None)
+
+
+@asynccontextmanager
+async def llm_slot(message, model):
+    notices = []
+
+    async def on_queued(position):
+        notices.append(await message.answer(f"Сейчас много запросов, ты в очереди: {position}. "
+                                            f"Ответ придет автоматически."))
+
+    async with scheduler.slot(provider_for_model(model), on_queued=on_queued):
+        for notice in notices:
+            await notice.delete()
+        yield
+
+
+async def ingest_file(message, file, allowance=None):
+    """Скачивает, при необходимости конвертирует и загружает файл в Gemini.
+
+    Возвращает загруженный файл (для небольших фото - {"mime_type", "data"}, для текстовых документов -
+    извлеченный текст, или None при ошибке) и статусное сообщение. allowance - место под текст
+    документов хода из text_allowance; документ, текст которого не помещается, загружается в Gemini.
+    """
+    rss_before = current_rss_mb()
+    status = None
+    uploaded_file = None
 
-        if message.document:
-            file = {
-                "path": local_path + user_id,
-                "name": message.document.file_name,
-                "id": message.document.file_id,
-                "mimetype": message.document.mime_type,
-                "size": message.document.file_size
-            }
-        elif message.photo:
-            print(message)
-            file = {
-                "path": local_path + user_id,
-                "name": message.photo[-1].file_id + ".jpg",
-                "id": message.photo[-1].file_id,
-                "mimetype": "image/jpeg",
-                "size": message.photo[-1].file_size
-            }
-
-        processed_files = await get_user_files(user_id)
-
-        gemini_saved_documents = await list_gemini_files()
-
-        print("Processed files", processed_files)
-        if processed_files:
-            for pf in processed_files:
-                if pf["name"] == file["name"] and pf["size"] == file['size'] and pf["mimetype"] == file["mimetype"]:
-                    print("File already processed")
-                    file['pdf_name'] = pf.get("pdf_name", "")
-        if gemini_saved_documents:
-            for gsd in gemini_saved_documents:
-                if gsd.display_name == file.get('pdf_name', ''):
-                    print("File already uploaded")
-                    file['gemini_name'] = gsd.name
-
-        if not file.get('gemini_name', '') and not file.get('pdf_name', ''):
-            print("Downloading file from telegram...")
-            try:
-                dl = await bot.get_file(file["id"])
-                print(dl)
-                src_name = os.path.basename(dl.file_path)
+    try:
+        with stage("telegram_download"):
+            dl = await bot.get_file(file["id"])
+            staged_path = stage_telegram_file(dl.file_path, file["path"], file["name"])
+        file["sha256"] = await file_sha256(staged_path)
+    except Exception as e:
+        await message.answer(str(e))
+        return None, status
 
-                try:
-                    os.mkdir(file["path"])
-                except FileExistsError:
-                    print("Don't need to create folder")
+    status = await message.answer("Файл получен!")
+    await bot.send_chat_action(message.chat.id, 'upload_document')
 
-                shutil.move(local_path + src_name,
-                            os.path.join(file["path"], file["name"]))
-            except Exception as e:
-                await message.answer(str(e))
+    # Небольшие фото передаются в запросе байтами: без загрузки в Files API и ожидания обработки
+    if message.photo and inline_image_allowed(file):
+        try:
+            image = await prepare_inline_image(staged_path)
+            log_rss(file["name"], file["size"], rss_before)
+            return image, status
+        except Exception as e:
+            logging.warning(f"Cannot inline {file['name']}, uploading to Gemini: {e}")
 
-        status = await message.answer("Файл получен!")
+    # Текст документа читается локально: без конвертации и Files API, ответить может и модель Groq
+    if message.document:
+        extracted = await extract_text(staged_path, file)
+        if is_extracted_text(extracted) and allowance and not reserve_text(allowance, file["name"], extracted):
+            logging.info(f"Text of {file['name']} does not fit the context budget, uploading to Gemini")
+        elif is_extracted_text(extracted):
+            log_rss(file["name"], file["size"], rss_before)
+            return extracted, status
+
+    indexed_file = await get_indexed_file(file["sha256"])
+    if indexed_file:
+        logging.info(f"File {file['sha256']} already uploaded as {indexed_file['gemini_name']}")
+        file["pdf_name"] = indexed_file["pdf_name"]
+        file["gemini_name"] = indexed_file["gemini_name"]
+
+    if "pdf" not in file.get("mimetype", "") and "image" not in file.get("mimetype", "") and not file.get(
+            "pdf_name", "") and not file.get("gemini_name", ""):
+        await bot.edit_message_text("Конвертирую файл в pdf...", message_id=status.message_id,
+                                    chat_id=message.chat.id)
         await bot.send_chat_action(message.chat.id, 'upload_document')
-
-        if "pdf" not in file.get("mimetype", "") and "image" not in file.get("mimetype", "") and not file.get(
-                "pdf_name", "") and not file.get("gemini_name", ""):
-            await bot.edit_message_text("Конвертирую файл в pdf...", message_id=status.message_id,
+        try:
+            converted_pdf = await convert_to_pdf(file=file)
+            pdf_scr = os.path.join(file["path"], converted_pdf)
+            pdf_dest = os.path.join(
+                file["path"], os.path.basename(file["name"]).split(".")[0] + ".pdf")
+            pdf_name = os.path.basename(pdf_dest)
+            os.replace(pdf_scr, pdf_dest)
+            # Telegram читает файл с диска потоком, PDF целиком в память не загружается
+            await message.answer_document(FSInputFile(pdf_dest, filename=pdf_name),
+                                          caption="Вот документ в PDF для повторного использования, если необходимо. Я понимаю только PDF! Ответ подготавливается...")
+            await bot.edit_message_text("Файл успешно сконвертирован в pdf!", message_id=status.message_id,
                                         chat_id=message.chat.id)
-            await bot.send_chat_action(message.chat.id, 'upload_document')
-            try:
-                converted_pdf = await convert_to_pdf(file=file)
-                pdf_scr = os.path.join(file["path"], converted_pdf)
-                pdf_dest = os.path.join(
-                    file["path"], file["name"].split(".")[0] + ".pdf")
-                pdf_name = os.path.basename(pdf_dest)
-                shutil.move(pdf_scr, pdf_dest)
-                with open(pdf_dest, 'rb') as f:
-                    pdf_file = BufferedInputFile(f.read(), filename=pdf_name)
-                    await message.answer_document(pdf_file,
-                                                  caption="Вот документ в PDF для повторного использования, если необходимо. Я понимаю только PDF! Ответ подготавливается...")
-                await bot.edit_message_text("Файл успешно сконвертирован в pdf!", message_id=status.message_id,
-                                            chat_id=message.chat.id)
-            except Exception as e:
-                await message.answer(str(e))
-                return
-
-            file["pdf_name"] = pdf_name
+        except Exception as e:
+            await message.answer(str(e))
+            return None, status
 
-        else:
-            file["pdf_name"] = file["name"]
-            await save_user_files(user_id, [file])
+        file["pdf_name"] = pdf_name
 
-        if not file.get('gemini_name', ''):
-            await bot.edit_message_text("Загрузка файла в Gemini...", message_id=status.message_id,
-                                        chat_id=message.chat.id)
-            await bot.send_chat_action(message.chat.id, 'upload_document')
-            try:
-                uploaded_file = await upload_to_gemini(path=os.path.join(file["path"], file['pdf_name']),
-                                                       mime_type='application/pdf' if ".pdf" in file["pdf_name"] else
-                                                       file["mimetype"])
-            except Exception as e:
-                await message.answer(str(e))
+    elif not file.get("pdf_name", ""):
+        file["pdf_name"] = os.path.basename(file["name"])
 
-            try:
-                await bot.edit_message_text("Обработка файла в Gemini...", message_id=status.message_id,
-                                            chat_id=status.chat.id)
-                await bot.send_chat_action(message.chat.id, 'typing')
-            except Exception as e:
-                await message.answer(str(e))
+    if not file.get('gemini_name', ''):
+        await bot.edit_message_text("Загрузка файла в Gemini...", message_id=status.message_id,
+                                    chat_id=message.chat.id)
+        await bot.send_chat_action(message.chat.id, 'upload_document')
+        try:
+            uploaded_file = await upload_to_gemini(path=os.path.join(file["path"], file['pdf_name']),
+                                                   mime_type='application/pdf' if ".pdf" in file["pdf_name"] else
+                                                   file["mimetype"])
+        except Exception as e:
+            await message.answer(str(e))
+            return None, status
 
-            try:
-                await wait_for_files_active([uploaded_file])
-                file['gemini_name'] = uploaded_file.name
-            except Exception as e:
-                await message.answer(str(e))
+        try:
+            await bot.edit_message_text("Обработка файла в Gemini...", message_id=status.message_id,
+                                        chat_id=status.chat.id)
+            await bot.send_chat_action(message.chat.id, 'typing')
+        except Exception as e:
+            await message.answer(str(e))
+
+        try:
+            await wait_for_files_active([uploaded_file])
+            file['gemini_name'] = uploaded_file.name
+            await index_file(file["sha256"], file["pdf_name"], uploaded_file.name,
+                             expires_at=gemini_expiration(uploaded_file))
+        except Exception as e:
+            await message.answer(str(e))
+            return None, status
+
+    else:
+        uploaded_file = await get_from_gemini(file['gemini_name'])
+
+    log_rss(file["name"], file["size"], rss_before)
+    return uploaded_file, status
 
-        else:
-            uploaded_file = await get_from_gemini(file['gemini_name'])
 
-        processed_files.append(file)
-        await save_user_files(user_id, processed_files)
+@dp.message(F.text | F.document | F.photo)
+async def chat_handler(message: types.Message):
+    messages = [message]
+    if message.media_group_id:
+        # Альбом отвечается одним ходом, его обрабатывает реплика, получившая первую часть
+        messages = await collect_media_group(message)
+        if not messages:
+            return
+    try:
+        async with user_turn(message.from_user.id):
+            await handle_chat(messages[0], messages)
+    except UserBusy:
+        await message.answer("Предыдущий запрос еще обрабатывается, подожди немного и повтори.")
+    except SchedulerOverloaded:
+        await message.answer("Сейчас слишком много запросов, попробуй через пару минут.")
+
+
+def telegram_file(message):
+    if message.document:
+        return {
+            "name": message.document.file_name,
+            "id": message.document.file_id,
+            "mimetype": message.document.mime_type,
+            "size": message.document.file_size
+        }
+    return {
+        "name": message.photo[-1].file_id + ".jpg",
+        "id": message.photo[-1].file_id,
+        "mimetype": "image/jpeg",
+        "size": message.photo[-1].file_size
+    }
+
+
+async def ingest_staged(message, file, user_id, allowance=None):
+    file["path"] = await create_staging_dir(user_id)
+    try:
+        return await ingest_file(message, file, allowance)
+    finally:
+        await remove_staging_dir(file["path"])
+
+
+async def handle_chat(message: types.Message, messages=None):
+    messages = messages or [message]
+    user_id = str(message.from_user.id)
+    # Лимит проверяется до скачивания файлов: отказ стоит одного обращения к Redis
+    tokens = await check_rate_limit(user_id) if user_id not in config.admin_ids else None
+    if tokens is not None and tokens <= 0:
+        await message.answer(f"Слишком много запросов подряд, попробуй через {math.ceil(rate_limit_wait(tokens) / 60)} мин.")
+        return
+    # Модель, файлы и история читаются одним запросом и записываются одной транзакцией в конце хода
+    with stage("context_load"):
+        state = await load_user_state(user_id)
+    chosen_model = await get_user_model(user_id, default_model=config.default_model, state=state)
+    context = await get_user_context(user_id, system_message=SYSTEM_MESSAGE, model=chosen_model, state=state)
+    saved_turns = len(context)
+    processed_files = None
+    attachments = [m for m in messages if m.document or m.photo]
+    # (сообщение, файл, загруженный файл) для каждого успешно обработанного вложения
+    ingested = []
+    status = ""
+    file_hash = ""
+    # (имя, извлеченный текст) документов, которые не нужно отправлять в Gemini
+    documents_text = []
+
+    # Если есть вложения, сначала скачиваем и обрабатываем их
+    if attachments:
+        await bot.send_chat_action(message.chat.id, 'upload_document')
 
-        if "gemini" not in chosen_model:
-            chosen_model = MODEL_CHOICES[4]
-        await set_user_model(user_id, chosen_model)
-        client = await get_client_for_model(chosen_model)
+        # Части альбома скачиваются, конвертируются и загружаются параллельно
+        files = [telegram_file(m) for m in attachments]
+        # Текст всех документов альбома делит одно место в истории модели
+        allowance = text_allowance(chosen_model)
+        results = await asyncio.gather(*(ingest_staged(m, file, user_id, allowance)
+                                         for m, file in zip(attachments, files)))
+        statuses = [file_status for _, file_status in results if file_status]
+        ingested = [(m, file, uploaded) for m, file, (uploaded, _) in zip(attachments, files, results) if uploaded]
+        # Дальше ход ведется в одном статусном сообщении
+        for extra in statuses[1:]:
+            await bot.delete_message(chat_id=extra.chat.id, message_id=extra.message_id)
+        if not ingested:
+            return
+        status = statuses[0]
+
+        file_hash = ",".join(file["sha256"] for _, file, _ in ingested)
+        # Прочитанные документы идут в сообщение текстом, Gemini нужен только остальным вложениям
+        documents_text = [(file["name"], uploaded) for _, file, uploaded in ingested if is_extracted_text(uploaded)]
+        ingested = [item for item in ingested if not is_extracted_text(item[2])]
+        stored_files = [file for _, file, _ in ingested if file.get("gemini_name")]
+        if stored_files:
+            hashes = {file["sha256"] for file in stored_files}
+            processed_files = [pf for pf in state["files"] if pf.get("sha256") not in hashes] + stored_files
+
+        if ingested and "gemini" not in chosen_model:
+            chosen_model = config.model_choices[4]
     else:
         # If msg is not document
         context.append({"role": "user", "content": message.text})
 
-    # Продолжаем обработку с выбранной моделью
-    # Gemini model
-    if "gemini" in chosen_model:
-        gemini_history = []
-        for msg in context[1:]:
-            if msg["role"] == "assistant":
-                gemini_history.append({
-                    "role": "model",
-                    "parts": [{"text": msg["content"]}]
-                })
-            elif msg["role"] == "user":
-                if type(msg["content"]) is list:
-                    old_uploaded_file = await get_from_gemini(msg["content"][0])
-                    gemini_history.append({
-                        "role": "user",
-                        "parts": [old_uploaded_file, msg["content"][1]]
-                    })
-                else:
-                    gemini_history.append({
-                        "role": "user",
-                        "parts": [{"text": msg["content"]}]
-                    })
-
-        chat_session = client.start_chat(history=gemini_history)
-
-        if message.document or message.photo:
-            await bot.edit_message_text("Gemini подготавливает ответ, может занять долгое время....",
-                                        message_id=status.message_id,
-                                        chat_id=message.chat.id)
-            await bot.send_chat_action(message.chat.id, 'typing')
-            print("Sending file:", uploaded_file)
-            gemini_message = [
-                uploaded_file, message.caption or "Выполни задания в этом документе"]
-            user_message = [uploaded_file.name,
-                            message.caption or "Выполни задания в этом документе"]
-
-            if file["path"]:
-                try:
-                    shutil.rmtree(file["path"])
-                except FileNotFoundError as e:
-                    print(str(e))
-                    print("Nothing to delete")
-        else:
-            await bot.send_chat_action(message.chat.id, 'typing')
-            user_message = message.text
-            gemini_message = message.text
+    if attachments:
+        # Подпись альбома Telegram хранит в одной из его частей
+        caption = next((m.caption for m in messages if m.caption), None) or "Выполни задания в этом документе"
+        if documents_text:
+            caption = document_prompt(caption, documents_text)
 
-        error_msg = ""
-        counter = 1
-        while not gemini_response and counter <= 5:
+    # Продолжаем обработку с выбранной моделью
+    if ingested:
+        await bot.edit_message_text("Gemini подготавливает ответ, может занять долгое время....",
+                                    message_id=status.message_id,
+                                    chat_id=message.chat.id)
+        names = [file.get("gemini_name", file["name"]) for _, file, _ in ingested]
+        logging.info(f"Sending files {names} to {chosen_model}")
+        # Один запрос с несколькими частями вместо запроса на каждый файл
+        gemini_message = [uploaded for _, _, uploaded in ingested] + [caption]
+        user_message = names + [caption]
+    elif attachments:
+        # Только текстовые документы: это обычная реплика пользователя для выбранной модели
+        await bot.edit_message_text("Документ прочитан, ответ подготавливается...",
+                                    message_id=status.message_id, chat_id=message.chat.id)
+        logging.info(f"Sending text of {[name for name, _ in documents_text]} to {chosen_model}")
+        context.append({"role": "user", "content": caption})
+        user_message = gemini_message = caption
+    else:
+        user_message = message.text
+        gemini_message = message.text
+    await bot.send_chat_action(message.chat.id, 'typing')
+
+    # Файлы в контексте понимает только Gemini
+    providers = {"gemini"} if ingested or any(isinstance(turn["content"], list) for turn in context) else None
+    # Дублирующие запросы нельзя показывать потоком в одном сообщении
+    hedge = router.hedge_delay > 0 and not attachments and len(message.text or "") <= ROUTER_HEDGE_MAX_CHARS
+    reply = StreamingReply(message, chosen_model) if STREAM_RESPONSES and not hedge else None
+    error_msg = None
+    usage_by_model = {}
+
+    async def ask(model):
+        with stage("client_init", model):
+            client = await get_client_for_model(model)
+        async with llm_slot(message, model):
+            started = time.perf_counter()
             try:
-                gemini_response = await chat_session.send_message_async(gemini_message)
-            except Exception as e:
-                if error_msg:
-                    logging.log(level=logging.WARN, msg=str(e))
-                    error_msg = await bot.edit_message_text(error_msg.text + ".",
-                                                            message_id=error_msg.message_id,
-                                                            chat_id=error_msg.chat.id)
-                else:
-                    error_msg = await message.answer(str(e))
-
-                logging.log(level=logging.INFO, msg="Sleeping...")
-                await asyncio.sleep(5)
-                counter += 1
+                with stage("llm_total", model):
+                    response_content, tokens = await call_model(model, client)
+            except Exception:
+                LLM_REQUESTS.labels(model, "error").inc()
+                raise
+            LLM_REQUESTS.labels(model, "ok").inc()
+        usage_by_model[model] = tokens
         try:
-            response_content = gemini_response.text
-        except Exception:
-            text = "Не получен ответ от Gemini, попробуй позже...\n Или выбери другую модель Gemini (/model)"
-            await bot.edit_message_text(text, message_id=status.message_id, chat_id=status.chat.id)
-            await bot.delete_message(message_id=error_msg.message_id, chat_id=error_msg.chat.id) if error_msg else None
-            logging.log(level=logging.ERROR, msg=text)
-            return
+            await record_usage(user_id, model, *(tokens or (0, 0)), time.perf_counter() - started)
+        except Exception as e:
+            # Учет не должен стоить пользователю ответа, уже полученного от модели
+            logging.warning(f"Usage not recorded for {user_id}: {e}")
+        return response_content
+
+    async def call_model(model, client):
+        """Текст ответа и (prompt_tokens, completion_tokens), если провайдер их сообщил."""
+        if reply:
+            reply.reset(model)
+        if provider_for_model(model) == "gemini":
+            # Только сохраненные реплики: текущее сообщение отправляется отдельно
+            turns = context[1:saved_turns]
+            cached = find_context_cache(state["files"], model, turns)
+            if cached:
+                # Начало беседы с документами уже в кэше Gemini, отправляются только реплики после него
+                try:
+                    client = await get_cached_gemini_client(cached[0])
+                    turns = turns[cached[1]:]
+                except Exception as e:
+                    logging.warning(f"Gemini context cache {cached[0]} unavailable: {e}")
+            gemini_history = await get_gemini_history(user_id, turns)
+            # Новая сессия на каждую попытку: оборванный стрим не должен попасть в историю
+            chat_session = client.start_chat(history=gemini_history)
+            if reply:
+                stream = await chat_session.send_message_async(gemini_message, stream=True)
+                async for chunk in stream:
+                    await reply.feed(gemini_chunk_text(chunk))
+                return stream.text, extract_usage(stream)
+            response = await chat_session.send_message_async(gemini_message)
+            return response.text, extract_usage(response)
 
-    else:  # Groq
-        user_message = message.text
         response = await client.chat.completions.create(
-            model=chosen_model,
-            stream=False,
+            model=model,
+            stream=reply is not None,
             stop=None,
             max_tokens=8000,
             messages=context,
             temperature=0.95,
             top_p=0.65
         )
-        response_content = response.choices[0].message.content
-
-    if message.document:
-        context.append({"role": "user", "content": user_message})
-    context.append({"role": "assistant", "content": response_content})
+        if reply:
+            tokens = None
+            async for chunk in response:
+                await reply.feed(chunk.choices[0].delta.content if chunk.choices else None)
+                tokens = extract_usage(chunk) or tokens
+            return reply.text, tokens
+        return response.choices[0].message.content, extract_usage(response)
+
+    async def on_failure(model, error):
+        nonlocal error_msg
+        if error_msg:
+            error_msg = await bot.edit_message_text(error_msg.text + ".",
+                                                    message_id=error_msg.message_id,
+                                                    chat_id=error_msg.chat.id)
+        else:
+            error_msg = await message.answer(str(error))
 
-    from formatting import format_message
-    text = format_message(response_content)
+    # Первый ход беседы не зависит от истории, одинаковые вопросы можно отвечать из кэша
+    cache_key = None
+    response_content = None
+    answered_by = chosen_model
+    if RESPONSE_CACHE and saved_turns == 1:
+        cache_key = response_cache_key(chosen_model, user_message[-1] if ingested else user_message, file_hash)
+        response_content = await get_cached_response(cache_key)
 
-    chunks = [text[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
-    not_sent = False
+    if response_content is None:
+        try:
+            answered_by, response_content = await router.run(chosen_model, ask, config.model_choices,
+                                                             providers=providers, hedge=hedge, on_failure=on_failure)
+        except ProvidersUnavailable as e:
+            logging.error(str(e))
+            text = "Не получен ответ от модели, попробуй позже...\n Или выбери другую модель (/model)"
+            if status:
+                await bot.edit_message_text(text, message_id=status.message_id, chat_id=status.chat.id)
+            else:
+                await message.answer(text)
+            await bot.delete_message(message_id=error_msg.message_id, chat_id=error_msg.chat.id) if error_msg else None
+            return
+        if answered_by != chosen_model:
+            logging.info(f"Answered by {answered_by} instead of {chosen_model}")
+        if cache_key:
+            await cache_response(cache_key, response_content)
+
+    # В истории остаются документы: [имена файлов в Gemini..., подпись]; фото в нее не попадают
+    documents = [file["gemini_name"] for m, file, _ in ingested if m.document]
+    if documents:
+        context.append({"role": "user", "content": documents + [user_message[-1]]})
+    context.append({"role": "assistant", "content": response_content})
 
-    try:
-        await message.answer(text, parse_mode=ParseMode.MARKDOWN_V2)
-    except Exception as e:
-        print(str(e), type(e))
-        not_sent = True
+    with stage("formatting", answered_by):
+        chunks = split_message(format_message(response_content))
+    # Если ответ уже показан потоком, превью заменяется первой частью
+    if reply:
+        chunks = await reply.finish(chunks)
 
-    if not_sent:
-        for chunk in chunks:
+    for chunk in chunks:
+        with stage("send", answered_by):
             try:
                 await message.answer(chunk, parse_mode=ParseMode.MARKDOWN_V2)
-            except Exception as e:
-                print(str(e), type(e))
-                try:
-                    if chunk.split("```")[1].split("\n")[0] != '':
-                        lang = chunk.split("```")[1].split("\n")[0]
-                        chunk = chunk + "\n```"
-                        print(chunk)
-                    else:
-                        chunk = f"```{lang}\n" + chunk
-                        print(chunk)
-                    await message.answer(chunk, parse_mode=ParseMode.MARKDOWN_V2)
-                except Exception as e:
-                    print(str(e), type(e))
-                    await message.answer(chunk, parse_mode=None)
+                SEND_ATTEMPTS.labels("MarkdownV2", "ok").inc()
+            except TelegramBadRequest as e:
+                SEND_ATTEMPTS.labels("MarkdownV2", "rejected").inc()
+                logging.warning(f"MarkdownV2 rejected, sending as plain text: {e}")
+                await message.answer(chunk, parse_mode=None)
+                SEND_ATTEMPTS.labels("plain", "ok").inc()
+
+    # Большой запрос с документами: следующие ходы пойдут через кэш контекста Gemini
+    tokens = usage_by_model.get(answered_by)
+    if tokens and provider_for_model(answered_by) == "gemini":
+        cached_files = await cache_context(answered_by, context[1:], processed_files or state["files"], tokens[0])
+        if cached_files:
+            processed_files = cached_files
 
     # Сохраняем контекст только после успешной отправки
-    await save_user_context(user_id, context)
+    with stage("context_save", answered_by):
+        await save_user_state(user_id, state, turns=context[saved_turns:],
+                              model=chosen_model if chosen_model != state["model"] else None, files=processed_files)
 
 
 async def main():
-    await dp.start_polling(bot)
+    dp.update.outer_middleware(update_guard)
+    # Процессы пула извлечения текста создаются первыми, пока у бота нет фоновых задач
+    dp.startup.register(start_extraction_pool)
+    dp.startup.register(start_reachability_monitor)
+    dp.startup.register(start_converters)
+    dp.startup.register(preload_sdks)
+    dp.startup.register(start_janitor)
+    # Сначала дожидаемся текущих ответов, потом закрываем клиентов LLM
+    dp.shutdown.register(update_guard.drain)
+    dp.shutdown.register(stop_janitor)
+    dp.shutdown.register(close_clients)
+    dp.shutdown.register(close_converters)
+    dp.shutdown.register(close_extraction_pool)
+    if METRICS_PORT and not WEBHOOK_URL:
+        # В режиме вебхука /metrics отдает тот же сервер, что принимает обновления
+        await start_metrics_server()
+    if WEBHOOK_URL:
+        await run_webhook(dp, bot)
+    else:
+        # getUpdates не работает, пока у бота установлен вебхук
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == '__main__':
     try:
         asyncio.run(main())
-    except Exception as e:
-        print(str(e))
+    except Exception:
+        logging.exception("Bot stopped")
@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json - одна строка JSON на запись, для сборщика логов; text - для чтения глазами
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# В режиме long polling /metrics слушает отдельный порт; 0 - не запускать
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# От миллисекунд (Redis) до минут (конвертация и загрузка больших файлов)
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Latency of one message pipeline stage",
+    ["stage", "model"], buckets=_BUCKETS)
+SEND_ATTEMPTS = Counter(
+    "bot_send_attempts_total", "sendMessage calls by parse mode and outcome",
+    ["parse_mode", "result"])
+LLM_REQUESTS = Counter(
+    "bot_llm_requests_total", "LLM calls by model and outcome",
+    ["model", "result"])
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "bot_response_cache_lookups_total", "Response cache lookups",
+    ["result"])
+# 1 у транспорта, через который сейчас идут запросы к Groq
+GROQ_TRANSPORT = Gauge(
+    "bot_groq_transport", "Transport used for Groq requests (1 - active)",
+    ["mode"])
+GROQ_TRANSPORT_SWITCHES = Counter(
+    "bot_groq_transport_switches_total", "Groq transport switches between direct and proxy")
+JANITOR_RECLAIMED = Counter(
+    "bot_janitor_reclaimed_total", "Objects removed by the janitor",
+    ["kind"])
+JANITOR_RECLAIMED_BYTES = Counter(
+    "bot_janitor_reclaimed_bytes_total", "Bytes freed by the janitor",
+    ["kind"])
+
+
+@contextmanager
+def stage(name, model=""):
+    """Замеряет этап обработки сообщения: with stage("pdf_conversion"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name, model).observe(time.perf_counter() - start)
+
+
+def observe(name, seconds, model=""):
+    if seconds is not None:
+        STAGE_SECONDS.labels(name, model).observe(seconds)
+
+
+async def metrics(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', METRICS_PORT).start()
+    logging.info(f"Metrics server listening on :{METRICS_PORT}")
+    return runner
+
+
+class JsonFormatter(logging.Formatter):
+    # Поля из extra={...} попадают в запись как есть
+    _RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self._RESERVED})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler], force=True)
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+import httpx
+
+from clients import provider_for_model
+
+ROUTER_ATTEMPTS = int(os.getenv('ROUTER_ATTEMPTS', 2))
+ROUTER_BACKOFF_BASE = float(os.getenv('ROUTER_BACKOFF_BASE', 0.5))
+ROUTER_BACKOFF_MAX = float(os.getenv('ROUTER_BACKOFF_MAX', 8))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 3))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+# Через сколько секунд без ответа отправлять дублирующий запрос; 0 - не отправлять
+ROUTER_HEDGE_DELAY = float(os.getenv('ROUTER_HEDGE_DELAY', 0))
+ROUTER_HEDGE_MAX_CHARS = int(os.getenv('ROUTER_HEDGE_MAX_CHARS', 500))
+
+
+def _parse_fallbacks(value):
+    # "model=fallback1|fallback2,model2=fallback"
+    fallbacks = {}
+    for item in filter(None, value.split(',')):
+        model, _, models = item.partition('=')
+        fallbacks[model.strip()] = [m.strip() for m in models.split('|') if m.strip()]
+    return fallbacks
+
+
+MODEL_FALLBACKS = _parse_fallbacks(os.getenv('MODEL_FALLBACKS', ''))
+
+
+class ProvidersUnavailable(Exception):
+    pass
+
+
+def _gemini_response_errors():
+    # Gemini ответил, но отказался отвечать на этот запрос: повтор не поможет, другая модель - может
+    types = sys.modules.get("google.generativeai.types")
+    return (types.BlockedPromptException, types.StopCandidateException) if types else ()
+
+
+def _provider_errors():
+    # SDK импортируются лениво: если модуля SDK еще нет, его исключение возникнуть не могло
+    errors = (asyncio.TimeoutError, ConnectionError, httpx.TransportError) + _gemini_response_errors()
+    groq = sys.modules.get("groq")
+    if groq:
+        errors += (groq.APIError,)
+    google_exceptions = sys.modules.get("google.api_core.exceptions")
+    if google_exceptions:
+        errors += (google_exceptions.GoogleAPIError,)
+    return errors
+
+
+def is_provider_error(error):
+    """Ошибка обращения к провайдеру, а не ошибка в коде бота."""
+    return isinstance(error, _provider_errors())
+
+
+def _is_bot_error(error):
+    # Открытый circuit breaker - тоже ответ о состоянии провайдера
+    return not isinstance(error, ProvidersUnavailable) and not is_provider_error(error)
+
+
+def is_transient(error):
+    """Ошибки, после которых имеет смысл повторить запрос к той же модели."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    if not is_provider_error(error) or isinstance(error, _gemini_response_errors()):
+        return False
+    # groq: status_code, google.api_core: code
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if not isinstance(status, int):
+        # Ошибки соединения SDK (APIConnectionError, APITimeoutError) без HTTP-статуса
+        return True
+    return status in (408, 409, 429) or status >= 500
+
+
+def backoff(attempt, base=ROUTER_BACKOFF_BASE, cap=ROUTER_BACKOFF_MAX):
+    # Full jitter: повторы разных пользователей не приходят к провайдеру одной волной
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """После failures ошибок подряд модель пропускается на cooldown секунд,
+    затем пропускается один пробный запрос."""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def available(self):
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def allow(self):
+        # В полуоткрытом состоянии пропускается только один запрос
+        if not self.available():
+            return False
+        if self.state == "half-open":
+            self.probing = True
+        return True
+
+    def abort(self):
+        # Пробный запрос отменен, не дождавшись ответа
+        self.probing = False
+
+    def success(self):
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.errors += 1
+        self.probing = False
+        if self.errors >= self.failures:
+            self.opened_at = time.monotonic()
+
+
+class ProviderRouter:
+    """Выбирает модель для запроса: повторы с backoff, circuit breaker на модель,
+    переход на модель другого провайдера и дублирующие запросы для коротких промптов."""
+
+    def __init__(self, fallbacks=None, attempts=ROUTER_ATTEMPTS, backoff_base=ROUTER_BACKOFF_BASE,
+                 hedge_delay=ROUTER_HEDGE_DELAY, breaker_failures=BREAKER_FAILURES,
+                 breaker_cooldown=BREAKER_COOLDOWN):
+        self.fallbacks = MODEL_FALLBACKS if fallbacks is None else fallbacks
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.hedge_delay = hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+
+    def breaker(self, model):
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return self.breakers[model]
+
+    def candidates(self, model, models, providers=None):
+        """Выбранная модель, затем заданные замены, затем первая модель каждого другого провайдера."""
+        if model in self.fallbacks:
+            ordered = [model] + self.fallbacks[model]
+        else:
+            ordered = [model]
+            seen = {provider_for_model(model)}
+            for other in models:
+                if provider_for_model(other) not in seen:
+                    seen.add(provider_for_model(other))
+                    ordered.append(other)
+        if providers is not None:
+            ordered = [m for m in ordered if provider_for_model(m) in providers]
+        return list(dict.fromkeys(ordered))
+
+    async def _attempts(self, model, call, on_failure):
+        # Повторы одной модели; нетранзиентная ошибка сразу передает ход следующей модели
+        breaker = self.breaker(model)
+        for attempt in range(self.attempts):
+            if not breaker.allow():
+                break
+            try:
+                result = await call(model)
+            except asyncio.CancelledError:
+                breaker.abort()
+                raise
+            except Exception as e:
+                if not is_provider_error(e):
+                    # Ошибка в коде бота: без повторов, без учета в circuit breaker и без перехода на другую модель
+                    breaker.abort()
+                    raise
+                logging.warning(f"Model {model} failed (attempt {attempt + 1}/{self.attempts}): {e!r}")
+                if on_failure:
+                    await on_failure(model, e)
+                if not is_transient(e):
+                    # Провайдер ответил, ошибка в самом запросе - модель исправна
+                    breaker.success()
+                    raise
+                breaker.failure()
+                if attempt + 1 < self.attempts and breaker.state == "closed":
+                    await asyncio.sleep(backoff(attempt, self.backoff_base))
+                    continue
+                raise
+            breaker.success()
+            return result
+        raise ProvidersUnavailable(f"Circuit for {model} is open")
+
+    async def _hedged(self, models, call, on_failure, tried):
+        # Основной запрос и, если он не успел за hedge_delay, дубль к следующей модели
+        tasks = {asyncio.create_task(self._attempts(models[0], call, on_failure)): models[0]}
+        tried.append(models[0])
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                logging.info(f"Hedging {models[0]} with {models[1]} after {self.hedge_delay}s")
+                tasks[asyncio.create_task(self._attempts(models[1], call, on_failure))] = models[1]
+                tried.append(models[1])
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return tasks[task], task.result()
+                    error = task.exception()
+                    if _is_bot_error(error):
+                        raise error
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self, model, call, models, providers=None, hedge=False, on_failure=None):
+        """Вызывает call(model) для выбранной модели и замен до первого ответа.
+
+        Возвращает (модель, ответ). ProvidersUnavailable - ни одна модель не ответила.
+        """
+        candidates = [m for m in self.candidates(model, models, providers) if self.breaker(m).available()]
+        if not candidates:
+            raise ProvidersUnavailable(f"All circuits are open for {model}")
+
+        errors = []
+        if hedge and self.hedge_delay > 0 and len(candidates) > 1:
+            tried = []
+            try:
+                return await self._hedged(candidates, call, on_failure, tried)
+            except Exception as e:
+                if _is_bot_error(e):
+                    raise
+                errors.append(e)
+                candidates = [m for m in candidates if m not in tried]
+
+        for candidate in candidates:
+            try:
+                return candidate, await self._attempts(candidate, call, on_failure)
+            except Exception as e:
+                if _is_bot_error(e):
+                    raise
+                errors.append(e)
+        raise ProvidersUnavailable(f"No model answered for {model}: {errors!r}")
+
+
+router = ProviderRouter()
@@ -0,0 +1,110 @@
+import asyncio
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from redis.exceptions import LockError
+
+from states import redis
+
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 16))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', 100))
+PROVIDER_MAX_CONCURRENCY = {
+    "groq": int(os.getenv('GROQ_MAX_CONCURRENCY', 8)),
+    "gemini": int(os.getenv('GEMINI_MAX_CONCURRENCY', 8)),
+}
+# Блокировка живет дольше самого долгого хода (конвертация + загрузка + ответ модели)
+USER_LOCK_TIMEOUT = int(os.getenv('USER_LOCK_TIMEOUT', 900))
+USER_LOCK_WAIT = int(os.getenv('USER_LOCK_WAIT', 300))
+
+
+class SchedulerOverloaded(Exception):
+    pass
+
+
+class UserBusy(Exception):
+    pass
+
+
+class Scheduler:
+    """Общая очередь к LLM с глобальным лимитом и лимитами на провайдера.
+
+    Ожидающие запросы запускаются в порядке поступления: пропускается вперед
+    только тот, чей провайдер свободен, когда провайдер стоящих впереди занят.
+    """
+
+    def __init__(self, limit, provider_limits, max_queue):
+        self.limit = limit
+        self.provider_limits = provider_limits
+        self.max_queue = max_queue
+        self.active = 0
+        self.active_by_provider = Counter()
+        self.queue = []
+
+    def _can_run(self, provider):
+        provider_limit = self.provider_limits.get(provider, self.limit)
+        return self.active < self.limit and self.active_by_provider[provider] < provider_limit
+
+    def _start(self, provider):
+        self.active += 1
+        self.active_by_provider[provider] += 1
+
+    def _release(self, provider):
+        self.active -= 1
+        self.active_by_provider[provider] -= 1
+        for waiter in list(self.queue):
+            waiter_provider, future = waiter
+            if self._can_run(waiter_provider):
+                self.queue.remove(waiter)
+                self._start(waiter_provider)
+                future.set_result(None)
+
+    async def _acquire(self, provider, on_queued):
+        # После каждого освобождения все запускаемые запросы уже сняты с очереди,
+        # поэтому свободный слот можно занять сразу, не нарушая порядка
+        if self._can_run(provider):
+            self._start(provider)
+            return
+        if len(self.queue) >= self.max_queue:
+            raise SchedulerOverloaded(f"LLM queue is full ({len(self.queue)} requests)")
+
+        waiter = (provider, asyncio.get_running_loop().create_future())
+        self.queue.append(waiter)
+        try:
+            if on_queued:
+                await on_queued(len(self.queue))
+            await waiter[1]
+        except BaseException:
+            if waiter in self.queue:
+                self.queue.remove(waiter)
+            elif waiter[1].done() and not waiter[1].cancelled():
+                # Слот уже выдан, но ход отменен - возвращаем слот следующему
+                self._release(provider)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, provider, on_queued=None):
+        await self._acquire(provider, on_queued)
+        try:
+            yield
+        finally:
+            self._release(provider)
+
+
+scheduler = Scheduler(LLM_MAX_CONCURRENCY, PROVIDER_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+
+@asynccontextmanager
+async def user_turn(user_id):
+    # Блокировка в Redis, чтобы ходы одного пользователя не пересекались и между репликами
+    lock = redis.lock(f"{user_id}_lock", timeout=USER_LOCK_TIMEOUT, blocking_timeout=USER_LOCK_WAIT)
+    if not await lock.acquire():
+        raise UserBusy(f"User {user_id} still has a request in progress")
+    try:
+        yield
+    finally:
+        try:
+            await lock.release()
+        except LockError:
+            # Блокировка истекла раньше, чем закончился ход
+            pass
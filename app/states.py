@@ -1,45 +1,251 @@
 import json
 import os
+import time
 
+import msgpack
 import redis.asyncio as aioredis
-from dotenv import load_dotenv
 
-load_dotenv()
+from config import config
 
-redis = aioredis.from_url(os.getenv('REDIS_URL'))
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
+redis = aioredis.from_url(config.redis_url)
+
+# Gemini хранит загруженные файлы 48 часов, запас нужен, чтобы не сослаться на файл,
+# который удалят во время ответа
+GEMINI_FILE_TTL = int(os.getenv('GEMINI_FILE_TTL', 48 * 3600))
+GEMINI_FILE_TTL_MARGIN = int(os.getenv('GEMINI_FILE_TTL_MARGIN', 3600))
+
+# Состояние пользователя - один хэш {user_id}_state: модель, файлы и реплики по отдельным полям.
+# Новая реплика дописывается полем, а не переписывает всю историю
+USER_STATE_VERSION = 1
+USER_STATE_TTL = int(os.getenv('USER_STATE_TTL', 90 * 24 * 3600))
+# zstd - сжимать значения длиннее STATE_COMPRESSION_MIN_BYTES (нужен пакет zstandard)
+STATE_COMPRESSION = os.getenv('STATE_COMPRESSION', '')
+STATE_COMPRESSION_MIN_BYTES = int(os.getenv('STATE_COMPRESSION_MIN_BYTES', 512))
+_TURN = "turn:"
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_compressor = zstandard.ZstdCompressor(level=3) if STATE_COMPRESSION == 'zstd' and zstandard else None
+
+CONTEXT_TTL = int(os.getenv('CONTEXT_TTL', 7 * 24 * 3600))
+CONTEXT_MAX_TURNS = int(os.getenv('CONTEXT_MAX_TURNS', 200))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 6000))
+CHARS_PER_TOKEN = int(os.getenv('CHARS_PER_TOKEN', 3))
+
+
+def _parse_budgets(value):
+    budgets = {}
+    for item in filter(None, value.split(',')):
+        model, tokens = item.split('=')
+        budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+# Бюджеты для отдельных моделей: "gemini-1.5-pro=100000,llama-3.1-8b-instant=4000"
+CONTEXT_TOKEN_BUDGETS = _parse_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS', ''))
+
+
+def estimate_tokens(turn):
+    content = turn["content"]
+    if isinstance(content, list):
+        # Файлы: [имена файлов в Gemini..., подпись]; сами документы в бюджет истории не входят
+        content = content[-1]
+    return len(content) // CHARS_PER_TOKEN + 4
 
-async def get_user_context(user_id, system_message):
-    data = await redis.get(user_id)
-    if data:
-        return json.loads(data)
-    # Возвращаем начальный контекст только если это первое обращение
-    # Убрали "name": user_id, так как он не нужен
-    return [{"role": "system", "content": system_message}]
 
+def fit_to_budget(turns, budget):
+    # Скользящее окно: берем самые свежие реплики, пока они помещаются в бюджет
+    window = []
+    used = 0
+    for turn in reversed(turns):
+        used += estimate_tokens(turn)
+        if used > budget and window:
+            break
+        window.append(turn)
+    window.reverse()
+    # История должна начинаться с реплики пользователя
+    while window and window[0]["role"] != "user":
+        window.pop(0)
+    return window
 
-async def save_user_context(user_id, context):
-    await redis.set(user_id, json.dumps(context))
 
+def pack(value):
+    data = msgpack.packb(value, use_bin_type=True)
+    if _compressor and len(data) >= STATE_COMPRESSION_MIN_BYTES:
+        data = _compressor.compress(data)
+    return data
 
-async def get_user_files(user_id):
-    data = await redis.get(f"{user_id}_files")
-    if data:
-        return json.loads(data)
+
+def unpack(data):
+    # Сжатые значения узнаются по сигнатуре zstd, поэтому сжатие можно включать и выключать на ходу
+    if data[:4] == _ZSTD_MAGIC:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def _empty_state():
+    return {"model": None, "files": [], "turns": [], "turn_ids": [], "next": 0}
+
+
+def _decode_state(data):
+    state = _empty_state()
+    turns = []
+    for field, value in data.items():
+        field = field.decode()
+        if field.startswith(_TURN):
+            turns.append((int(field[len(_TURN):]), value))
+        elif field == "model":
+            state["model"] = value.decode()
+        elif field == "files":
+            state["files"] = unpack(value)
+        elif field == "next":
+            state["next"] = int(value)
+        elif field == "updated_at":
+            state["updated_at"] = float(value)
+    turns.sort()
+    state["turn_ids"] = [turn_id for turn_id, _ in turns]
+    if time.time() - state.get("updated_at", 0) <= CONTEXT_TTL:
+        state["turns"] = [unpack(value) for _, value in turns]
     else:
-        return []
+        # Беседа заброшена дольше CONTEXT_TTL: выбор модели и файлы остаются, история нет
+        state["turns"] = []
+        state["stale_ids"] = state["turn_ids"]
+        state["turn_ids"] = []
+    return state
 
 
-async def save_user_files(user_id, data):
-    await redis.set(f"{user_id}_files", json.dumps(data))
+def _write_state(pipe, user_id, state, turns=(), model=None, files=None):
+    """Добавляет в pipe запись изменений состояния и обновляет state."""
+    key = f"{user_id}_state"
+    mapping = {"v": USER_STATE_VERSION, "updated_at": time.time()}
+    if model is not None:
+        mapping["model"] = state["model"] = model
+    if files is not None:
+        state["files"] = files
+        mapping["files"] = pack(files)
+    for turn in turns:
+        mapping[f"{_TURN}{state['next']}"] = pack(turn)
+        state["turn_ids"].append(state["next"])
+        state["turns"].append(turn)
+        state["next"] += 1
+    mapping["next"] = state["next"]
+    pipe.hset(key, mapping=mapping)
+
+    excess = max(0, len(state["turn_ids"]) - CONTEXT_MAX_TURNS)
+    removed = state.pop("stale_ids", []) + state["turn_ids"][:excess]
+    if removed:
+        pipe.hdel(key, *(f"{_TURN}{turn_id}" for turn_id in removed))
+        del state["turn_ids"][:excess]
+        del state["turns"][:excess]
+    pipe.expire(key, USER_STATE_TTL)
+
+
+async def _migrate_user_state(user_id):
+    # Раньше модель, файлы и контекст лежали под отдельными ключами, а еще раньше
+    # весь контекст был одной JSON-строкой под ключом user_id
+    old_keys = (f"{user_id}_model", f"{user_id}_files", f"{user_id}_context", user_id)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.get(old_keys[0])
+        pipe.get(old_keys[1])
+        pipe.lrange(old_keys[2], -CONTEXT_MAX_TURNS, -1)
+        pipe.get(old_keys[3])
+        model, files, context, legacy_context = await pipe.execute()
+    state = _empty_state()
+    if not (model or files or context or legacy_context):
+        return state
+
+    if context:
+        turns = [json.loads(turn) for turn in context]
+    else:
+        turns = [turn for turn in json.loads(legacy_context or "[]") if turn["role"] != "system"]
+    async with redis.pipeline(transaction=True) as pipe:
+        _write_state(pipe, user_id, state, turns=turns[-CONTEXT_MAX_TURNS:],
+                     model=model.decode() if model else None, files=json.loads(files) if files else [])
+        pipe.delete(*old_keys)
+        await pipe.execute()
+    return state
 
 
-async def get_user_model(user_id, default_model):
-    from main import MODEL_CHOICES
-    model = await redis.get(f"{user_id}_model")
-    if model:
-        decoded_model = model.decode()
-        # Проверяем, существует ли модель в списке доступных
-        if decoded_model in MODEL_CHOICES:
-            return decoded_model
+async def load_user_state(user_id):
+    """Модель, файлы и история пользователя за одно обращение к Redis."""
+    data = await redis.hgetall(f"{user_id}_state")
+    if not data:
+        return await _migrate_user_state(user_id)
+    return _decode_state(data)
+
+
+async def save_user_state(user_id, state, turns=(), model=None, files=None):
+    """Новые реплики и изменившиеся модель и файлы одной транзакцией."""
+    async with redis.pipeline(transaction=True) as pipe:
+        _write_state(pipe, user_id, state, turns=turns, model=model, files=files)
+        await pipe.execute()
+
+
+async def get_user_context(user_id, system_message, model=None, state=None):
+    if state is None:
+        state = await load_user_state(user_id)
+    budget = CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+    # Возвращаем начальный контекст только если это первое обращение
+    return [{"role": "system", "content": system_message}] + fit_to_budget(state["turns"], budget)
+
+
+async def append_user_context(user_id, *turns):
+    if turns:
+        await save_user_state(user_id, await load_user_state(user_id), turns=turns)
+
+
+def _clear_turns(pipe, user_id, state):
+    turn_ids = state.pop("stale_ids", []) + state["turn_ids"]
+    if turn_ids:
+        pipe.hdel(f"{user_id}_state", *(f"{_TURN}{turn_id}" for turn_id in turn_ids))
+    state["turn_ids"] = []
+    state["turns"] = []
+
+
+async def clear_user_context(user_id):
+    state = await load_user_state(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        _clear_turns(pipe, user_id, state)
+        await pipe.execute()
+
+
+async def set_user_model(user_id, model, reset_context=True):
+    state = await load_user_state(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        if reset_context:
+            # При смене модели создаем новый контекст с system message
+            _clear_turns(pipe, user_id, state)
+        _write_state(pipe, user_id, state, model=model)
+        await pipe.execute()
+
+
+async def get_user_model(user_id, default_model, state=None):
+    if state is None:
+        state = await load_user_state(user_id)
+    # Проверяем, существует ли модель в списке доступных
+    if state["model"] in config.model_choices:
+        return state["model"]
     return default_model
+
+
+async def get_indexed_file(sha256):
+    # Индекс общий для всех пользователей: одинаковый файл конвертируется и загружается один раз
+    data = await redis.hgetall(f"file_index:{sha256}")
+    if not data:
+        return None
+    record = {key.decode(): value.decode() for key, value in data.items()}
+    if float(record.get("expires_at", 0)) - GEMINI_FILE_TTL_MARGIN <= time.time():
+        return None
+    return record
+
+
+async def index_file(sha256, pdf_name, gemini_name, expires_at=None):
+    expires_at = int(expires_at or time.time() + GEMINI_FILE_TTL)
+    key = f"file_index:{sha256}"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={"pdf_name": pdf_name, "gemini_name": gemini_name, "expires_at": expires_at})
+        pipe.expireat(key, expires_at)
+        await pipe.execute()
@@ -0,0 +1,119 @@
+import logging
+import os
+import time
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+
+from formatting import TELEGRAM_MESSAGE_LIMIT, format_message, split_message
+from metrics import observe, SEND_ATTEMPTS
+
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+# Telegram ограничивает частоту правок одного сообщения, поэтому правки копятся
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+STREAM_MIN_DELTA = int(os.getenv('STREAM_MIN_DELTA', 40))
+
+
+def _seconds(value):
+    return f"{value:.2f}s" if value is not None else "-"
+
+
+class StreamingReply:
+    """Показывает ответ модели по мере генерации, редактируя одно сообщение бота."""
+
+    def __init__(self, message, model):
+        self.message = message
+        self.model = model
+        self.sent = None
+        self.text = ""
+        self.shown = 0
+        self.preview_full = False
+        self.next_edit = 0.0
+        self.started = time.monotonic()
+        self.first_token = None
+        self.first_visible = None
+
+    async def feed(self, chunk):
+        if not chunk:
+            return
+        if self.first_token is None:
+            self.first_token = time.monotonic() - self.started
+        self.text += chunk
+        if len(self.text) - self.shown >= STREAM_MIN_DELTA and time.monotonic() >= self.next_edit:
+            await self._flush()
+
+    def reset(self, model=None):
+        # Повторная попытка запроса (в том числе к другой модели) начинает ответ заново,
+        # сообщение остается тем же
+        if model:
+            self.model = model
+        self.text = ""
+        self.shown = 0
+        self.preview_full = False
+
+    async def _flush(self):
+        if self.preview_full:
+            # Превью заполнено, остаток придет в финальной отправке
+            return
+        text = format_message(self.text)
+        parse_mode = ParseMode.MARKDOWN_V2
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            text = split_message(text)[0]
+            self.preview_full = True
+        try:
+            await self._show(text, parse_mode)
+        except TelegramRetryAfter as e:
+            self.next_edit = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            # Незавершенная разметка не прошла проверку Telegram - показываем как есть
+            try:
+                await self._show(self.text[:TELEGRAM_MESSAGE_LIMIT], None)
+            except TelegramAPIError as e:
+                return self._skip(e)
+        except TelegramAPIError as e:
+            return self._skip(e)
+        self.shown = len(self.text)
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        if self.first_visible is None:
+            self.first_visible = time.monotonic() - self.started
+
+    def _skip(self, error):
+        # Сбой сети или Telegram не должен обрывать ответ модели: превью догонит следующая правка
+        logging.warning(f"Streamed preview update failed: {error!r}")
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def _show(self, text, parse_mode):
+        if self.sent is None:
+            self.sent = await self.message.answer(text, parse_mode=parse_mode)
+        else:
+            self.sent = await self.sent.edit_text(text, parse_mode=parse_mode)
+
+    async def finish(self, chunks):
+        """Заменяет превью первой частью ответа и возвращает части, которые осталось отправить."""
+        total = time.monotonic() - self.started
+        observe("first_token", self.first_token, self.model)
+        observe("first_visible", self.first_visible, self.model)
+        logging.info(f"Streamed response: model={self.model} first_token={_seconds(self.first_token)} "
+                     f"first_visible={_seconds(self.first_visible)} total={_seconds(total)}")
+        if self.sent is None:
+            return chunks
+        try:
+            await self.sent.edit_text(chunks[0], parse_mode=ParseMode.MARKDOWN_V2)
+            SEND_ATTEMPTS.labels("MarkdownV2", "ok").inc()
+            return chunks[1:]
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return chunks[1:]
+            SEND_ATTEMPTS.labels("MarkdownV2", "rejected").inc()
+            logging.warning(f"Final edit of streamed preview failed: {e}")
+        except TelegramAPIError as e:
+            # Ответ модели уже получен: не удалось отредактировать превью - отправляем ответ новыми сообщениями
+            logging.warning(f"Final edit of streamed preview failed: {e!r}")
+        try:
+            await self.sent.delete()
+        except TelegramAPIError as e:
+            logging.warning(f"Cannot delete streamed preview: {e!r}")
+        return chunks
@@ -0,0 +1,158 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from states import redis
+
+# Дневные счетчики хранятся чуть дольше месяца, для сводки за прошлый месяц
+USAGE_TTL_DAYS = int(os.getenv('USAGE_TTL_DAYS', 35))
+# Токен-бакет на пользователя: емкость и пополнение в минуту; 0 - без ограничений
+USER_TOKEN_BUCKET = int(os.getenv('USER_TOKEN_BUCKET', 0))
+USER_TOKENS_PER_MINUTE = float(os.getenv('USER_TOKENS_PER_MINUTE', 2000))
+
+USAGE_PREFIX = "usage"
+_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "latency_ms")
+
+# Пополняет бакет за прошедшее время и возвращает остаток; списание делает record_usage.
+# Один EVALSHA на сообщение: проверка не требует нескольких обращений к Redis
+_REFILL = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(tokens)
+"""
+_refill = None
+
+
+def usage_day(timestamp=None):
+    return datetime.fromtimestamp(timestamp or time.time(), timezone.utc).strftime("%Y-%m-%d")
+
+
+def _user_key(day, user_id):
+    return f"{USAGE_PREFIX}:{day}:{user_id}"
+
+
+def _bucket_key(user_id):
+    return f"{USAGE_PREFIX}:bucket:{user_id}"
+
+
+def extract_usage(response):
+    """(prompt_tokens, completion_tokens) из ответа Groq, последнего чанка его стрима или ответа Gemini."""
+    usage = getattr(response, "usage", None)
+    x_groq = getattr(response, "x_groq", None)
+    if usage is None and x_groq is not None:
+        # В стриме Groq счетчики приходят в x_groq последнего чанка
+        usage = x_groq.usage
+    if usage is not None:
+        return usage.prompt_tokens or 0, usage.completion_tokens or 0
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is not None:
+        return metadata.prompt_token_count or 0, metadata.candidates_token_count or 0
+    return None
+
+
+async def check_rate_limit(user_id):
+    """Остаток бакета пользователя; None, если ограничение выключено.
+
+    Запрос пропускается, пока остаток положительный: точная цена ответа известна только после него.
+    """
+    if not USER_TOKEN_BUCKET:
+        return None
+    global _refill
+    if _refill is None or _refill.registered_client is not redis:
+        _refill = redis.register_script(_REFILL)
+    tokens = await _refill(keys=[_bucket_key(user_id)],
+                           args=[USER_TOKEN_BUCKET, USER_TOKENS_PER_MINUTE / 60, time.time()])
+    return float(tokens)
+
+
+def rate_limit_wait(tokens):
+    # Сколько секунд ждать, пока бакет снова станет положительным
+    return max(0.0, -tokens) / (USER_TOKENS_PER_MINUTE / 60) + 1
+
+
+async def record_usage(user_id, model, prompt_tokens, completion_tokens, latency):
+    """Атомарные счетчики за день: по пользователю и модели, по модели для всех и рейтинг пользователей."""
+    day = usage_day()
+    user_key = _user_key(day, user_id)
+    total_key = f"{USAGE_PREFIX}:{day}"
+    top_key = f"{USAGE_PREFIX}:{day}:top"
+    values = {"requests": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+              "latency_ms": int(latency * 1000)}
+    tokens = prompt_tokens + completion_tokens
+    async with redis.pipeline(transaction=False) as pipe:
+        for field, value in values.items():
+            pipe.hincrby(user_key, f"{model}:{field}", value)
+            pipe.hincrby(total_key, f"{model}:{field}", value)
+        pipe.zincrby(top_key, tokens, user_id)
+        for key in (user_key, total_key, top_key):
+            pipe.expire(key, USAGE_TTL_DAYS * 24 * 3600)
+        if USER_TOKEN_BUCKET:
+            pipe.hincrbyfloat(_bucket_key(user_id), "tokens", -tokens)
+        await pipe.execute()
+    logging.debug(f"Usage {user_id} {model}: {prompt_tokens}+{completion_tokens} tokens, {latency:.2f}s")
+
+
+def _by_model(data):
+    models = {}
+    for field, value in data.items():
+        model, name = field.decode().rsplit(":", 1)
+        models.setdefault(model, dict.fromkeys(_FIELDS, 0))[name] += int(value)
+    return models
+
+
+def _merge(total, models):
+    for model, counters in models.items():
+        for name, value in counters.items():
+            total.setdefault(model, dict.fromkeys(_FIELDS, 0))[name] += value
+    return total
+
+
+def _days(days):
+    today = datetime.now(timezone.utc)
+    return [(today - timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(days)]
+
+
+async def get_user_usage(user_id, days=1):
+    """Счетчики пользователя по моделям за последние days дней (сегодня - первый день)."""
+    async with redis.pipeline(transaction=False) as pipe:
+        for day in _days(days):
+            pipe.hgetall(_user_key(day, user_id))
+        results = await pipe.execute()
+    total = {}
+    for data in results:
+        _merge(total, _by_model(data))
+    return total
+
+
+async def get_usage_summary(days=1, top=10):
+    """Счетчики всех пользователей по моделям и самые активные пользователи за последние days дней."""
+    async with redis.pipeline(transaction=False) as pipe:
+        for day in _days(days):
+            pipe.hgetall(f"{USAGE_PREFIX}:{day}")
+            pipe.zrange(f"{USAGE_PREFIX}:{day}:top", 0, -1, withscores=True)
+        results = await pipe.execute()
+    models = {}
+    users = {}
+    for data, ranking in zip(results[::2], results[1::2]):
+        _merge(models, _by_model(data))
+        for user_id, tokens in ranking:
+            users[user_id.decode()] = users.get(user_id.decode(), 0) + int(tokens)
+    return models, sorted(users.items(), key=lambda item: -item[1])[:top]
+
+
+def format_usage(models):
+    lines = []
+    for model, counters in sorted(models.items()):
+        requests = counters["requests"] or 1
+        lines.append(f"{model}: запросов {counters['requests']}, токенов {counters['prompt_tokens']} + "
+                     f"{counters['completion_tokens']}, среднее время ответа "
+                     f"{counters['latency_ms'] / requests / 1000:.1f} с")
+    return "\n".join(lines) or "Запросов не было"
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+import signal
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from metrics import metrics
+from states import redis
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+# Telegram повторяет доставку, если ответ задержался; повтор может прийти на другую реплику
+UPDATE_DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', 3600))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 90))
+
+
+class UpdateGuard(BaseMiddleware):
+    """Отбрасывает повторные update_id и считает обновления, которые еще обрабатываются."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        if not await redis.set(f"update_{event.update_id}", 1, nx=True, ex=UPDATE_DEDUP_TTL):
+            logging.info(f"Skipping duplicate update {event.update_id}")
+            return None
+
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+
+    async def drain(self):
+        if not self.in_flight:
+            return
+        logging.info(f"Waiting for {self.in_flight} updates in progress...")
+        try:
+            await asyncio.wait_for(self.idle.wait(), SHUTDOWN_DRAIN_TIMEOUT)
+        except TimeoutError:
+            logging.warning(f"Shutdown with {self.in_flight} updates still in progress")
+
+
+update_guard = UpdateGuard()
+
+
+async def health(request):
+    return web.Response(text="ok")
+
+
+async def run_webhook(dp, bot):
+    async def set_webhook():
+        # Все реплики регистрируют один и тот же адрес сервиса, повторный вызов безопасен
+        await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+
+    dp.startup.register(set_webhook)
+
+    app = web.Application()
+    # Сначала хуки диспетчера: при остановке они дожидаются обработки до закрытия сессии бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", health)
+    app.router.add_get("/metrics", metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await runner.cleanup()
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import fakeredis
+from aiogram import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+import albums  # noqa: E402
+import clients  # noqa: E402
+import files  # noqa: E402
+
+FILES = int(os.getenv('BENCH_FILES', 5))
+DOWNLOAD_SECONDS = 0.3
+UPLOAD_SECONDS = 1.0
+PROCESSING_SECONDS = 2.0
+# Ответ по документу; каждый дополнительный документ в том же запросе добавляет немного
+LLM_SECONDS = 6.0
+LLM_SECONDS_PER_EXTRA_FILE = 1.0
+# Интервал между частями альбома, как их присылает Telegram
+PART_INTERVAL = 0.05
+
+
+class FakeGemini:
+    def __init__(self):
+        self.ready_at = {}
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(UPLOAD_SECONDS)
+        self.ready_at[path] = time.monotonic() + PROCESSING_SECONDS
+        return SimpleNamespace(name=path, display_name=path, uri=f"fake://{path}")
+
+    def get_file(self, name):
+        state = "ACTIVE" if time.monotonic() >= self.ready_at[name] else "PROCESSING"
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), expiration_time=None)
+
+
+def album_part(message_id):
+    return types.Message.model_validate({
+        "message_id": message_id, "date": 0, "media_group_id": "album",
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+        "document": {"file_id": f"f{message_id}", "file_unique_id": f"u{message_id}",
+                     "file_name": f"task{message_id}.pdf"},
+    })
+
+
+async def ingest(message):
+    await asyncio.sleep(DOWNLOAD_SECONDS)
+    uploaded = await files.upload_to_gemini(message.document.file_name, mime_type="application/pdf")
+    await files.wait_for_files_active([uploaded])
+    return uploaded
+
+
+async def per_file():
+    # Прежнее поведение: каждая часть - отдельный ход, ходы пользователя идут по очереди
+    llm_calls = 0
+    for message in map(album_part, range(FILES)):
+        await ingest(message)
+        await asyncio.sleep(LLM_SECONDS)
+        llm_calls += 1
+    return llm_calls
+
+
+async def media_group():
+    async def arrive(message, delay):
+        await asyncio.sleep(delay)
+        messages = await albums.collect_media_group(message)
+        if messages:
+            await asyncio.gather(*(ingest(m) for m in messages))
+            await asyncio.sleep(LLM_SECONDS + LLM_SECONDS_PER_EXTRA_FILE * (len(messages) - 1))
+            return 1
+        return 0
+
+    return sum(await asyncio.gather(*(arrive(album_part(i), i * PART_INTERVAL) for i in range(FILES))))
+
+
+async def bench():
+    clients._genai = FakeGemini()
+    albums.redis = fakeredis.FakeAsyncRedis()
+    for name, run in (("per file", per_file), ("media group", media_group)):
+        start = time.perf_counter()
+        llm_calls = await run()
+        print(f"{name:12} {FILES} files: {time.perf_counter() - start:5.1f}s wall, {llm_calls} LLM calls")
+
+
+asyncio.run(bench())
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+from groq import AsyncGroq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import clients  # noqa: E402
+
+N = 1000
+
+
+async def per_message():
+    # Как было раньше: новый httpx-клиент и AsyncGroq на каждое сообщение
+    created = []
+    start = time.perf_counter()
+    for _ in range(N):
+        created.append(AsyncGroq(api_key="bench", http_client=httpx.AsyncClient()))
+    elapsed = time.perf_counter() - start
+    for client in created:
+        await client.close()
+    return elapsed
+
+
+async def registry():
+    clients._get_groq_client()
+    start = time.perf_counter()
+    for _ in range(N):
+        clients._get_groq_client()
+    elapsed = time.perf_counter() - start
+    await clients.close_clients()
+    return elapsed
+
+
+async def bench():
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    old = await per_message()
+    new = await registry()
+    print(f"per-message construction: {old / N * 1e6:.1f} us/message")
+    print(f"registry lookup:          {new / N * 1e6:.1f} us/message")
+
+
+asyncio.run(bench())
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import states  # noqa: E402
+
+SYSTEM_MESSAGE = "Ты ассистент, которого зовут StudentLLMAbot."
+TURN = "Объясни, пожалуйста, как решать квадратные уравнения через дискриминант. " * 4
+HISTORY_LENGTHS = [10, 50, 100, 200]
+MESSAGES = 50
+
+
+async def legacy_turn(redis, user_id):
+    # Старый формат: вся история читается и переписывается одной JSON-строкой
+    data = await redis.get(user_id)
+    context = json.loads(data) if data else [{"role": "system", "content": SYSTEM_MESSAGE}]
+    context.append({"role": "user", "content": TURN})
+    context.append({"role": "assistant", "content": TURN})
+    payload = json.dumps(context)
+    await redis.set(user_id, payload)
+    return len(data or b"") + len(payload)
+
+
+async def state_turn(user_id):
+    context = await states.get_user_context(user_id, SYSTEM_MESSAGE)
+    turns = [{"role": "user", "content": TURN}, {"role": "assistant", "content": TURN}]
+    await states.append_user_context(user_id, *turns)
+    read = sum(len(json.dumps(turn)) for turn in context[1:])
+    return read + sum(len(json.dumps(turn)) for turn in turns)
+
+
+async def bench():
+    redis = fakeredis.FakeAsyncRedis()
+    states.redis = redis
+    print("history  legacy bytes/msg  legacy ms  state bytes/msg  state ms")
+    for length in HISTORY_LENGTHS:
+        await redis.flushall()
+        for _ in range(length // 2):
+            await legacy_turn(redis, "legacy")
+            await states.append_user_context("list", {"role": "user", "content": TURN},
+                                             {"role": "assistant", "content": TURN})
+
+        results = []
+        for turn in (lambda: legacy_turn(redis, "legacy"), lambda: state_turn("list")):
+            total_bytes = 0
+            start = time.perf_counter()
+            for _ in range(MESSAGES):
+                total_bytes += await turn()
+            results.append((total_bytes / MESSAGES, (time.perf_counter() - start) / MESSAGES * 1000))
+        (legacy_bytes, legacy_ms), (state_bytes, state_ms) = results
+        print(f"{length:7}  {legacy_bytes:16.0f}  {legacy_ms:9.2f}  {state_bytes:15.0f}  {state_ms:8.2f}")
+
+
+asyncio.run(bench())
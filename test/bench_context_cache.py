@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import clients  # noqa: E402
+import history  # noqa: E402
+
+MODEL = "gemini-1.5-pro-002"
+DOCUMENT_TOKENS = int(os.getenv('BENCH_DOCUMENT_TOKENS', 120000))
+FOLLOW_UPS = int(os.getenv('BENCH_FOLLOW_UPS', 10))
+QUESTION_TOKENS = 60
+ANSWER_TOKENS = 800
+# Модель задержки: фиксированная часть, чтение входа и генерация; закэшированный вход читается быстрее
+BASE_SECONDS = 0.8
+INPUT_TOKENS_PER_SECOND = 20000
+CACHED_TOKENS_PER_SECOND = 200000
+OUTPUT_TOKENS_PER_SECOND = 80
+# Цены Gemini 1.5 Pro, $ за миллион токенов (хранение кэша - за час)
+INPUT_PRICE = 1.25
+CACHED_PRICE = 0.3125
+OUTPUT_PRICE = 5.0
+STORAGE_PRICE_PER_HOUR = 4.5
+TURN_INTERVAL_MINUTES = 3
+
+
+class FakeGemini:
+    def __init__(self):
+        self.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=self.create))
+
+    def create(self, model, system_instruction, contents, ttl):
+        return SimpleNamespace(name="cachedContents/bench", expire_time=datetime.now(timezone.utc) + ttl)
+
+    def get_file(self, name):
+        return SimpleNamespace(name=name, state=SimpleNamespace(name="ACTIVE"), expiration_time=None)
+
+
+def turn_tokens(turns):
+    return sum(DOCUMENT_TOKENS if isinstance(turn["content"], list) else
+               (QUESTION_TOKENS if turn["role"] == "user" else ANSWER_TOKENS) for turn in turns)
+
+
+async def conversation(use_cache):
+    files = [{"sha256": "doc", "gemini_name": "files/doc"}]
+    turns = []
+    results = []
+    for turn in range(FOLLOW_UPS + 1):
+        question = {"role": "user", "content": ["files/doc", "Выполни задания"] if not turn else "А дальше?"}
+        cached = history.find_context_cache(files, MODEL, turns) if use_cache else None
+        cached_tokens = turn_tokens(turns[:cached[1]]) if cached else 0
+        prompt_tokens = turn_tokens(turns + [question])
+        uncached = prompt_tokens - cached_tokens
+        latency = (BASE_SECONDS + uncached / INPUT_TOKENS_PER_SECOND + cached_tokens / CACHED_TOKENS_PER_SECOND
+                   + ANSWER_TOKENS / OUTPUT_TOKENS_PER_SECOND)
+        cost = (uncached * INPUT_PRICE + cached_tokens * CACHED_PRICE + ANSWER_TOKENS * OUTPUT_PRICE) / 1e6
+        if cached:
+            cost += cached_tokens * STORAGE_PRICE_PER_HOUR / 1e6 * TURN_INTERVAL_MINUTES / 60
+        turns += [question, {"role": "assistant", "content": "..."}]
+        if use_cache:
+            files = await history.cache_context(MODEL, turns, files, prompt_tokens) or files
+        results.append((latency, cost))
+    return results[1:]
+
+
+async def bench():
+    clients._genai = FakeGemini()
+    print(f"{DOCUMENT_TOKENS} token document, {FOLLOW_UPS} follow-ups, {TURN_INTERVAL_MINUTES} min apart")
+    for use_cache in (False, True):
+        results = await conversation(use_cache)
+        latency = sum(r[0] for r in results) / len(results)
+        cost = sum(r[1] for r in results)
+        print(f"{'context cache' if use_cache else 'full history':14} follow-up latency {latency:5.2f}s, "
+              f"cost ${cost:.3f}")
+
+
+asyncio.run(bench())
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+from conversion import ILovePdfConverter, LibreOfficeConverter, LIBREOFFICE_BINARY  # noqa: E402
+
+CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                 '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                 '<Default Extension="xml" ContentType="application/xml"/>{}</Types>')
+RELS = ('<?xml version="1.0" encoding="UTF-8"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{}</Relationships>')
+OFFICE_DOCUMENT = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+
+def make_docx(path, paragraphs):
+    body = "".join(f"<w:p><w:r><w:t>Задание {i}. Найдите производную функции f(x) = x^{i} + sin(x).</w:t></w:r></w:p>"
+                   for i in range(paragraphs))
+    with zipfile.ZipFile(path, "w") as docx:
+        docx.writestr("[Content_Types].xml", CONTENT_TYPES.format(
+            '<Override PartName="/word/document.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'))
+        docx.writestr("_rels/.rels", RELS.format(
+            f'<Relationship Id="rId1" Type="{OFFICE_DOCUMENT}" Target="word/document.xml"/>'))
+        docx.writestr("word/document.xml",
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                      f'<w:body>{body}</w:body></w:document>')
+
+
+def make_xlsx(path, rows):
+    data = "".join(f'<row r="{r}"><c r="A{r}"><v>{r}</v></c><c r="B{r}"><v>{r * r}</v></c></row>'
+                   for r in range(1, rows + 1))
+    with zipfile.ZipFile(path, "w") as xlsx:
+        xlsx.writestr("[Content_Types].xml", CONTENT_TYPES.format(
+            '<Override PartName="/xl/workbook.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'))
+        xlsx.writestr("_rels/.rels", RELS.format(
+            f'<Relationship Id="rId1" Type="{OFFICE_DOCUMENT}" Target="xl/workbook.xml"/>'))
+        xlsx.writestr("xl/_rels/workbook.xml.rels", RELS.format(
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/worksheet" Target="worksheets/sheet1.xml"/>'))
+        xlsx.writestr("xl/workbook.xml",
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                      'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                      '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        xlsx.writestr("xl/worksheets/sheet1.xml",
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                      f'<sheetData>{data}</sheetData></worksheet>')
+
+
+class ColdLibreOffice:
+    """Прежний способ без пула для сравнения: новый soffice на каждый документ."""
+
+    name = "soffice per file"
+
+    async def convert(self, path, output_dir):
+        profile = tempfile.mkdtemp(prefix="lo_cold_")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                LIBREOFFICE_BINARY, "--headless", "--norestore", f"-env:UserInstallation=file://{profile}",
+                "--convert-to", "pdf", "--outdir", output_dir, path,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await process.wait()
+        finally:
+            shutil.rmtree(profile, ignore_errors=True)
+
+
+def samples(args, directory):
+    files = []
+    for i in range(args.copies):
+        files.append(os.path.join(directory, f"handout{i}.docx"))
+        make_docx(files[-1], args.paragraphs)
+        files.append(os.path.join(directory, f"table{i}.xlsx"))
+        make_xlsx(files[-1], args.rows)
+    if args.samples:
+        # PPTX и настоящие задания студентов кладутся в папку --samples
+        for name in sorted(os.listdir(args.samples)):
+            for i in range(args.copies):
+                stem, ext = os.path.splitext(name)
+                files.append(os.path.join(directory, f"{stem}_{i}{ext}"))
+                shutil.copy(os.path.join(args.samples, name), files[-1])
+    return files
+
+
+async def measure(converter, files, args):
+    latencies = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(path):
+        async with semaphore:
+            start = time.perf_counter()
+            await converter.convert(path, os.path.dirname(path))
+            latencies.setdefault(os.path.splitext(path)[1], []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(path) for path in files))
+    elapsed = time.perf_counter() - start
+    for ext, values in sorted(latencies.items()):
+        values.sort()
+        print(f"{converter.name:>18} {ext:>5}: p50 {values[len(values) // 2]:6.2f}s, "
+              f"p99 {values[min(len(values) - 1, int(len(values) * 0.99))]:6.2f}s")
+    print(f"{converter.name:>18}   all: {len(files) / elapsed:.2f} documents/s")
+
+
+async def run(args):
+    converters = []
+    pool = LibreOfficeConverter(workers=args.workers)
+    if pool.available():
+        converters += [ColdLibreOffice(), pool]
+    else:
+        print("LibreOffice/unoconv not found, skipping local engines")
+    if ILovePdfConverter().available() and args.ilovepdf:
+        converters.append(ILovePdfConverter(concurrency=args.concurrency))
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = samples(args, directory)
+        try:
+            if pool.available():
+                await pool.start()
+            for converter in converters:
+                await measure(converter, files, args)
+        finally:
+            await pool.close()
+
+
+parser = argparse.ArgumentParser(description="PDF conversion latency and throughput per engine")
+parser.add_argument("--copies", type=int, default=10, help="copies of every sample")
+parser.add_argument("--paragraphs", type=int, default=200)
+parser.add_argument("--rows", type=int, default=500)
+parser.add_argument("--samples", help="directory with extra DOCX/PPTX/XLSX files")
+parser.add_argument("--workers", type=int, default=2)
+parser.add_argument("--concurrency", type=int, default=4)
+parser.add_argument("--ilovepdf", action="store_true", help="also measure iLovePDF (uses API quota)")
+asyncio.run(run(parser.parse_args()))
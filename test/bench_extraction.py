@@ -0,0 +1,106 @@
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+import clients  # noqa: E402
+import extraction  # noqa: E402
+import files  # noqa: E402
+from test_extraction import make_docx, make_pdf  # noqa: E402
+
+RUNS = 5
+ANSWER_TOKENS = 800
+# Канал до Google, обработка в Files API и конвертация LibreOffice: типичные значения из логов бота
+RTT = 0.15
+BANDWIDTH = 4 * 1024 * 1024  # байт/с
+PROCESSING_SECONDS = 2.0
+CONVERT_SECONDS = 2.5
+# Модель задержки ответа: фиксированная часть, чтение входа и генерация
+GEMINI = SimpleNamespace(base=0.8, input_per_second=20000, output_per_second=80, input_price=1.25, output_price=5.0)
+GROQ = SimpleNamespace(base=0.3, input_per_second=100000, output_per_second=250, input_price=0.59, output_price=0.79)
+# Gemini считает страницу PDF как 258 токенов независимо от текста на ней
+GEMINI_PAGE_TOKENS = 258
+PROMPT_TOKENS = 300
+
+
+class FakeGemini:
+    def __init__(self):
+        self.ready_at = {}
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(RTT + os.path.getsize(path) / BANDWIDTH)
+        self.ready_at[path] = time.monotonic() + PROCESSING_SECONDS
+        return SimpleNamespace(name=path, display_name=path, uri=f"fake://{path}")
+
+    def get_file(self, name):
+        time.sleep(RTT)
+        state = "ACTIVE" if time.monotonic() >= self.ready_at[name] else "PROCESSING"
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), expiration_time=None)
+
+
+def answer(provider, input_tokens):
+    latency = provider.base + input_tokens / provider.input_per_second + ANSWER_TOKENS / provider.output_per_second
+    cost = (input_tokens * provider.input_price + ANSWER_TOKENS * provider.output_price) / 1e6
+    return latency, cost
+
+
+async def gemini_route(path, pages, convert):
+    start = time.perf_counter()
+    if convert:
+        await asyncio.sleep(CONVERT_SECONDS)
+    uploaded = await files.upload_to_gemini(path, mime_type="application/pdf")
+    await files.wait_for_files_active([uploaded])
+    latency, cost = answer(GEMINI, PROMPT_TOKENS + pages * GEMINI_PAGE_TOKENS)
+    return time.perf_counter() - start + latency, cost
+
+
+async def text_route(path, name, sha256):
+    start = time.perf_counter()
+    result = await extraction.extract_text(path, {"name": name, "sha256": sha256, "size": os.path.getsize(path)})
+    assert extraction.is_extracted_text(result), result
+    extracted = time.perf_counter() - start
+    latency, cost = answer(GROQ, PROMPT_TOKENS + result["tokens"])
+    return extracted + latency, cost, result["tokens"], extracted
+
+
+async def bench():
+    clients._genai = FakeGemini()
+    extraction.redis = fakeredis.FakeAsyncRedis()
+    await extraction.start_extraction_pool()
+    line = "Task {} line {}: find the derivative and the extrema of the given function on the interval"
+    print(f"{'document':>12} {'tokens':>7}  {'Gemini p50':>10} {'cost':>8}  {'text p50':>8} {'cost':>8}  "
+          f"{'extract':>8} {'cached':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        documents = [
+            (make_pdf(os.path.join(tmp, "task.pdf"), [[line.format(p, i) for i in range(25)] for p in range(3)]),
+             "task.pdf", 3, False),
+            (make_docx(os.path.join(tmp, "task.docx"), [line.format(0, i) for i in range(40)]), "task.docx", 2, True),
+        ]
+        for path, name, pages, convert in documents:
+            timings = {"gemini": [], "text": [], "extract": [], "cached": []}
+            for run in range(RUNS):
+                latency, gemini_cost = await gemini_route(path, pages, convert)
+                timings["gemini"].append(latency)
+                # Новый sha256 на каждый прогон: замеряется извлечение, а не кэш
+                latency, text_cost, tokens, extracted = await text_route(path, name, f"{name}{run}")
+                timings["text"].append(latency)
+                timings["extract"].append(extracted)
+                timings["cached"].append((await text_route(path, name, f"{name}{run}"))[3])
+            print(f"{name:>12} {tokens:>7}  {statistics.median(timings['gemini']):>8.2f} s ${gemini_cost:>7.5f}  "
+                  f"{statistics.median(timings['text']):>6.2f} s ${text_cost:>7.5f}  "
+                  f"{statistics.median(timings['extract']) * 1000:>5.0f} ms "
+                  f"{statistics.median(timings['cached']) * 1000:>5.1f} ms")
+    await extraction.close_extraction_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
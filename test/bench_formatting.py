@@ -0,0 +1,18 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from formatting import format_message  # noqa: E402
+from test_formatting import LLM_RESPONSE  # noqa: E402
+
+for size in (8_000, 64_000, 512_000):
+    text = (LLM_RESPONSE * (size // len(LLM_RESPONSE) + 1))[:size]
+    runs = max(1, 2_000_000 // size)
+    start = time.perf_counter()
+    for _ in range(runs):
+        format_message(text)
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{size:>7} chars: {elapsed * 1000:8.2f} ms/response, {size / elapsed / 1e6:.2f} M chars/s")
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+import clients  # noqa: E402
+import files  # noqa: E402
+
+RUNS = 5
+# Канал до Google и время обработки файла в Files API: типичные значения из логов бота
+RTT = 0.15
+BANDWIDTH = 4 * 1024 * 1024  # байт/с
+PROCESSING_SECONDS = 2.0
+SIZES = [(1280, 960), (2560, 1920), (4000, 3000)]
+
+
+class FakeGemini:
+    """Files API: загрузка зависит от размера, после нее файл какое-то время в PROCESSING."""
+
+    def __init__(self):
+        self.ready_at = {}
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(RTT + os.path.getsize(path) / BANDWIDTH)
+        self.ready_at[path] = time.monotonic() + PROCESSING_SECONDS
+        return SimpleNamespace(name=path, display_name=path, uri=f"fake://{path}")
+
+    def get_file(self, name):
+        time.sleep(RTT)
+        state = "ACTIVE" if time.monotonic() >= self.ready_at[name] else "PROCESSING"
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), expiration_time=None)
+
+
+def photo(path, size):
+    # Шум сжимается плохо, как настоящая фотография конспекта
+    Image.effect_noise(size, 40).convert("RGB").save(path, format="JPEG", quality=90)
+
+
+async def files_api(path):
+    uploaded = await files.upload_to_gemini(path, mime_type="image/jpeg")
+    await files.wait_for_files_active([uploaded])
+    # В запросе к модели только ссылка на файл
+    await asyncio.sleep(RTT)
+
+
+async def inline(path):
+    image = await files.prepare_inline_image(path)
+    # Байты изображения едут в теле запроса к модели
+    await asyncio.sleep(RTT + len(image["data"]) / BANDWIDTH)
+    return len(image["data"])
+
+
+async def bench():
+    clients._genai = FakeGemini()
+    print(f"{'photo':>10} {'size':>9}  {'Files API p50':>13}  {'inline p50':>10}  {'inline bytes':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in SIZES:
+            path = os.path.join(tmp, f"{size[0]}x{size[1]}.jpg")
+            photo(path, size)
+            timings = {"files": [], "inline": []}
+            for _ in range(RUNS):
+                start = time.perf_counter()
+                await files_api(path)
+                timings["files"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                sent = await inline(path)
+                timings["inline"].append(time.perf_counter() - start)
+            print(f"{size[0]:>4}x{size[1]:<5} {os.path.getsize(path) // 1024:>6} KB  "
+                  f"{statistics.median(timings['files']) * 1000:>10.0f} ms  "
+                  f"{statistics.median(timings['inline']) * 1000:>7.0f} ms  {sent // 1024:>9} KB")
+
+
+asyncio.run(bench())
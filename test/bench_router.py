@@ -0,0 +1,80 @@
+import argparse
+import logging
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from router import ProviderRouter, ProvidersUnavailable  # noqa: E402
+from test_router import MODELS, run_providers  # noqa: E402
+
+
+def provider_behaviour(args):
+    # Обычно быстрый ответ, изредка долгий хвост и транзиентные ошибки
+    def delay():
+        return args.stall if random.random() < args.stall_rate else random.uniform(0.02, 0.08)
+
+    return {"delay": delay, "errors": [503 if random.random() < args.error_rate else 0 for _ in range(10_000)]}
+
+
+async def single_model(ask, args):
+    # Прежнее поведение: та же модель до 5 раз с фиксированной паузой
+    for _ in range(5):
+        try:
+            return await ask(MODELS[0])
+        except Exception:
+            await asyncio.sleep(args.fixed_sleep)
+    raise ProvidersUnavailable()
+
+
+async def measure(name, request, args):
+    latencies = []
+    failed = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        nonlocal failed
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await request()
+            except ProvidersUnavailable:
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{name:>22}: p50 {latencies[len(latencies) // 2] * 1000:7.1f}ms, "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:7.1f}ms, "
+          f"failed {failed}, {len(latencies) / elapsed:.0f} req/s")
+
+
+async def run(args):
+    logging.disable(logging.WARNING)
+    random.seed(1)
+    ask, close = await run_providers(**{model: provider_behaviour(args) for model in MODELS})
+    try:
+        await measure("single model, fixed", lambda: single_model(ask, args), args)
+        router = ProviderRouter(fallbacks={}, attempts=2, backoff_base=0.05)
+        await measure("router", lambda: router.run(MODELS[0], ask, MODELS), args)
+        router = ProviderRouter(fallbacks={}, attempts=2, backoff_base=0.05, hedge_delay=args.hedge_delay)
+        await measure("router + hedging", lambda: router.run(MODELS[0], ask, MODELS, hedge=True), args)
+    finally:
+        await close()
+
+
+parser = argparse.ArgumentParser(description="Tail latency of the provider router against fake providers")
+parser.add_argument("--requests", type=int, default=1000)
+parser.add_argument("--concurrency", type=int, default=10)
+parser.add_argument("--error-rate", type=float, default=0.05)
+parser.add_argument("--stall-rate", type=float, default=0.02)
+parser.add_argument("--stall", type=float, default=2.0, help="seconds a stalled response takes")
+parser.add_argument("--fixed-sleep", type=float, default=5.0, help="pause between retries in the old loop")
+parser.add_argument("--hedge-delay", type=float, default=0.2)
+asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,59 @@
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from formatting import format_message, split_message, TELEGRAM_MESSAGE_LIMIT  # noqa: E402
+from test_formatting import LLM_RESPONSE, assert_valid_markdown_v2  # noqa: E402
+
+
+def send(stats, text, markdown=True):
+    """Фейковый sendMessage: отклоняет длинный текст и некорректный MarkdownV2, как Telegram."""
+    stats["calls"] += 1
+    if len(text) > TELEGRAM_MESSAGE_LIMIT:
+        stats["rejected"] += 1
+        return False
+    if markdown:
+        try:
+            assert_valid_markdown_v2(text)
+        except AssertionError:
+            stats["rejected"] += 1
+            return False
+    else:
+        stats["plain"] += 1
+    return True
+
+
+def send_fixed_offsets(stats, text):
+    # Прежняя отправка: целиком, затем куски по 4000 символов с починкой блоков кода
+    if send(stats, text):
+        return
+    lang = ""
+    for chunk in (text[i:i + 4000] for i in range(0, len(text), 4000)):
+        if send(stats, chunk):
+            continue
+        parts = chunk.split("```")
+        if len(parts) > 1 and parts[1].split("\n")[0] != "":
+            lang = parts[1].split("\n")[0]
+            chunk = chunk + "\n```"
+        else:
+            chunk = f"```{lang}\n" + chunk
+        if not send(stats, chunk):
+            send(stats, chunk, markdown=False)
+
+
+def send_split(stats, text):
+    for chunk in split_message(text):
+        if not send(stats, chunk):
+            send(stats, chunk, markdown=False)
+
+
+for size in (4_000, 8_000, 20_000, 64_000):
+    text = format_message((LLM_RESPONSE * (size // len(LLM_RESPONSE) + 1))[:size])
+    for name, strategy in (("fixed offsets", send_fixed_offsets), ("split_message", send_split)):
+        stats = Counter()
+        strategy(stats, text)
+        print(f"{size:>6} chars, {name:>13}: {stats['calls']:>3} calls, {stats['rejected']:>3} rejected, "
+              f"{stats['plain']:>3} sent without formatting")
@@ -0,0 +1,32 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# Каталог приложения можно передать аргументом, чтобы сравнить с другой версией
+APP = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "app")
+RUNS = int(os.getenv('BENCH_RUNS', 5))
+ENV = {
+    "TELEGRAM_BOT_TOKEN": "123:abc", "API_SERVER_URL": "http://localhost:8081", "REDIS_URL": "redis://localhost",
+    "MODEL_CHOICES": "llama-3.1-70b-versatile,llama-3.1-8b-instant,a,b,gemini-1.5-pro", "GEMINI_API_KEY": "bench",
+}
+REPORT = ["main", "aiogram", "clients", "files", "conversion", "states", "google.generativeai", "groq", "pylovepdf",
+          "PIL"]
+
+
+def run():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-W", "ignore", "-c", "import main"],
+                            cwd=APP, env={**os.environ, **ENV}, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, name = line.split("|")
+            modules.setdefault(name.strip(), int(cumulative))
+    return modules
+
+
+runs = [run() for _ in range(RUNS)]
+print(f"{'module':22} {'cumulative, ms (median of ' + str(RUNS) + ')':>32}")
+for name in REPORT:
+    times = [modules[name] for modules in runs if name in modules]
+    print(f"{name:22} {statistics.median(times) / 1000 if times else 0:>32.0f}")
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import sys
+from collections import Counter
+
+import fakeredis
+from redis.asyncio.client import Pipeline
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import states  # noqa: E402
+
+TURN = "Объясни, пожалуйста, как решать квадратные уравнения через дискриминант. " * 4
+FILE = {"name": "Задание 3.docx", "id": "BQACAgIAAxkBAAI" * 4, "mimetype": "application/msword",
+        "size": 123456, "sha256": "ab" * 32, "pdf_name": "Задание 3.pdf", "gemini_name": "files/abc123"}
+HISTORY = 100
+MESSAGES = 50
+
+
+def size(value):
+    if isinstance(value, (bytes, str)):
+        return len(value.encode() if isinstance(value, str) else value)
+    if isinstance(value, (list, tuple)):
+        return sum(size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(size(k) + size(v) for k, v in value.items())
+    return len(str(value))
+
+
+class CountingRedis(fakeredis.FakeAsyncRedis):
+    """Считает обращения к Redis (pipeline - одно) и байты запросов и ответов."""
+
+    stats = Counter()
+
+    async def execute_command(self, *args, **options):
+        result = await super().execute_command(*args, **options)
+        if not getattr(self, "_in_pipeline", False):
+            self.stats["round_trips"] += 1
+            self.stats["sent"] += size(args)
+            self.stats["received"] += size(result)
+        return result
+
+
+_execute = Pipeline.execute
+
+
+async def counting_execute(self, raise_on_error=True):
+    CountingRedis.stats["round_trips"] += 1
+    CountingRedis.stats["sent"] += sum(size(args) for args, _ in self.command_stack)
+    result = await _execute(self, raise_on_error)
+    CountingRedis.stats["received"] += size(result)
+    return result
+
+
+Pipeline.execute = counting_execute
+
+
+async def separate_keys_turn(redis, user_id, with_file):
+    # Прежний ход: модель, контекст и файлы под разными ключами в JSON
+    await redis.get(f"{user_id}_model")
+    await redis.lrange(f"{user_id}_context", -200, -1)
+    if with_file:
+        files = json.loads(await redis.get(f"{user_id}_files") or "[]")
+        await redis.set(f"{user_id}_files", json.dumps(files[-5:] + [FILE]))
+        await redis.set(f"{user_id}_model", "gemini-1.5-pro")
+    turns = [{"role": "user", "content": TURN}, {"role": "assistant", "content": TURN}]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(f"{user_id}_context", *(json.dumps(turn) for turn in turns))
+        pipe.ltrim(f"{user_id}_context", -200, -1)
+        pipe.expire(f"{user_id}_context", 3600)
+        await pipe.execute()
+
+
+async def state_turn(user_id, with_file):
+    state = await states.load_user_state(user_id)
+    files = state["files"][-5:] + [FILE] if with_file else None
+    turns = [{"role": "user", "content": TURN}, {"role": "assistant", "content": TURN}]
+    await states.save_user_state(user_id, state, turns=turns, files=files,
+                                 model="gemini-1.5-pro" if with_file else None)
+
+
+async def bench():
+    redis = CountingRedis()
+    states.redis = redis
+    print("layout               message  round trips  bytes sent  bytes received")
+    for compression in (None, "zstd"):
+        states._compressor = states.zstandard.ZstdCompressor(level=3) if compression else None
+        for with_file in (False, True):
+            await redis.flushall()
+            for _ in range(HISTORY // 2):
+                await separate_keys_turn(redis, "old", with_file)
+                await state_turn("new", with_file)
+            rows = [("separate keys, JSON", lambda: separate_keys_turn(redis, "old", with_file)),
+                    (f"hash, msgpack{'+zstd' if compression else ''}", lambda: state_turn("new", with_file))]
+            for name, turn in rows:
+                if compression and name.startswith("separate"):
+                    continue
+                CountingRedis.stats.clear()
+                for _ in range(MESSAGES):
+                    await turn()
+                stats = CountingRedis.stats
+                print(f"{name:20} {'file' if with_file else 'text':>8}  {stats['round_trips'] / MESSAGES:11.1f}  "
+                      f"{stats['sent'] / MESSAGES:10.0f}  {stats['received'] / MESSAGES:14.0f}")
+    # Объем хранения на пользователя со 100 репликами
+    print(f"stored: separate keys {size(await redis.lrange('old_context', 0, -1))} bytes, "
+          f"hash {size(await redis.hgetall('new_state'))} bytes")
+
+
+asyncio.run(bench())
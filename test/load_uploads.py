@@ -0,0 +1,75 @@
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "load-test")
+os.environ.setdefault("FILE_POLL_INITIAL_DELAY", "0.2")
+
+import clients  # noqa: E402
+import files  # noqa: E402
+
+UPLOADS = 5
+UPLOAD_SECONDS = 2.0
+PROCESSING_POLLS = 3
+
+
+class FakeGemini:
+    """Синхронный SDK: каждый вызов блокирует поток, как настоящий genai."""
+
+    def __init__(self):
+        self.polls = {}
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(UPLOAD_SECONDS)
+        return SimpleNamespace(name=path, display_name=path, uri=f"fake://{path}")
+
+    def get_file(self, name):
+        time.sleep(0.05)
+        self.polls[name] = self.polls.get(name, 0) + 1
+        state = "ACTIVE" if self.polls[name] > PROCESSING_POLLS else "PROCESSING"
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state))
+
+
+async def upload(i):
+    uploaded = await files.upload_to_gemini(f"files/doc-{i}.pdf", mime_type="application/pdf")
+    await files.wait_for_files_active([uploaded])
+
+
+async def text_chat(latencies, stop):
+    # Имитация текстового сообщения: несколько await без блокирующей работы
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.05)
+        latencies.append(time.perf_counter() - start - 0.05)
+
+
+async def run(blocking):
+    clients._genai = FakeGemini()
+    latencies = []
+    stop = asyncio.Event()
+    chat = asyncio.create_task(text_chat(latencies, stop))
+    start = time.perf_counter()
+    if blocking:
+        # Поведение до переноса в пул: SDK вызывается прямо в event loop
+        for i in range(UPLOADS):
+            clients.gemini_sdk().upload_file(f"files/doc-{i}.pdf")
+            await asyncio.sleep(0)
+    else:
+        await asyncio.gather(*(upload(i) for i in range(UPLOADS)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await chat
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{'blocking' if blocking else 'executor'}: {UPLOADS} uploads in {elapsed:.1f}s, "
+          f"chat lag median {statistics.median(latencies) * 1000:.1f}ms, "
+          f"p99 {p99 * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+
+
+asyncio.run(run(blocking=True))
+asyncio.run(run(blocking=False))
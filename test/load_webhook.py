@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Load{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def post(session, url, secret, update, latencies, statuses):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=update, headers=headers) as response:
+            await response.read()
+            statuses[response.status] += 1
+    except aiohttp.ClientError as e:
+        statuses[type(e).__name__] += 1
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(args):
+    updates = []
+    base_id = int(time.time() * 1000)
+    for i in range(args.updates):
+        updates.append(make_update(base_id + i, 100000 + i % args.users, f"Сообщение нагрузочного теста {i}"))
+    # Повторная доставка тех же update_id, как при ретраях Telegram
+    updates += random.sample(updates, int(len(updates) * args.duplicates))
+    random.shuffle(updates)
+
+    latencies = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def worker(update):
+        async with semaphore:
+            await post(session, args.url, args.secret, update, latencies, statuses)
+
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(update) for update in updates))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"sent {len(updates)} updates ({args.updates} unique) in {elapsed:.2f}s, "
+          f"{len(updates) / elapsed:.0f} updates/s")
+    print(f"p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f}ms")
+    print("responses:", dict(statuses))
+
+
+parser = argparse.ArgumentParser(description="Posts synthetic Telegram updates to the bot webhook")
+parser.add_argument("--url", default="http://localhost:8080/webhook")
+parser.add_argument("--secret", default=None)
+parser.add_argument("--updates", type=int, default=1000)
+parser.add_argument("--users", type=int, default=50)
+parser.add_argument("--concurrency", type=int, default=50)
+parser.add_argument("--duplicates", type=float, default=0.1, help="share of updates delivered twice")
+asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,451 @@
+"""Офлайн-прогон бота: обновления Telegram идут прямо в Dispatcher, внешние сервисы заменены фейками.
+
+Bot API и Groq - локальные HTTP-серверы, Gemini - фейковый SDK (настоящий ходит по gRPC),
+конвертация - фейковый движок, Redis - fakeredis или локальный сервер (--redis-url).
+Задержки и доля ошибок настраиваются, случайность фиксирована --seed, поэтому прогоны сравнимы:
+
+    python test/replay.py --updates 300 --json before.json
+    python test/replay.py --updates 300 --compare before.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+import redis.asyncio
+from aiohttp import web
+from google.api_core.exceptions import ServiceUnavailable
+
+APP = os.path.join(os.path.dirname(__file__), "..", "app")
+sys.path.insert(0, APP)
+
+TOKEN = "123456:replay"
+for name, value in {
+    "TELEGRAM_BOT_TOKEN": TOKEN, "API_SERVER_URL": "http://127.0.0.1:1", "REDIS_URL": "redis://localhost",
+    "MODEL_CHOICES": "llama-3.3-70b-versatile,llama-3.1-8b-instant,gemma2-9b-it,mixtral-8x7b-32768,gemini-1.5-pro",
+    "GROQ_API_KEY": "replay", "GEMINI_API_KEY": "replay", "PDF_CONVERTERS": "libreoffice",
+    "LOG_LEVEL": "ERROR", "REACHABILITY_TTL": "1e9",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline replay of Telegram updates through the bot pipeline")
+    parser.add_argument("--updates", type=int, default=200, help="number of synthetic updates")
+    parser.add_argument("--replay", help="JSONL file with recorded Telegram updates instead of synthetic ones")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--documents", type=float, default=0.1, help="share of updates with a .docx")
+    parser.add_argument("--scanned", type=float, default=0.3,
+                        help="share of documents whose tasks are in pictures and need Gemini")
+    parser.add_argument("--photos", type=float, default=0.1, help="share of updates with a photo")
+    parser.add_argument("--rate", type=float, default=0, help="arrivals per second, 0 - all at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot-api-latency", type=float, default=0.03)
+    parser.add_argument("--llm-first-token", type=float, default=0.4)
+    parser.add_argument("--llm-tokens", type=int, default=300, help="tokens per answer")
+    parser.add_argument("--llm-token-interval", type=float, default=0.005)
+    parser.add_argument("--upload-latency", type=float, default=0.5)
+    parser.add_argument("--processing-latency", type=float, default=0)
+    parser.add_argument("--convert-latency", type=float, default=1.0)
+    parser.add_argument("--groq-errors", type=float, default=0, help="share of Groq requests answered 503")
+    parser.add_argument("--gemini-errors", type=float, default=0, help="share of Gemini requests failing with 503")
+    parser.add_argument("--markdown-errors", type=float, default=0,
+                        help="share of MarkdownV2 messages rejected by the Bot API")
+    parser.add_argument("--redis-url", help="real Redis instead of fakeredis")
+    parser.add_argument("--json", help="save the report to this file")
+    parser.add_argument("--compare", help="print the difference with a saved report")
+    return parser.parse_args(argv)
+
+
+class FakeBotApi:
+    """Локальный Bot API: запоминает вызовы, отвечает с задержкой и по заказу отклоняет MarkdownV2."""
+
+    def __init__(self, args, rng, root):
+        self.args = args
+        self.rng = rng
+        self.root = root
+        self.calls = Counter()
+        self.message_id = 1000000
+        self.files = {}
+
+    def message(self, chat_id, text=None):
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()), "text": text or "",
+                "chat": {"id": int(chat_id), "type": "private"}}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        await asyncio.sleep(self.args.bot_api_latency)
+        if (data.get("parse_mode") == "MarkdownV2" and method in ("sendMessage", "editMessageText")
+                and self.rng.random() < self.args.markdown_errors):
+            self.calls[f"{method}:rejected"] += 1
+            return web.json_response({"ok": False, "error_code": 400,
+                                      "description": "Bad Request: can't parse entities"}, status=400)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self.message(data.get("chat_id", 0), data.get("text"))
+        elif method == "getFile":
+            result = self.get_file(data["file_id"])
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def get_file(self, file_id):
+        # Локальный Bot API кладет файл на общий том; бот забирает его переименованием
+        name, content = self.files[file_id]
+        folder = "photos" if name.endswith(".jpg") else "documents"
+        os.makedirs(os.path.join(self.root, TOKEN, folder), exist_ok=True)
+        path = os.path.join(self.root, TOKEN, folder, f"{file_id}_{name}")
+        with open(path, "wb") as f:
+            f.write(content)
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(content), "file_path": path}
+
+
+class FakeGroq:
+    """OpenAI-совместимый стрим Groq с usage в x_groq последнего чанка."""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.calls = Counter()
+
+    async def completions(self, request):
+        body = await request.json()
+        if self.rng.random() < self.args.groq_errors:
+            self.calls["error"] += 1
+            return web.json_response({"error": {"message": "fake overload"}}, status=503)
+        self.calls["ok"] += 1
+        await asyncio.sleep(self.args.llm_first_token)
+        base = {"id": "replay", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"]}
+        usage = {"prompt_tokens": sum(len(str(m["content"])) for m in body["messages"]) // 3,
+                 "completion_tokens": self.args.llm_tokens, "total_tokens": 0}
+        if not body.get("stream"):
+            return web.json_response({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer(self.args)}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in answer(self.args).split(" "):
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.args.llm_token_interval)
+        last = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {"id": "replay", "usage": usage}}
+        await response.write(f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n".encode())
+        return response
+
+
+def answer(args):
+    # Ответ с разметкой, как у настоящей модели: форматирование тоже входит в замер
+    return " ".join(["**Ответ:**" if i == 0 else f"`x{i}`" if i % 25 == 0 else "слово" for i in range(args.llm_tokens)])
+
+
+class FakeGeminiError(ServiceUnavailable):
+    """Перегрузка Gemini: настоящий SDK бросает исключения google.api_core."""
+
+
+class FakeGemini:
+    """SDK google.generativeai в объеме, который использует бот."""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.calls = Counter()
+        self.ready_at = {}
+        self.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=self.create_cache))
+        gemini = self
+
+        class GenerativeModel:
+            def __init__(self, model_name, generation_config=None, system_instruction=None):
+                self.model_name = model_name
+
+            @classmethod
+            def from_cached_content(cls, cached_content, generation_config=None):
+                return cls(cached_content)
+
+            def start_chat(self, history=None):
+                return SimpleNamespace(send_message_async=gemini.send_message_async)
+
+        self.GenerativeModel = GenerativeModel
+
+    def configure(self, **kwargs):
+        pass
+
+    def GenerationConfig(self, **kwargs):
+        return kwargs
+
+    def upload_file(self, path, mime_type=None):
+        self.calls["upload"] += 1
+        time.sleep(self.args.upload_latency)
+        name = f"files/{self.calls['upload']}"
+        self.ready_at[name] = time.monotonic() + self.args.processing_latency
+        return self.get_file(name)
+
+    def get_file(self, name):
+        state = "ACTIVE" if time.monotonic() >= self.ready_at.get(name, 0) else "PROCESSING"
+        return SimpleNamespace(name=name, display_name=name, uri=f"fake://{name}", expiration_time=None,
+                               state=SimpleNamespace(name=state))
+
+    def create_cache(self, **kwargs):
+        raise FakeGeminiError("context caching is not simulated")
+
+    async def send_message_async(self, message, stream=False):
+        if self.rng.random() < self.args.gemini_errors:
+            self.calls["error"] += 1
+            raise FakeGeminiError("fake overload")
+        self.calls["ok"] += 1
+        await asyncio.sleep(self.args.llm_first_token)
+        words = answer(self.args).split(" ")
+        usage = SimpleNamespace(prompt_token_count=1000, candidates_token_count=len(words))
+        if not stream:
+            return SimpleNamespace(text=" ".join(words), usage_metadata=usage)
+        return FakeGeminiStream(words, usage, self.args.llm_token_interval)
+
+
+class FakeGeminiStream:
+    def __init__(self, words, usage, interval):
+        self.words = words
+        self.usage_metadata = usage
+        self.interval = interval
+        self.text = " ".join(words)
+
+    async def __aiter__(self):
+        for word in self.words:
+            await asyncio.sleep(self.interval)
+            yield SimpleNamespace(text=word + " ")
+
+
+class FakeConverter:
+    name = "libreoffice"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def available(self):
+        return True
+
+    async def convert(self, path, output_dir):
+        await asyncio.sleep(self.latency)
+        pdf_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(b"%PDF-1.4 replay")
+        return pdf_path
+
+    async def close(self):
+        pass
+
+
+class StageRecorder:
+    """Подменяет гистограмму этапов и хранит сами замеры, чтобы считать перцентили."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def labels(self, name, model=""):
+        return SimpleNamespace(observe=self.samples[name].append)
+
+
+def sample_photo():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.effect_noise((1280, 960), 40).convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def sample_docx(number, images):
+    # Задания текстом или, как в отсканированной методичке, картинками
+    w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+    body = "".join(f"<w:p><w:r><w:t>Задание {number}.{i}. Вычислите интеграл и объясните решение.</w:t></w:r></w:p>"
+                   for i in range(1 if images else 30))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as docx:
+        docx.writestr("word/document.xml", f"<w:document {w}><w:body>{body}</w:body></w:document>")
+        for i in range(images):
+            docx.writestr(f"word/media/image{i}.png", b"png")
+    return buffer.getvalue()
+
+
+def synthetic_updates(args, rng, bot_api):
+    photo = sample_photo()
+    updates = []
+    base = 500000000
+    for i in range(args.updates):
+        user_id = 700000 + i % args.users
+        message = {"message_id": i + 1, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": f"Replay{user_id}"}}
+        kind = rng.random()
+        if kind < args.documents:
+            file_id = f"doc{i}"
+            bot_api.files[file_id] = ("task.docx", sample_docx(i, 5 if rng.random() < args.scanned else 0))
+            message.update(caption="Реши задания", document={
+                "file_id": file_id, "file_unique_id": file_id, "file_name": "task.docx",
+                "file_size": len(bot_api.files[file_id][1]),
+                "mime_type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"})
+        elif kind < args.documents + args.photos:
+            file_id = f"photo{i}"
+            bot_api.files[file_id] = ("photo.jpg", photo)
+            message.update(caption="Что на фото?", photo=[{"file_id": file_id, "file_unique_id": file_id,
+                                                             "width": 1280, "height": 960, "file_size": len(photo)}])
+        else:
+            message["text"] = f"Объясни тему номер {rng.randint(1, 50)}, пожалуйста"
+        updates.append({"update_id": base + i, "message": message})
+    return updates
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+
+async def start_server(routes):
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+async def replay(args):
+    rng = random.Random(args.seed)
+    if not args.redis_url:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server)
+    else:
+        os.environ["REDIS_URL"] = args.redis_url
+
+    root = tempfile.mkdtemp(prefix="replay_")
+    bot_api = FakeBotApi(args, rng, root)
+    groq = FakeGroq(args, rng)
+    bot_runner, bot_url = await start_server([("POST", "/bot{token}/{method}", bot_api.handle)])
+    groq_runner, groq_url = await start_server([("POST", "/openai/v1/chat/completions", groq.completions)])
+    os.environ["GROQ_BASE_URL"] = groq_url
+
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    import clients
+    import conversion
+    import extraction
+    import files
+    import main
+    import metrics
+    from webhook import update_guard
+
+    gemini = FakeGemini(args, rng)
+    clients._genai = gemini
+    files.BOT_API_ROOT = root
+    conversion._converters["libreoffice"] = FakeConverter(args.convert_latency)
+    recorder = StageRecorder()
+    metrics.STAGE_SECONDS = recorder
+    main.bot.session.api = TelegramAPIServer.from_base(bot_url, is_local=True)
+    main.dp.update.outer_middleware(update_guard)
+    await extraction.start_extraction_pool()
+
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(args, rng, bot_api)
+
+    latencies = []
+    failures = Counter()
+
+    async def feed(update, delay):
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            await main.dp.feed_update(main.bot, Update.model_validate(update))
+        except Exception as e:
+            failures[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - start)
+
+    arrivals = []
+    delay = 0.0
+    for _ in updates:
+        arrivals.append(delay)
+        if args.rate:
+            delay += rng.expovariate(args.rate)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(feed(update, at) for update, at in zip(updates, arrivals)))
+    elapsed = time.perf_counter() - start
+
+    await clients.close_clients()
+    await extraction.close_extraction_pool()
+    await main.bot.session.close()
+    await bot_runner.cleanup()
+    await groq_runner.cleanup()
+
+    return {
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(len(updates) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "failures": dict(failures),
+        "bot_api_calls": dict(bot_api.calls),
+        "groq_calls": dict(groq.calls),
+        "gemini_calls": dict(gemini.calls),
+        "stages": {name: {"count": len(values),
+                          "p50_ms": round(statistics.median(values) * 1000, 1),
+                          "p99_ms": round(percentile(values, 0.99) * 1000, 1)}
+                   for name, values in sorted(recorder.samples.items())},
+    }
+
+
+def print_report(report, baseline=None):
+    def delta(value, old):
+        if old is None or not old:
+            return ""
+        return f" ({(value - old) / old:+.0%})"
+
+    baseline = baseline or {}
+    print(f"{report['updates']} updates in {report['seconds']:.2f}s: "
+          f"{report['messages_per_second']:.1f} msg/s{delta(report['messages_per_second'], baseline.get('messages_per_second'))}")
+    print(f"latency p50 {report['p50_ms']:.0f} ms{delta(report['p50_ms'], baseline.get('p50_ms'))}, "
+          f"p99 {report['p99_ms']:.0f} ms{delta(report['p99_ms'], baseline.get('p99_ms'))}")
+    if report["failures"]:
+        print("failures:", report["failures"])
+    print("bot api:", report["bot_api_calls"])
+    print("groq:", report["groq_calls"], "gemini:", report["gemini_calls"])
+    print(f"{'stage':28} {'count':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    old_stages = baseline.get("stages", {})
+    for name, stage in report["stages"].items():
+        old = old_stages.get(name, {})
+        print(f"{name:28} {stage['count']:>6} {stage['p50_ms']:>9.1f} {stage['p99_ms']:>9.1f}"
+              f"{delta(stage['p50_ms'], old.get('p50_ms'))}")
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(replay(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+
+import fakeredis
+import pytest
+from aiogram import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import albums  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(albums, "redis", fakeredis.FakeAsyncRedis())
+    monkeypatch.setattr(albums, "MEDIA_GROUP_WINDOW", 0.1)
+    monkeypatch.setattr(albums, "MEDIA_GROUP_MAX_WAIT", 1)
+
+
+def album_part(message_id, group="g1", caption=None):
+    return types.Message.model_validate({
+        "message_id": message_id, "date": 0, "media_group_id": group, "caption": caption,
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+        "document": {"file_id": f"f{message_id}", "file_unique_id": f"u{message_id}", "file_name": f"{message_id}.pdf"},
+    })
+
+
+def test_first_part_collects_whole_album_in_order():
+    async def scenario():
+        async def arrive(message, delay):
+            await asyncio.sleep(delay)
+            return await albums.collect_media_group(message)
+
+        # Части приходят вразнобой и с паузами меньше окна
+        results = await asyncio.gather(arrive(album_part(11, caption="Реши"), 0), arrive(album_part(13), 0.05),
+                                       arrive(album_part(12), 0.12), arrive(album_part(99, group="g2"), 0))
+        album, late, middle, other = results
+        assert [m.message_id for m in album] == [11, 12, 13]
+        assert album[0].caption == "Реши" and album[2].document.file_name == "13.pdf"
+        assert late is None and middle is None
+        assert [m.message_id for m in other] == [99]
+
+    asyncio.run(scenario())
+
+
+def test_collection_is_bounded_by_max_wait(monkeypatch):
+    monkeypatch.setattr(albums, "MEDIA_GROUP_MAX_WAIT", 0.3)
+
+    async def scenario():
+        async def trickle():
+            # Новая часть каждые 0.05 с - окно тишины не наступает никогда
+            for message_id in range(2, 100):
+                await asyncio.sleep(0.05)
+                await albums.collect_media_group(album_part(message_id))
+
+        feeder = asyncio.create_task(trickle())
+        start = asyncio.get_running_loop().time()
+        album = await albums.collect_media_group(album_part(1))
+        feeder.cancel()
+        assert asyncio.get_running_loop().time() - start < 0.5
+        assert len(album) > 1
+
+    asyncio.run(scenario())
+
+
+def test_part_after_collection_is_answered_separately(caplog):
+    async def scenario():
+        album = await albums.collect_media_group(album_part(1))
+        # Часть пришла позже MEDIA_GROUP_MAX_WAIT: альбом уже отвечен без нее
+        late = await albums.collect_media_group(album_part(2))
+        return album, late
+
+    album, late = asyncio.run(scenario())
+    assert [m.message_id for m in album] == [1]
+    assert [m.message_id for m in late] == [2]
+    assert "arrived after the album was collected" in caplog.text
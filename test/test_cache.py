@@ -0,0 +1,70 @@
+import asyncio
+import os
+import sys
+
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import cache  # noqa: E402
+
+
+def use_fake_redis(monkeypatch, max_entries=100):
+    monkeypatch.setattr(cache, "redis", fakeredis.aioredis.FakeRedis())
+    monkeypatch.setattr(cache, "RESPONSE_CACHE_MAX_ENTRIES", max_entries)
+
+
+def test_key_ignores_case_spacing_and_edge_punctuation():
+    key = cache.response_cache_key("llama", "Что такое  производная?")
+    assert key == cache.response_cache_key("llama", "  что такое производная ")
+    assert key != cache.response_cache_key("gemini", "Что такое производная?")
+    assert key != cache.response_cache_key("llama", "Что такое производная?", "abc")
+    assert cache.response_cache_key("gemini", "Выполни задания в этом документе", "abc") == \
+        cache.response_cache_key("gemini", "выполни задания в этом документе.", "abc")
+
+
+def test_hit_miss_and_stats(monkeypatch):
+    async def scenario():
+        use_fake_redis(monkeypatch)
+        key = cache.response_cache_key("llama", "2 + 2?")
+        assert await cache.get_cached_response(key) is None
+        await cache.cache_response(key, "4")
+        assert await cache.get_cached_response(key) == "4"
+        stats = await cache.response_cache_stats()
+        assert stats["hits"] == 1 and stats["misses"] == 1 and stats["entries"] == 1
+        assert stats["hit_rate"] == 0.5
+        assert await cache.redis.ttl(key) > 0
+
+    asyncio.run(scenario())
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    async def scenario():
+        use_fake_redis(monkeypatch, max_entries=2)
+        keys = [cache.response_cache_key("llama", f"вопрос {i}") for i in range(3)]
+        await cache.cache_response(keys[0], "a")
+        await cache.cache_response(keys[1], "b")
+        await asyncio.sleep(0.01)
+        # Обращение к первой записи делает ее свежей, вытесняется вторая
+        assert await cache.get_cached_response(keys[0]) == "a"
+        await cache.cache_response(keys[2], "c")
+        assert await cache.get_cached_response(keys[1]) is None
+        assert await cache.get_cached_response(keys[0]) == "a"
+        assert (await cache.response_cache_stats())["evictions"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_purge_keeps_stats(monkeypatch):
+    async def scenario():
+        use_fake_redis(monkeypatch)
+        for i in range(3):
+            await cache.cache_response(cache.response_cache_key("llama", f"вопрос {i}"), "ответ")
+        await cache.redis.set("123_context", "не кэш")
+        assert await cache.purge_response_cache() == 3
+        stats = await cache.response_cache_stats()
+        assert stats["entries"] == 0 and stats["stores"] == 3
+        assert (await cache.redis.get("123_context")).decode() == "не кэш"
+
+    asyncio.run(scenario())
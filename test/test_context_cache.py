@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import clients  # noqa: E402
+import history  # noqa: E402
+
+MODEL = "gemini-1.5-pro-002"
+FILES = [{"sha256": "a", "gemini_name": "files/old"}, {"sha256": "b", "gemini_name": "files/doc"}]
+TURNS = [
+    {"role": "user", "content": "Привет"},
+    {"role": "assistant", "content": "Привет!"},
+    {"role": "user", "content": ["files/doc", "Выполни задания в этом документе"]},
+    {"role": "assistant", "content": "Решение..."},
+]
+
+
+class FakeGemini:
+    def __init__(self, fail=False):
+        self.created = []
+        self.fail = fail
+        self.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=self.create))
+
+    def create(self, model, system_instruction, contents, ttl):
+        if self.fail:
+            raise ValueError("400 Cached content is too small")
+        self.created.append(contents)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}",
+                               expire_time=datetime.now(timezone.utc) + ttl)
+
+    def get_file(self, name):
+        return SimpleNamespace(name=name, state=SimpleNamespace(name="ACTIVE"), expiration_time=None)
+
+
+@pytest.fixture(autouse=True)
+def fake_gemini(monkeypatch):
+    gemini = FakeGemini()
+    monkeypatch.setattr(clients, "_genai", gemini)
+    monkeypatch.setattr(history, "_cache_failures", {})
+    return gemini
+
+
+def test_small_requests_are_not_cached(fake_gemini):
+    assert asyncio.run(history.cache_context(MODEL, TURNS, FILES, 1000)) is None
+    assert not fake_gemini.created
+
+
+def test_cache_covers_history_up_to_last_document(fake_gemini):
+    files = asyncio.run(history.cache_context(MODEL, TURNS, FILES, 100000))
+    # Кэшируется начало беседы до реплики с документом включительно
+    assert len(fake_gemini.created[0]) == 3
+    assert "context_cache" not in files[0] and files[1]["context_cache"]["name"] == "cachedContents/1"
+
+    # Следующий ход: те же первые реплики и новые после них
+    later = TURNS + [{"role": "user", "content": "А второе задание?"}, {"role": "assistant", "content": "..."}]
+    assert history.find_context_cache(files, MODEL, later) == ("cachedContents/1", 3)
+    assert history.find_context_cache(files, "gemini-1.5-flash-002", later) is None
+    # Окно истории сдвинулось - начало уже другое
+    assert history.find_context_cache(files, MODEL, later[2:]) is None
+
+    # Повторно тот же кэш не создается
+    assert asyncio.run(history.cache_context(MODEL, later, files, 100000)) is None
+    assert len(fake_gemini.created) == 1
+
+
+def test_expired_cache_is_ignored(fake_gemini):
+    files = asyncio.run(history.cache_context(MODEL, TURNS, FILES, 100000))
+    files[1]["context_cache"]["expires_at"] = time.time() + history.GEMINI_CACHE_MARGIN - 1
+    assert history.find_context_cache(files, MODEL, TURNS) is None
+
+
+def test_failed_creation_is_not_retried_immediately(fake_gemini):
+    fake_gemini.fail = True
+    assert asyncio.run(history.cache_context(MODEL, TURNS, FILES, 100000)) is None
+    fake_gemini.fail = False
+    assert asyncio.run(history.cache_context(MODEL, TURNS, FILES, 100000)) is None
+    assert not fake_gemini.created
+    # Без документов в истории кэшировать нечего
+    assert asyncio.run(history.cache_context("other", TURNS[:2], FILES, 100000)) is None
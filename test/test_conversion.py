@@ -0,0 +1,114 @@
+import asyncio
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+from conversion import LibreOfficeConverter, ConversionError, convert_to_pdf  # noqa: E402
+
+# Фейковый soffice: слушает UNO-порт из --accept, пока его не убьют
+FAKE_SOFFICE = """
+import re, socket, sys, time
+port = int(re.search(r"port=(\\d+)", " ".join(sys.argv)).group(1))
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(("127.0.0.1", port))
+server.listen()
+while True:
+    server.accept()[0].close()
+"""
+
+# Фейковый unoconv: "пишет" PDF; slow - зависает, broken - падает
+FAKE_UNOCONV = """
+import os, sys, time
+path = sys.argv[-1]
+output = [a for a in sys.argv if a.startswith("--output=")][0][len("--output="):]
+name = os.path.basename(path)
+if "slow" in name:
+    time.sleep(30)
+if "broken" in name:
+    sys.exit("cannot load document")
+time.sleep(0.1)
+with open(os.path.join(output, os.path.splitext(name)[0] + ".pdf"), "w") as pdf:
+    pdf.write("%PDF-1.4")
+"""
+
+
+def script(tmp_path, name, source):
+    path = tmp_path / name
+    path.write_text(f"#!{sys.executable}\n{source}")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+@pytest.fixture
+def converter(tmp_path):
+    return LibreOfficeConverter(workers=2, binary=script(tmp_path, "soffice", FAKE_SOFFICE),
+                                unoconv=script(tmp_path, "unoconv", FAKE_UNOCONV),
+                                base_port=23000 + os.getpid() % 1000 * 2, timeout=1)
+
+
+def document(tmp_path, name):
+    (tmp_path / name).write_text("document")
+    return {"name": name, "path": str(tmp_path)}
+
+
+def test_pool_converts_with_warm_workers(converter, tmp_path):
+    async def scenario():
+        try:
+            await converter.start()
+            start = time.perf_counter()
+            names = await asyncio.gather(*(convert_to_pdf(document(tmp_path, f"doc{i}.docx"), [converter])
+                                           for i in range(4)))
+            elapsed = time.perf_counter() - start
+            assert names == [f"doc{i}.pdf" for i in range(4)]
+            # Два процесса - две волны по ~0.1 с, а не четыре
+            assert elapsed < 1
+        finally:
+            await converter.close()
+
+    asyncio.run(scenario())
+
+
+def test_timeout_restarts_worker(converter, tmp_path):
+    async def scenario():
+        try:
+            await converter.start()
+            first = converter.workers[0].process.pid, converter.workers[1].process.pid
+            with pytest.raises(ConversionError, match="timed out"):
+                await converter.convert(str(tmp_path / "slow.docx"), str(tmp_path))
+            assert any(worker.process is None for worker in converter.workers)
+            # Следующие задания запускают процесс заново и проходят
+            for i in range(2):
+                assert await convert_to_pdf(document(tmp_path, f"next{i}.xlsx"), [converter]) == f"next{i}.pdf"
+            assert (converter.workers[0].process.pid, converter.workers[1].process.pid) != first
+        finally:
+            await converter.close()
+
+    asyncio.run(scenario())
+
+
+def test_falls_back_to_next_converter(converter, tmp_path):
+    class Fallback:
+        name = "fallback"
+
+        async def convert(self, path, output_dir):
+            pdf = os.path.join(output_dir, "fallback.pdf")
+            open(pdf, "w").close()
+            return pdf
+
+    async def scenario():
+        try:
+            assert await convert_to_pdf(document(tmp_path, "broken.pptx"), [converter, Fallback()]) == "fallback.pdf"
+            with pytest.raises(ConversionError, match="cannot load document"):
+                await convert_to_pdf(document(tmp_path, "broken.pptx"), [converter])
+        finally:
+            await converter.close()
+
+    asyncio.run(scenario())
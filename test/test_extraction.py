@@ -0,0 +1,180 @@
+import asyncio
+import os
+import sys
+import zipfile
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import extraction  # noqa: E402
+import states  # noqa: E402
+
+LOREM = "Задание {}. Найдите производную функции f(x) = x^2 sin x и исследуйте ее на экстремумы."
+
+
+def make_pdf(path, pages, images=0):
+    """PDF с текстовым слоем: pages - список строк на страницах; images - картинок на первой странице."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    image_refs = []
+    for _ in range(images):
+        objects.append("<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray "
+                       "/BitsPerComponent 8 /Length 1 >>\nstream\n\x00\nendstream")
+        image_refs.append(len(objects))
+    kids = []
+    for number, lines in enumerate(pages):
+        commands = "".join(f"BT /F1 10 Tf 40 {800 - 14 * i} Td ({line}) Tj ET\n" for i, line in enumerate(lines))
+        objects.append(f"<< /Length {len(commands)} >>\nstream\n{commands}endstream")
+        content = len(objects)
+        xobjects = " ".join(f"/Im{ref} {ref} 0 R" for ref in image_refs) if number == 0 else ""
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> /XObject << {xobjects} >> >> >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def make_docx(path, paragraphs, images=0, math=False):
+    w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+    m = 'xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math"'
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>" for text in paragraphs)
+    if math:
+        body += "<w:p><m:oMath><m:r><m:t>x</m:t></m:r></m:oMath></w:p>"
+    with zipfile.ZipFile(path, "w") as docx:
+        docx.writestr("word/document.xml", f'<w:document {w} {m}><w:body>{body}</w:body></w:document>')
+        for i in range(images):
+            docx.writestr(f"word/media/image{i}.png", b"png")
+    return str(path)
+
+
+def test_pdf_text_is_extracted(tmp_path):
+    path = make_pdf(tmp_path / "task.pdf", [[f"Task {i} line {j} with enough text" for j in range(10)]
+                                            for i in range(2)])
+    result = extraction.extract_document(path, "pdf")
+    assert result["route"] == "text"
+    assert result["pages"] == 2
+    assert "Task 1 line 9" in "".join(result["chunks"])
+
+
+def test_scanned_and_image_heavy_pdfs_go_to_gemini(tmp_path):
+    scanned = make_pdf(tmp_path / "scan.pdf", [[], ["1"]])
+    assert extraction.extract_document(scanned, "pdf")["reason"] == "scanned"
+    pictures = make_pdf(tmp_path / "pictures.pdf", [[f"Line {j} of the task text here" for j in range(10)]], images=5)
+    assert extraction.extract_document(pictures, "pdf")["reason"] == "images"
+
+
+def test_large_document_stops_early(tmp_path):
+    path = make_pdf(tmp_path / "book.pdf", [[f"Page {i} line {j} " + "x" * 60 for j in range(40)] for i in range(30)])
+    result = extraction.extract_document(path, "pdf", max_tokens=2000)
+    assert result["reason"] == "too_large"
+    # Страница - около 1000 токенов: остальные 28 страниц не читаются
+    assert result["pages"] == 2
+
+
+def test_docx_text_math_and_images(tmp_path):
+    text = make_docx(tmp_path / "task.docx", [LOREM.format(i) for i in range(5)], images=1)
+    result = extraction.extract_document(text, "docx")
+    assert result["route"] == "text"
+    assert LOREM.format(4) in result["chunks"][0]
+    assert result["tokens"] == extraction.count_tokens("\n".join(LOREM.format(i) for i in range(5)))
+
+    formulas = make_docx(tmp_path / "math.docx", [LOREM.format(1)], math=True)
+    assert extraction.extract_document(formulas, "docx")["reason"] == "math"
+    pictures = make_docx(tmp_path / "pictures.docx", ["См. рисунки"], images=4)
+    assert extraction.extract_document(pictures, "docx")["reason"] == "images"
+
+
+def test_text_file_in_cp1251(tmp_path):
+    path = tmp_path / "task.txt"
+    path.write_bytes(LOREM.format(1).encode("cp1251"))
+    assert extraction.extract_document(str(path), "text")["chunks"] == [LOREM.format(1)]
+
+
+def test_chunks_follow_paragraphs_and_limit():
+    text = "\n".join(["a" * 50] * 10 + ["b" * 400])
+    chunks = extraction.chunk_text(text, max_tokens=50, chars_per_token=3)
+    assert all(len(chunk) <= 150 for chunk in chunks)
+    assert chunks[0] == "\n".join(["a" * 50] * 2)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+
+def test_extraction_kind():
+    assert extraction.extraction_kind({"name": "Lab.PDF", "mimetype": "application/pdf"}) == "pdf"
+    assert extraction.extraction_kind({"name": "task.docx"}) == "docx"
+    assert extraction.extraction_kind({"name": "notes", "mimetype": "text/plain"}) == "text"
+    assert extraction.extraction_kind({"name": "slides.pptx"}) is None
+
+
+def test_document_prompt_numbers_chunks():
+    prompt = extraction.document_prompt("Реши", [("a.txt", {"chunks": ["one"]}), ("b.pdf", {"chunks": ["x", "y"]})])
+    assert prompt.startswith("Реши\n\nДокумент a.txt:\n")
+    assert "Документ b.pdf, часть 2 из 2:" in prompt
+
+
+def test_album_text_shares_one_allowance(monkeypatch):
+    monkeypatch.setattr(extraction, "CONTEXT_TOKEN_BUDGETS", {"gemini-big": 100000})
+    allowance = extraction.text_allowance("llama-small")
+    assert allowance["tokens"] == int(states.CONTEXT_TOKEN_BUDGET * extraction.TEXT_CONTEXT_SHARE)
+    # Каждый документ меньше TEXT_INLINE_MAX_TOKENS, но вместе они не помещаются
+    document = {"chunks": ["x" * (2000 * states.CHARS_PER_TOKEN)]}
+    assert extraction.reserve_text(allowance, "a.txt", document)
+    assert not extraction.reserve_text(allowance, "b.txt", document)
+    assert extraction.text_allowance("gemini-big")["tokens"] == extraction.TEXT_INLINE_MAX_TOKENS
+
+
+def test_document_turn_survives_follow_ups(monkeypatch):
+    # Небольшой бюджет, как у быстрых моделей Groq: документ на TEXT_INLINE_MAX_TOKENS в него не влезает с ответом
+    monkeypatch.setattr(extraction, "CONTEXT_TOKEN_BUDGETS", {"llama-small": 4000})
+    allowance = extraction.text_allowance("llama-small")
+    document = {"chunks": extraction.chunk_text("\n".join(LOREM.format(i) for i in range(200)))}
+    while not extraction.reserve_text(dict(allowance), "task.txt", document):
+        document["chunks"].pop()
+    turns = [{"role": "user", "content": extraction.document_prompt("Реши", [("task.txt", document)])}]
+    # Несколько уточнений с развернутыми ответами после документа
+    for i in range(3):
+        turns.append({"role": "assistant", "content": LOREM.format(i) * 10})
+        turns.append({"role": "user", "content": f"А почему в задании {i} так?"})
+    assert turns[0] in states.fit_to_budget(turns, 4000)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(extraction, "redis", redis)
+    return redis
+
+
+# Пул с fork в pytest создается из процесса с потоками других тестов
+@pytest.mark.filterwarnings("ignore:This process .* is multi-threaded")
+def test_extract_text_runs_in_pool_and_caches_by_hash(tmp_path, monkeypatch, fake_redis):
+    path = make_docx(tmp_path / "task.docx", [LOREM.format(1)])
+    file = {"name": "task.docx", "sha256": "abc", "size": os.path.getsize(path)}
+
+    async def scenario():
+        try:
+            first = await extraction.extract_text(path, file)
+            os.remove(path)
+            # Файл уже прочитан: второй раз результат берется из Redis
+            second = await extraction.extract_text(path, file)
+        finally:
+            await extraction.close_extraction_pool()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert extraction.is_extracted_text(first)
+    assert first == second
+    assert asyncio.run(extraction.extract_text(path, {"name": "slides.pptx", "sha256": "x"})) is None
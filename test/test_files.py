@@ -0,0 +1,141 @@
+import asyncio
+import dataclasses
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+import clients  # noqa: E402
+import files  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def bot_api_volume(monkeypatch, tmp_path):
+    monkeypatch.setattr(files, "BOT_API_ROOT", str(tmp_path))
+    monkeypatch.setattr(files, "config", dataclasses.replace(files.config, telegram_bot_token="123:abc"))
+    return tmp_path
+
+
+def download(name, data=b"task"):
+    # Так файл кладет локальный Bot API сервер: <token>/documents/<file>
+    folder = os.path.join(files.bot_api_dir(), "documents")
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name), "wb") as f:
+        f.write(data)
+    return f"123:abc/documents/{name}"
+
+
+def test_each_request_gets_its_own_staging_dir():
+    async def scenario():
+        return await asyncio.gather(*(files.create_staging_dir("7") for _ in range(5)))
+
+    dirs = asyncio.run(scenario())
+    assert len(set(dirs)) == 5
+    for path in dirs:
+        assert os.path.isdir(path)
+        assert os.path.dirname(path) == files.staging_root()
+        assert os.path.basename(path).startswith("7_")
+
+
+def test_staged_file_is_moved_not_copied():
+    file_path = download("file_1.pdf", b"x" * 1000)
+    source = os.path.join(files.bot_api_dir(), "documents", "file_1.pdf")
+    inode = os.stat(source).st_ino
+
+    async def scenario():
+        staging_dir = await files.create_staging_dir("7")
+        staged = files.stage_telegram_file(file_path, staging_dir, "../task.pdf")
+        return staging_dir, staged
+
+    staging_dir, staged = asyncio.run(scenario())
+    # os.replace на том же томе: тот же inode, исходного файла больше нет, имя не выходит из папки
+    assert staged == os.path.join(staging_dir, "task.pdf")
+    assert os.stat(staged).st_ino == inode
+    assert not os.path.exists(source)
+
+    asyncio.run(files.remove_staging_dir(staging_dir))
+    assert not os.path.exists(staging_dir)
+
+
+def test_rss_is_logged_as_current_and_peak(caplog):
+    before = files.current_rss_mb()
+    if before is None:
+        pytest.skip("no /proc/self/statm")
+    assert 0 < before <= files.peak_rss_mb() + 1
+    with caplog.at_level(logging.INFO):
+        files.log_rss("task.pdf", 1000, before)
+    assert "process RSS" in caplog.text and "process peak" in caplog.text
+
+
+class FakeGemini:
+    def __init__(self, expires_in=48 * 3600, state="ACTIVE"):
+        self.expires_in = expires_in
+        self.state = state
+        self.gets = []
+        self.deleted = []
+
+    def get_file(self, name):
+        self.gets.append(name)
+        expiration = datetime.fromtimestamp(time.time() + self.expires_in, timezone.utc)
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=self.state), expiration_time=expiration)
+
+    def delete_file(self, name):
+        self.deleted.append(name)
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    monkeypatch.setattr(files, "_gemini_files", {})
+    gemini = FakeGemini()
+    monkeypatch.setattr(clients, "_genai", gemini)
+    return gemini
+
+
+def test_gemini_handles_are_cached_until_expiry(gemini):
+    async def scenario():
+        first = await files.get_from_gemini("files/1")
+        second = await files.get_from_gemini("files/1")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is second and gemini.gets == ["files/1"]
+    # Запись живет до истечения файла в Gemini минус запас
+    expires_at = files._gemini_files["files/1"][1]
+    assert expires_at == pytest.approx(files.gemini_expiration(first) - files.GEMINI_FILE_TTL_MARGIN)
+
+
+def test_expiring_and_processing_handles_are_fetched_again(gemini):
+    async def scenario():
+        # Файл истекает раньше, чем через запас: кэшировать его бессмысленно
+        gemini.expires_in = files.GEMINI_FILE_TTL_MARGIN / 2
+        await files.get_from_gemini("files/old")
+        await files.get_from_gemini("files/old")
+        gemini.expires_in, gemini.state = 48 * 3600, "PROCESSING"
+        await files.get_from_gemini("files/new")
+        await files.get_from_gemini("files/new")
+
+    asyncio.run(scenario())
+    assert gemini.gets == ["files/old"] * 2 + ["files/new"] * 2
+    assert "files/new" not in files._gemini_files
+
+
+def test_full_cache_evicts_expired_handles_first(gemini, monkeypatch):
+    monkeypatch.setattr(files, "GEMINI_FILE_CACHE_SIZE", 3)
+    now = time.time()
+    files._gemini_files.update({"files/a": ("a", now + 100), "files/b": ("b", now - 1), "files/c": ("c", now + 100)})
+    files.cache_gemini_file(gemini.get_file("files/d"))
+    assert list(files._gemini_files) == ["files/a", "files/c", "files/d"]
+    # Истекших больше нет: вытесняется самая старая запись
+    files.cache_gemini_file(gemini.get_file("files/e"))
+    assert list(files._gemini_files) == ["files/c", "files/d", "files/e"]
+
+    asyncio.run(files.delete_from_gemini("files/d"))
+    assert "files/d" not in files._gemini_files and gemini.deleted == ["files/d"]
@@ -0,0 +1,240 @@
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from formatting import format_message, split_message, SPECIAL_CHARS  # noqa: E402
+
+
+def assert_valid_markdown_v2(text):
+    """Проверка по правилам MarkdownV2: все спецсимволы вне разметки экранированы,
+    сущности вложены правильно и закрыты, внутри кода экранированы только ` и \\."""
+    stack = []
+    i = 0
+    n = len(text)
+    line_start = True
+    while i < n:
+        ch = text[i]
+        if text.startswith("```", i):
+            end = text.find("\n```", i + 3)
+            assert end != -1, f"unclosed pre at {i}: {text[i:i + 40]!r}"
+            body = text[text.index("\n", i) + 1:end] if "\n" in text[i:end + 1] else ""
+            check_code(body)
+            i = end + 4
+            line_start = False
+            continue
+        if ch == "\\":
+            assert i + 1 < n and text[i + 1] in SPECIAL_CHARS, f"bad escape at {i}: {text[i:i + 10]!r}"
+            i += 2
+        elif ch == "`":
+            end = text.find("`", i + 1)
+            while end != -1 and text[end - 1] == "\\" and not text[i + 1:end].endswith("\\\\"):
+                end = text.find("`", end + 1)
+            assert end != -1, f"unclosed code at {i}"
+            check_code(text[i + 1:end])
+            i = end + 1
+        elif ch in "*_~":
+            kind = "__" if text.startswith("__", i) else ch
+            if stack and stack[-1] == kind:
+                stack.pop()
+            else:
+                assert kind not in stack, f"entities cross at {i}: {text[max(0, i - 20):i + 20]!r}"
+                stack.append(kind)
+            i += len(kind)
+        elif ch == "[":
+            close = text.find("](", i)
+            end = text.find(")", close)
+            assert close != -1 and end != -1, f"broken link at {i}"
+            assert close > i + 1, f"empty link text at {i}"
+            assert_valid_markdown_v2(text[i + 1:close])
+            i = end + 1
+        elif ch == ">" and line_start:
+            i += 1
+        else:
+            assert ch not in SPECIAL_CHARS, f"unescaped {ch!r} at {i}: {text[max(0, i - 20):i + 20]!r}"
+            i += 1
+        line_start = ch == "\n"
+    assert not stack, f"unclosed entities {stack}"
+
+
+def check_code(body):
+    i = 0
+    while i < len(body):
+        if body[i] == "\\":
+            assert body[i + 1] in "`\\", f"bad escape in code: {body!r}"
+            i += 2
+        else:
+            assert body[i] != "`", f"unescaped backtick in code: {body!r}"
+            i += 1
+
+
+CORPUS = [
+    ("Привет! Это тест.", "Привет\\! Это тест\\."),
+    ("**Жирный** и *курсив*", "*Жирный* и _курсив_"),
+    ("__тоже жирный__ и _курсив_", "*тоже жирный* и _курсив_"),
+    ("***оба***", "*_оба_*"),
+    ("~~зачеркнуто~~", "~зачеркнуто~"),
+    ("Вызови `print(a_b)` здесь", "Вызови `print(a_b)` здесь"),
+    ("snake_case_name и 2 * 3 = 6", "snake\\_case\\_name и 2 \\* 3 \\= 6"),
+    ("# Заголовок", "*Заголовок*"),
+    ("## **Жирный** заголовок", "*Жирный заголовок*"),
+    ("* пункт\n- пункт 2\n  + вложенный", "• пункт\n• пункт 2\n  • вложенный"),
+    ("1. первый\n2) второй", "1\\. первый\n2\\) второй"),
+    ("> цитата", ">цитата"),
+    ("---", "————————"),
+    ("[сайт](https://example.com/a_b?q=1)", "[сайт](https://example.com/a_b?q=1)"),
+    ("```python\nprint('`x`')\n```", "```python\nprint('\\`x\\`')\n```"),
+    ("```\nunterminated", "```\nunterminated\n```"),
+    ("**незакрытый жирный", "\\*\\*незакрытый жирный"),
+    ("путь C:\\Users\\a", "путь C:\\\\Users\\\\a"),
+    ("Экранировано \\* вручную", "Экранировано \\* вручную"),
+    ("_a_ _b_", "_a_ _b_"),
+]
+
+
+@pytest.mark.parametrize("source, expected", CORPUS)
+def test_corpus(source, expected):
+    result = format_message(source)
+    assert result == expected
+    assert_valid_markdown_v2(result)
+
+
+LLM_RESPONSE = """## Решение задачи №1
+
+Нам нужно найти **корни** уравнения *x² - 5x + 6 = 0*.
+
+1. Дискриминант: `D = b^2 - 4ac = 25 - 24 = 1`
+2. Корни: x₁ = (5 + 1) / 2 = 3, x₂ = (5 - 1) / 2 = 2
+
+> **Ответ:** x = 2 или x = 3 (проверка: 2*3 = 6).
+
+```python
+import math
+
+def solve(a, b, c):
+    d = b ** 2 - 4 * a * c  # `d` - дискриминант
+    return [(-b + s * math.sqrt(d)) / (2 * a) for s in (1, -1)]
+```
+
+* **Важно:** не забудь про случай `d < 0`!
+* Ссылки: [документация](https://docs.python.org/3/library/math.html) | {фигурные} #хештег
+"""
+
+
+def test_long_llm_response_is_valid():
+    assert_valid_markdown_v2(format_message(LLM_RESPONSE))
+
+
+@pytest.mark.parametrize("cut", range(0, len(LLM_RESPONSE), 7))
+def test_partial_stream_output_is_valid(cut):
+    # Превью при стриминге рендерится из произвольного префикса ответа
+    assert_valid_markdown_v2(format_message(LLM_RESPONSE[:cut]))
+
+
+@pytest.mark.parametrize("source", [
+    "**a *b** c*", "*a **b* c**", "**a _b** c_", "_a **b_ c**", "****", "__", "a__b__c",
+    "``` in the middle ```", "`", "``code``", "[broken](link", "[x](javascript:alert(1))",
+    "~~~", "***a**", "*a**b*", "_a__b_", "\\", "#", "#нет пробела", "1.5 + 2.5",
+    "**_***", "___*******", "**_a_*b***", "*a*_b_",
+])
+def test_malformed_markdown_is_still_valid(source):
+    assert_valid_markdown_v2(format_message(source))
+
+
+@pytest.mark.parametrize("source, expected", [
+    ("*a*_b_", "_ab_"),
+    ("**_a_*b***", "*_ab_*"),
+    ("**_***", "*\\_\\**"),
+    ("~~~~", "\\~\\~\\~\\~"),
+])
+def test_adjacent_italics_are_merged_and_empty_entities_stay_text(source, expected):
+    # Между двумя курсивами "__" было бы подчеркиванием, а пустой жирный внутри жирного - ошибкой разметки
+    assert format_message(source) == expected
+
+
+def assert_valid_split(text, limit):
+    chunks = split_message(text, limit)
+    for chunk in chunks:
+        assert 0 < len(chunk) <= limit
+        assert_valid_markdown_v2(chunk)
+    return chunks
+
+
+@pytest.mark.parametrize("limit", [60, 100, 250, 4096])
+def test_split_long_llm_response(limit):
+    text = format_message(LLM_RESPONSE * 20)
+    chunks = assert_valid_split(text, limit)
+    # Текст не теряется: без пробелов на границах и повторно открытых блоков кода совпадает
+    assert "".join(chunks).replace("\n```python\n", "").replace("```python\n", "").replace("\n```", "") \
+        .replace("```", "").replace("\n", "").replace(" ", "") == \
+        text.replace("\n```python\n", "").replace("```python\n", "").replace("\n```", "") \
+        .replace("```", "").replace("\n", "").replace(" ", "")
+
+
+def test_split_reopens_code_block_with_language():
+    text = format_message("```python\n" + "\n".join(f"x_{i} = {i}" for i in range(200)) + "\n```")
+    chunks = assert_valid_split(text, 300)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("```python\n") and chunk.endswith("\n```") for chunk in chunks)
+
+
+def test_split_prefers_paragraphs():
+    paragraphs = ["Абзац " + str(i) + " " + "слово " * 30 for i in range(10)]
+    chunks = assert_valid_split(format_message("\n\n".join(paragraphs)), 500)
+    assert all(chunk.strip().startswith("Абзац") for chunk in chunks)
+
+
+@pytest.mark.parametrize("source", [
+    "a\\.b " * 2000, "**жирный текст** и " * 500, "слово" * 3000, "`" + "x" * 5000 + "`",
+    "[ссылка](https://example.com) " * 400, "**" + "очень длинный жирный " * 300 + "**",
+    "**_" + "x" * 5000 + "_**",
+])
+def test_split_long_lines(source):
+    assert_valid_split(format_message(source), 4096)
+
+
+@pytest.mark.parametrize("link_text", ["ссылка " * 60, "ссылка" * 80, "**жирная** ссылка " * 25],
+                         ids=["words", "no_spaces", "markup"])
+def test_split_link_longer_than_limit(link_text):
+    url = "https://example.com/tasks?id=1"
+    text = format_message(f"См. [{link_text}]({url}) и дальше")
+    chunks = assert_valid_split(text, 120)
+    assert len(chunks) > 3
+    # Каждая часть ссылки остается ссылкой на тот же адрес
+    assert all(chunk.startswith("[") and f"]({url})" in chunk for chunk in chunks[1:])
+    link = "".join(chunks).replace(f"]({url})[", "")
+    assert link.replace(" ", "") == text.replace(" ", "")
+
+
+def test_split_link_inside_bold():
+    text = format_message("**Жирный [" + "текст ссылки " * 50 + "](https://example.com)**")
+    chunks = assert_valid_split(text, 150)
+    assert all(chunk.startswith("*") for chunk in chunks[1:])
+
+
+@pytest.mark.parametrize("code_line", [4090, 4080, 300])
+def test_split_never_sends_an_empty_code_block(code_line):
+    text = format_message("Intro\n\n```python\n" + "x" * code_line + "\n```\nend")
+    chunks = assert_valid_split(text, 4096 if code_line > 300 else 200)
+    assert not any(chunk.endswith("```python\n```") for chunk in chunks)
+    if code_line == 4090:
+        # Строка длиннее части режется сразу после открытия блока: частей столько, сколько нужно по длине
+        assert len(chunks) == math.ceil(len(text) / 4096)
+
+
+def test_split_drops_empty_chunks():
+    chunks = assert_valid_split(format_message("\n" + "y" * 5000), 4096)
+    assert len(chunks) == 2 and all(chunk.strip() for chunk in chunks)
+
+
+@pytest.mark.parametrize("source", ["*[[](https://x.y/z)_", "**_x_**", "_[a](https://x.y/z)_ " * 3])
+@pytest.mark.parametrize("limit", [8, 12, 20])
+def test_split_with_tiny_limit_terminates(source, limit):
+    text = format_message(source)
+    chunks = split_message(text, limit)
+    # Сущность длиннее limit не сохранить, но каждая часть в лимите и текст не теряется
+    assert all(0 < len(chunk) <= limit for chunk in chunks)
+    assert len(chunks) <= len(text)
@@ -0,0 +1,50 @@
+import asyncio
+import io
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+from files import prepare_inline_image, inline_image_allowed, INLINE_IMAGE_MAX_BYTES  # noqa: E402
+
+
+def save(tmp_path, name, size, format, mode="RGB", exif=None):
+    path = tmp_path / name
+    image = Image.new(mode, size, "white")
+    image.save(path, format=format, **({"exif": exif} if exif else {}))
+    return str(path)
+
+
+def test_small_jpeg_is_sent_unchanged(tmp_path):
+    path = save(tmp_path, "photo.jpg", (800, 600), "JPEG")
+    image = asyncio.run(prepare_inline_image(path, max_side=1536))
+    assert image == {"mime_type": "image/jpeg", "data": open(path, "rb").read()}
+
+
+def test_large_image_is_downscaled_to_jpeg(tmp_path):
+    path = save(tmp_path, "scan.png", (4000, 3000), "PNG", mode="RGBA")
+    image = asyncio.run(prepare_inline_image(path, max_side=1000))
+    assert image["mime_type"] == "image/jpeg"
+    with Image.open(io.BytesIO(image["data"])) as result:
+        assert result.size == (1000, 750)
+        assert result.format == "JPEG"
+
+
+def test_exif_orientation_is_applied(tmp_path):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # повернуто на 90 градусов
+    path = save(tmp_path, "portrait.jpg", (2000, 1000), "JPEG", exif=exif)
+    image = asyncio.run(prepare_inline_image(path, max_side=1000))
+    with Image.open(io.BytesIO(image["data"])) as result:
+        assert result.size == (500, 1000)
+
+
+def test_size_threshold():
+    assert inline_image_allowed({"size": 200 * 1024})
+    assert not inline_image_allowed({"size": INLINE_IMAGE_MAX_BYTES + 1})
+    # Размер неизвестен - безопаснее обычный путь
+    assert not inline_image_allowed({"size": None})
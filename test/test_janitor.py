@@ -0,0 +1,166 @@
+import asyncio
+import dataclasses
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+import clients  # noqa: E402
+import files  # noqa: E402
+import janitor  # noqa: E402
+import states  # noqa: E402
+
+NOW = time.time()
+HOUR = 3600
+
+
+class FakeGemini:
+    def __init__(self, *gemini_files):
+        self.files = {file.name: file for file in gemini_files}
+        self.deleted = []
+
+    def list_files(self):
+        return iter(list(self.files.values()))
+
+    def delete_file(self, name):
+        self.deleted.append(name)
+        del self.files[name]
+
+
+def gemini_file(name, age=2 * HOUR, expires_in=40 * HOUR, state="ACTIVE"):
+    return SimpleNamespace(name=name, size_bytes=1000, state=SimpleNamespace(name=state),
+                           create_time=datetime.fromtimestamp(NOW - age, timezone.utc),
+                           expiration_time=datetime.fromtimestamp(NOW + expires_in, timezone.utc))
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch, tmp_path):
+    redis = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(janitor, "redis", redis)
+    monkeypatch.setattr(states, "redis", redis)
+    monkeypatch.setattr(janitor, "JANITOR_DELETES_PER_SECOND", 1000)
+    monkeypatch.setattr(files, "BOT_API_ROOT", str(tmp_path))
+    monkeypatch.setattr(files, "config", dataclasses.replace(files.config, telegram_bot_token="123:abc"))
+    return redis
+
+
+def use_gemini(monkeypatch, *gemini_files):
+    gemini = FakeGemini(*gemini_files)
+    monkeypatch.setattr(clients, "_genai", gemini)
+    return gemini
+
+
+def test_deletes_unreferenced_failed_and_expiring_files(monkeypatch, environment):
+    gemini = use_gemini(monkeypatch,
+                        gemini_file("files/indexed"), gemini_file("files/in-state"),
+                        gemini_file("files/orphan"), gemini_file("files/just-uploaded", age=60),
+                        gemini_file("files/failed", state="FAILED"), gemini_file("files/expiring", expires_in=60))
+
+    async def scenario():
+        await states.index_file("a" * 64, "a.pdf", "files/indexed", expires_at=NOW + 40 * HOUR)
+        await states.save_user_state("1", states._empty_state(), files=[{"sha256": "b", "gemini_name": "files/in-state"}])
+        return await janitor.clean_gemini_files(now=NOW)
+
+    stats = asyncio.run(scenario())
+    assert sorted(gemini.deleted) == ["files/expiring", "files/failed", "files/orphan"]
+    assert stats["gemini_files"] == 3
+    assert sorted(gemini.files) == ["files/in-state", "files/indexed", "files/just-uploaded"]
+
+
+def test_prunes_records_of_deleted_files_and_expired_caches(monkeypatch, environment):
+    use_gemini(monkeypatch, gemini_file("files/live"))
+    records = [
+        {"sha256": "a", "gemini_name": "files/live", "context_cache": {"name": "c", "expires_at": NOW - 1}},
+        {"sha256": "b", "gemini_name": "files/gone"},
+        # Загружен после получения списка файлов, но уже в индексе
+        {"sha256": "c", "gemini_name": "files/new"},
+    ]
+
+    async def scenario():
+        await states.index_file("c", "c.pdf", "files/new", expires_at=NOW + 40 * HOUR)
+        state = states._empty_state()
+        await states.save_user_state("1", state, turns=[{"role": "user", "content": "hi"}], files=records)
+        stats = await janitor.clean_gemini_files(now=NOW)
+        return stats, await states.load_user_state("1")
+
+    stats, state = asyncio.run(scenario())
+    assert stats["file_records"] == 1
+    assert state["files"] == [{"sha256": "a", "gemini_name": "files/live"}, {"sha256": "c", "gemini_name": "files/new"}]
+    assert state["turns"] == [{"role": "user", "content": "hi"}]
+
+
+def test_sweeps_old_staging_dirs_and_bot_api_leftovers(environment):
+    old = NOW - 2 * HOUR
+    stale_dir = os.path.join(files.staging_root(), "1_old")
+    fresh_dir = os.path.join(files.staging_root(), "1_new")
+    leftover = os.path.join(files.bot_api_dir(), "documents", "file_1.docx")
+    for path in (stale_dir, fresh_dir, os.path.dirname(leftover)):
+        os.makedirs(path)
+    with open(os.path.join(stale_dir, "task.pdf"), "wb") as f:
+        f.write(b"x" * 100)
+    with open(leftover, "wb") as f:
+        f.write(b"x" * 50)
+    for path in (stale_dir, leftover):
+        os.utime(path, (old, old))
+
+    removed = asyncio.run(janitor.sweep_local_files(now=NOW))
+    assert removed == {"staging_dirs": 1, "bot_api_files": 1}
+    assert not os.path.exists(stale_dir) and not os.path.exists(leftover)
+    assert os.path.isdir(fresh_dir)
+
+
+def test_one_replica_cleans_gemini_per_interval(monkeypatch, environment):
+    gemini = use_gemini(monkeypatch, gemini_file("files/orphan"))
+
+    async def scenario():
+        first = await janitor.run_janitor()
+        second = await janitor.run_janitor()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first["gemini_files"] == 1 and "gemini_files" not in second
+    assert gemini.deleted == ["files/orphan"]
+
+
+def test_sweep_skips_entries_removed_by_another_replica(monkeypatch, environment):
+    old = NOW - 2 * HOUR
+    vanished = os.path.join(files.staging_root(), "1_gone")
+    stale = os.path.join(files.staging_root(), "1_old")
+    for path in (vanished, stale):
+        os.makedirs(path)
+        os.utime(path, (old, old))
+    scandir = os.scandir
+
+    def racing_scandir(path):
+        if path != files.staging_root():
+            return scandir(path)
+        entries = list(scandir(path))
+        # Реплика на том же томе удаляет папку между scandir и stat
+        os.rmdir(vanished)
+        return iter(entries)
+
+    monkeypatch.setattr(janitor.os, "scandir", racing_scandir)
+    removed, _ = janitor._sweep_local(NOW)
+    assert removed["staging_dirs"] == 1
+    assert not os.path.exists(stale)
+
+
+def test_local_sweep_runs_once_per_interval_on_shared_volume(monkeypatch, environment):
+    use_gemini(monkeypatch)
+    stale = os.path.join(files.staging_root(), "1_old")
+    os.makedirs(stale)
+    os.utime(stale, (NOW - 2 * HOUR, NOW - 2 * HOUR))
+
+    async def scenario():
+        return await janitor.run_janitor(), await janitor.run_janitor()
+
+    first, second = asyncio.run(scenario())
+    assert first["staging_dirs"] == 1 and second == {}
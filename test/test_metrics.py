@@ -0,0 +1,43 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import metrics  # noqa: E402
+
+
+def test_stage_is_recorded_even_on_error():
+    def count():
+        return metrics.STAGE_SECONDS.labels("test_stage", "llama")._sum.get()
+
+    before = count()
+    try:
+        with metrics.stage("test_stage", "llama"):
+            raise ValueError
+    except ValueError:
+        pass
+    assert count() > before
+
+
+def test_metrics_endpoint_exposes_histograms():
+    async def scenario():
+        metrics.observe("formatting", 0.01, "gemini")
+        response = await metrics.metrics(make_mocked_request("GET", "/metrics"))
+        body = response.body.decode()
+        assert 'bot_stage_seconds_bucket{le="0.01",model="gemini",stage="formatting"}' in body
+        assert response.headers["Content-Type"].startswith("text/plain")
+
+    asyncio.run(scenario())
+
+
+def test_json_log_lines_keep_extra_fields():
+    record = logging.LogRecord("bot", logging.INFO, __file__, 1, "Answered by %s", ("llama",), None)
+    record.user_id = "42"
+    entry = json.loads(metrics.JsonFormatter().format(record))
+    assert entry["message"] == "Answered by llama"
+    assert entry["level"] == "INFO" and entry["user_id"] == "42"
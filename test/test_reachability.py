@@ -0,0 +1,73 @@
+import asyncio
+import dataclasses
+import os
+import sys
+
+from aiohttp import web
+from prometheus_client import REGISTRY
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import clients  # noqa: E402
+
+
+def transport_metrics():
+    return ({mode: REGISTRY.get_sample_value("bot_groq_transport", {"mode": mode}) for mode in ("direct", "proxy")},
+            REGISTRY.get_sample_value("bot_groq_transport_switches_total"))
+
+
+async def run_stub(status):
+    async def handler(request):
+        return web.Response(status=status["code"], text=status["text"])
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+def test_switches_between_direct_and_proxy(monkeypatch):
+    monkeypatch.setattr(clients, "config", dataclasses.replace(clients.config, proxy="http://proxy.local:3128"))
+
+    async def scenario():
+        status = {"code": 200, "text": "ok"}
+        runner, url = await run_stub(status)
+        _, switches = transport_metrics()
+        try:
+            assert await clients.check_reachability(url) == "direct"
+            assert clients.get_proxy() is None
+            assert transport_metrics() == ({"direct": 1, "proxy": 0}, switches)
+
+            status["code"] = 403
+            assert await clients.check_reachability(url) == "proxy"
+            assert clients.get_proxy() == "http://proxy.local:3128"
+            assert transport_metrics() == ({"direct": 0, "proxy": 1}, switches + 1)
+
+            status.update(code=200, text="This page is geo-blocked")
+            assert await clients.check_reachability(url) == "proxy"
+
+            status.update(code=200, text="ok")
+            assert await clients.check_reachability(url) == "direct"
+            assert clients.transport["switches"] == 2
+            assert transport_metrics() == ({"direct": 1, "proxy": 0}, switches + 2)
+        finally:
+            await runner.cleanup()
+            await clients.close_clients()
+
+    asyncio.run(scenario())
+
+
+def test_failed_probe_keeps_previous_transport():
+    async def scenario():
+        clients.transport["mode"] = "proxy"
+        try:
+            assert await clients.check_reachability("http://127.0.0.1:9/") == "proxy"
+        finally:
+            clients.transport["mode"] = "direct"
+            await clients.close_clients()
+
+    asyncio.run(scenario())
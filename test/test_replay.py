@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+REPLAY = os.path.join(os.path.dirname(__file__), "replay.py")
+FAST = ["--updates", "20", "--users", "5", "--bot-api-latency", "0", "--llm-first-token", "0",
+        "--llm-tokens", "20", "--llm-token-interval", "0", "--upload-latency", "0", "--convert-latency", "0"]
+
+
+def replay(tmp_path, *args):
+    report = tmp_path / "report.json"
+    # Отдельный процесс: replay подменяет redis.asyncio.from_url и импортирует main со своим окружением
+    result = subprocess.run([sys.executable, "-W", "ignore", REPLAY, *FAST, *args, "--json", str(report)],
+                            capture_output=True, text=True, timeout=240)
+    assert result.returncode == 0, result.stderr[-2000:]
+    with open(report, encoding="utf-8") as f:
+        return json.load(f), result.stdout
+
+
+def test_replay_answers_every_update(tmp_path):
+    report, output = replay(tmp_path)
+    assert report["updates"] == 20
+    assert not report["failures"]
+    assert report["stages"]["llm_total"]["count"] == 20
+    assert report["bot_api_calls"]["sendMessage"] >= 20
+    assert "msg/s" in output
+
+
+def test_replay_injected_errors_are_reported(tmp_path):
+    report, _ = replay(tmp_path, "--groq-errors", "1", "--markdown-errors", "1", "--documents", "0", "--photos", "0")
+    assert report["groq_calls"].get("ok", 0) == 0
+    assert report["groq_calls"]["error"] > 0
+    assert report["bot_api_calls"]["sendMessage:rejected"] > 0
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+from aiohttp import web
+from groq import AsyncGroq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from router import ProviderRouter, ProvidersUnavailable, is_transient  # noqa: E402
+
+
+async def run_fake_provider(behaviour):
+    """Фейковый OpenAI-совместимый провайдер. behaviour: очередь кодов ответа
+    ("errors"), задержка ответа ("delay") и счетчик запросов ("requests")."""
+    behaviour.setdefault("requests", 0)
+
+    async def completions(request):
+        body = await request.json()
+        behaviour["requests"] += 1
+        delay = behaviour.get("delay", 0)
+        await asyncio.sleep(delay() if callable(delay) else delay)
+        errors = behaviour.get("errors", [])
+        if errors:
+            code = errors.pop(0)
+            if code:
+                return web.json_response({"error": {"message": f"fake {code}"}}, status=code)
+        return web.json_response({
+            "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"answer from {body['model']}"}}],
+        })
+
+    app = web.Application()
+    app.router.add_post("/openai/v1/chat/completions", completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, AsyncGroq(api_key="test", base_url=f"http://127.0.0.1:{port}", max_retries=0)
+
+
+async def run_providers(**behaviours):
+    # Модель -> фейковый сервер; провайдер определяется по имени модели, как в боте
+    runners = []
+    clients = {}
+    for model, behaviour in behaviours.items():
+        runner, client = await run_fake_provider(behaviour)
+        runners.append(runner)
+        clients[model] = client
+
+    async def ask(model):
+        response = await clients[model].chat.completions.create(
+            model=model, messages=[{"role": "user", "content": "2 + 2?"}])
+        return response.choices[0].message.content
+
+    async def close():
+        for runner in runners:
+            await runner.cleanup()
+
+    return ask, close
+
+
+MODELS = ["llama-fake", "gemini-fake"]
+
+
+def test_retries_transient_errors_on_the_same_model():
+    async def scenario():
+        groq = {"errors": [503]}
+        gemini = {}
+        ask, close = await run_providers(**{"llama-fake": groq, "gemini-fake": gemini})
+        try:
+            router = ProviderRouter(fallbacks={}, attempts=2, backoff_base=0.01)
+            assert await router.run("llama-fake", ask, MODELS) == ("llama-fake", "answer from llama-fake")
+            assert groq["requests"] == 2 and gemini["requests"] == 0
+        finally:
+            await close()
+
+    asyncio.run(scenario())
+
+
+def test_falls_back_to_other_provider_and_opens_circuit():
+    async def scenario():
+        groq = {"errors": [500] * 100}
+        gemini = {}
+        ask, close = await run_providers(**{"llama-fake": groq, "gemini-fake": gemini})
+        failures = []
+
+        async def on_failure(model, error):
+            failures.append(model)
+
+        try:
+            router = ProviderRouter(fallbacks={}, attempts=2, backoff_base=0.01,
+                                    breaker_failures=2, breaker_cooldown=0.2)
+            assert await router.run("llama-fake", ask, MODELS, on_failure=on_failure) == \
+                ("gemini-fake", "answer from gemini-fake")
+            assert failures == ["llama-fake", "llama-fake"]
+            assert router.breaker("llama-fake").state == "open"
+
+            # Пока цепь разомкнута, Groq не получает запросов
+            assert (await router.run("llama-fake", ask, MODELS))[0] == "gemini-fake"
+            assert groq["requests"] == 2
+
+            # После cooldown проходит один пробный запрос, и цепь замыкается
+            await asyncio.sleep(0.25)
+            groq["errors"] = []
+            assert (await router.run("llama-fake", ask, MODELS))[0] == "llama-fake"
+            assert router.breaker("llama-fake").state == "closed"
+        finally:
+            await close()
+
+    asyncio.run(scenario())
+
+
+def test_client_errors_skip_retries_and_keep_circuit_closed():
+    async def scenario():
+        groq = {"errors": [400]}
+        gemini = {}
+        ask, close = await run_providers(**{"llama-fake": groq, "gemini-fake": gemini})
+        try:
+            router = ProviderRouter(fallbacks={}, attempts=3, backoff_base=0.01, breaker_failures=1)
+            assert (await router.run("llama-fake", ask, MODELS))[0] == "gemini-fake"
+            assert groq["requests"] == 1
+            assert router.breaker("llama-fake").state == "closed"
+        finally:
+            await close()
+
+    asyncio.run(scenario())
+
+
+def test_file_turns_stay_on_gemini():
+    async def scenario():
+        gemini = {"errors": [503] * 10}
+        ask, close = await run_providers(**{"llama-fake": {}, "gemini-fake": gemini})
+        try:
+            router = ProviderRouter(fallbacks={}, attempts=2, backoff_base=0.01)
+            try:
+                await router.run("gemini-fake", ask, MODELS, providers={"gemini"})
+                assert False, "expected ProvidersUnavailable"
+            except ProvidersUnavailable:
+                pass
+            assert gemini["requests"] == 2
+        finally:
+            await close()
+
+    asyncio.run(scenario())
+
+
+def test_explicit_fallbacks_order():
+    router = ProviderRouter(fallbacks={"llama-fake": ["llama-small", "gemini-pro"]})
+    assert router.candidates("llama-fake", MODELS) == ["llama-fake", "llama-small", "gemini-pro"]
+    assert router.candidates("gemini-fake", MODELS + ["gemini-pro"]) == ["gemini-fake", "llama-fake"]
+    assert router.candidates("llama-fake", MODELS, providers={"gemini"}) == ["gemini-pro"]
+
+
+def test_hedged_request_takes_first_answer():
+    async def scenario():
+        groq = {"delay": 1}
+        gemini = {"delay": 0.05}
+        ask, close = await run_providers(**{"llama-fake": groq, "gemini-fake": gemini})
+        try:
+            router = ProviderRouter(fallbacks={}, hedge_delay=0.1)
+            start = time.perf_counter()
+            assert (await router.run("llama-fake", ask, MODELS, hedge=True))[0] == "gemini-fake"
+            assert time.perf_counter() - start < 0.5
+            assert groq["requests"] == 1 and gemini["requests"] == 1
+            # Отмененный основной запрос не считается ошибкой модели
+            assert router.breaker("llama-fake").errors == 0
+
+            # Быстрый основной ответ дубль не запускает
+            groq["delay"] = 0
+            assert (await router.run("llama-fake", ask, MODELS, hedge=True))[0] == "llama-fake"
+            assert gemini["requests"] == 1
+        finally:
+            await close()
+
+    asyncio.run(scenario())
+
+
+def test_bot_errors_are_not_retried_or_failed_over():
+    async def scenario():
+        calls = []
+
+        async def ask(model):
+            calls.append(model)
+            return {}["missing"]
+
+        router = ProviderRouter(fallbacks={}, attempts=3, backoff_base=0.01, breaker_failures=1)
+        with pytest.raises(KeyError):
+            await router.run("llama-fake", ask, MODELS)
+        # Ошибка в коде бота не говорит о провайдере: одна попытка, circuit закрыт, другой модели нет
+        assert calls == ["llama-fake"]
+        assert router.breaker("llama-fake").state == "closed"
+        assert not is_transient(KeyError("x")) and not is_transient(ValueError("x"))
+
+    asyncio.run(scenario())
+
+
+def test_streaming_preview_survives_telegram_network_errors():
+    from aiogram.exceptions import TelegramNetworkError
+    from aiogram.methods import SendMessage
+    from streaming import StreamingReply
+
+    class Message:
+        async def answer(self, text, parse_mode=None):
+            raise TelegramNetworkError(SendMessage(chat_id=1, text=text), "connection reset")
+
+    async def scenario():
+        router = ProviderRouter(fallbacks={}, attempts=1, breaker_failures=1)
+        reply = StreamingReply(Message(), "llama-fake")
+
+        async def ask(model):
+            await reply.feed("x" * 100)
+            return "answer"
+
+        assert await router.run("llama-fake", ask, MODELS) == ("llama-fake", "answer")
+        assert router.breaker("llama-fake").errors == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+from scheduler import Scheduler, SchedulerOverloaded  # noqa: E402
+
+
+def test_runs_waiters_in_arrival_order_within_provider_limits():
+    async def scenario():
+        scheduler = Scheduler(limit=2, provider_limits={"groq": 1, "gemini": 2}, max_queue=10)
+        order = []
+        positions = []
+        release = asyncio.Event()
+
+        async def turn(name, provider):
+            async def on_queued(position):
+                positions.append((name, position))
+
+            async with scheduler.slot(provider, on_queued=on_queued):
+                order.append(name)
+                await release.wait()
+
+        tasks = [asyncio.create_task(turn("groq-1", "groq")),
+                 asyncio.create_task(turn("groq-2", "groq")),
+                 asyncio.create_task(turn("gemini-1", "gemini")),
+                 asyncio.create_task(turn("gemini-2", "gemini"))]
+        await asyncio.sleep(0)
+        # groq-2 ждет свободный слот Groq, gemini-1 проходит, gemini-2 упирается в общий лимит
+        assert order == ["groq-1", "gemini-1"]
+        assert positions == [("groq-2", 1), ("gemini-2", 2)]
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["groq-1", "gemini-1", "groq-2", "gemini-2"]
+        assert scheduler.active == 0 and not scheduler.queue
+
+    asyncio.run(scenario())
+
+
+def test_sheds_requests_when_queue_is_full():
+    async def scenario():
+        scheduler = Scheduler(limit=1, provider_limits={}, max_queue=1)
+        release = asyncio.Event()
+
+        async def turn():
+            async with scheduler.slot("groq"):
+                await release.wait()
+
+        tasks = [asyncio.create_task(turn()), asyncio.create_task(turn())]
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerOverloaded):
+            async with scheduler.slot("groq"):
+                pass
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = Scheduler(limit=1, provider_limits={}, max_queue=5)
+        release = asyncio.Event()
+
+        async def turn():
+            async with scheduler.slot("groq"):
+                await release.wait()
+
+        running = asyncio.create_task(turn())
+        waiting = asyncio.create_task(turn())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert not scheduler.queue
+
+        release.set()
+        await running
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+APP = os.path.join(os.path.dirname(__file__), "..", "app")
+ENV = {
+    "TELEGRAM_BOT_TOKEN": "123:abc", "API_SERVER_URL": "http://localhost:8081", "REDIS_URL": "redis://localhost",
+    "MODEL_CHOICES": "llama-3.1-70b-versatile,llama-3.1-8b-instant,a,b,gemini-1.5-pro", "GEMINI_API_KEY": "test",
+}
+# SDK провайдеров и движков, которые нужны только при первом запросе к ним
+LAZY_MODULES = ["google.generativeai", "groq", "pylovepdf", "PIL", "pypdf"]
+
+
+def import_main():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-W", "ignore", "-c", "import main"],
+                            cwd=APP, env={**os.environ, **ENV}, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    # Строки вида "import time: self [us] | cumulative | module"
+    modules = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line.split("|")
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def test_main_imports_without_provider_sdks():
+    modules = import_main()
+    assert "main" in modules
+    loaded = [name for name in modules for lazy in LAZY_MODULES if name == lazy or name.startswith(lazy + ".")]
+    assert not loaded, f"imported at startup: {sorted(set(loaded))[:10]}"
+
+
+def test_app_modules_do_not_import_main():
+    # Запущенный как скрипт main - это __main__, импорт main выполнил бы его второй раз
+    for name in os.listdir(APP):
+        if name.endswith(".py") and name != "main.py":
+            with open(os.path.join(APP, name), encoding="utf-8") as f:
+                assert "from main import" not in f.read(), name
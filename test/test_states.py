@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import files  # noqa: E402
+import states  # noqa: E402
+
+USER = {"role": "user", "content": "Что такое интеграл?"}
+ASSISTANT = {"role": "assistant", "content": "Интеграл - это..."}
+FILE = {"name": "task.docx", "sha256": "abc", "gemini_name": "files/1", "size": 1000}
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(states, "redis", fakeredis.FakeAsyncRedis())
+
+
+def test_state_round_trip():
+    async def scenario():
+        state = await states.load_user_state("1")
+        await states.save_user_state("1", state, turns=[USER, ASSISTANT], model="llama", files=[FILE])
+        loaded = await states.load_user_state("1")
+        assert loaded["model"] == "llama" and loaded["files"] == [FILE]
+        assert loaded["turns"] == [USER, ASSISTANT] and loaded["next"] == 2
+        # Одна запись - один ключ
+        assert await states.redis.keys("*") == [b"1_state"]
+
+    asyncio.run(scenario())
+
+
+def test_migrates_separate_keys():
+    async def scenario():
+        await states.redis.set("1_model", "gemini-pro")
+        await states.redis.set("1_files", json.dumps([FILE]))
+        await states.redis.rpush("1_context", json.dumps(USER), json.dumps(ASSISTANT))
+        await states.redis.set("2", json.dumps([{"role": "system", "content": "old"}, USER]))
+
+        state = await states.load_user_state("1")
+        assert state["model"] == "gemini-pro" and state["files"] == [FILE] and state["turns"] == [USER, ASSISTANT]
+        assert (await states.load_user_state("2"))["turns"] == [USER]
+        assert sorted(await states.redis.keys("*")) == [b"1_state", b"2_state"]
+
+    asyncio.run(scenario())
+
+
+def test_trims_to_max_turns_and_clears(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(states, "CONTEXT_MAX_TURNS", 4)
+        state = await states.load_user_state("1")
+        for i in range(3):
+            await states.save_user_state("1", state, turns=[{"role": "user", "content": str(i)}, ASSISTANT])
+        loaded = await states.load_user_state("1")
+        assert [turn["content"] for turn in loaded["turns"]] == ["1", ASSISTANT["content"], "2", ASSISTANT["content"]]
+        assert loaded["turns"] == state["turns"]
+        # v, updated_at, next и четыре реплики
+        assert await states.redis.hlen("1_state") == 3 + 4
+
+        await states.set_user_model("1", "gemini-pro")
+        loaded = await states.load_user_state("1")
+        assert loaded["turns"] == [] and loaded["model"] == "gemini-pro" and loaded["next"] == 6
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_context_expires_but_model_stays(monkeypatch):
+    async def scenario():
+        state = await states.load_user_state("1")
+        await states.save_user_state("1", state, turns=[USER, ASSISTANT], model="llama")
+        monkeypatch.setattr(states, "CONTEXT_TTL", -1)
+        loaded = await states.load_user_state("1")
+        assert loaded["turns"] == [] and loaded["model"] == "llama"
+        await states.save_user_state("1", loaded, turns=[USER])
+        assert [field for field in await states.redis.hkeys("1_state") if field.startswith(b"turn:")] == [b"turn:2"]
+
+    asyncio.run(scenario())
+
+
+def test_zstd_values_are_readable_either_way(monkeypatch):
+    turn = {"role": "assistant", "content": "очень длинный ответ " * 200}
+    plain = states.pack(turn)
+    monkeypatch.setattr(states, "_compressor", states.zstandard.ZstdCompressor())
+    compressed = states.pack(turn)
+    assert len(compressed) < len(plain) / 5
+    assert states.unpack(compressed) == states.unpack(plain) == turn
+
+
+def test_file_index_hit_and_miss():
+    async def scenario():
+        assert await states.get_indexed_file("abc") is None
+        await states.index_file("abc", "task.pdf", "files/1")
+        record = await states.get_indexed_file("abc")
+        assert record["pdf_name"] == "task.pdf" and record["gemini_name"] == "files/1"
+        assert await states.get_indexed_file("other") is None
+        # Ключ живет столько же, сколько файл в Gemini
+        assert 0 < await states.redis.ttl("file_index:abc") <= states.GEMINI_FILE_TTL
+
+    asyncio.run(scenario())
+
+
+def test_file_index_skips_files_about_to_expire_in_gemini():
+    async def scenario():
+        now = time.time()
+        await states.index_file("late", "late.pdf", "files/late", expires_at=now + states.GEMINI_FILE_TTL_MARGIN / 2)
+        await states.index_file("fresh", "fresh.pdf", "files/fresh", expires_at=now + 2 * states.GEMINI_FILE_TTL_MARGIN)
+        # Файл, который Gemini удалит во время ответа, загружается заново
+        assert await states.get_indexed_file("late") is None
+        assert (await states.get_indexed_file("fresh"))["gemini_name"] == "files/fresh"
+
+    asyncio.run(scenario())
+
+
+def test_file_sha256_is_content_addressed(tmp_path):
+    first, second, other = tmp_path / "a.pdf", tmp_path / "b.pdf", tmp_path / "c.pdf"
+    first.write_bytes(b"same task")
+    second.write_bytes(b"same task")
+    other.write_bytes(b"other task")
+
+    async def scenario():
+        return [await files.file_sha256(str(path)) for path in (first, second, other)]
+
+    a, b, c = asyncio.run(scenario())
+    assert a == b == hashlib.sha256(b"same task").hexdigest() and a != c
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import streaming  # noqa: E402
+from streaming import StreamingReply  # noqa: E402
+
+METHOD = EditMessageText(text="x")
+
+
+class FakeSent:
+    def __init__(self, chat, text):
+        self.chat = chat
+        self.text = text
+
+    async def edit_text(self, text, parse_mode=None):
+        self.chat.calls.append(("edit", text))
+        if self.chat.edit_errors:
+            raise self.chat.edit_errors.pop(0)
+        self.text = text
+        return self
+
+    async def delete(self):
+        self.chat.calls.append(("delete", self.text))
+        if self.chat.delete_error:
+            raise self.chat.delete_error
+
+
+class FakeMessage:
+    """Сообщение пользователя: ответы и правки записываются в calls, ошибки Telegram задаются заранее."""
+
+    def __init__(self, edit_errors=(), delete_error=None):
+        self.calls = []
+        self.edit_errors = list(edit_errors)
+        self.delete_error = delete_error
+
+    async def answer(self, text, parse_mode=None):
+        self.calls.append(("answer", text))
+        return FakeSent(self, text)
+
+
+@pytest.fixture(autouse=True)
+def fast_edits(monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_EDIT_INTERVAL", 0.05)
+    monkeypatch.setattr(streaming, "STREAM_MIN_DELTA", 10)
+
+
+def test_small_chunks_are_coalesced_into_rate_limited_edits():
+    message = FakeMessage()
+    reply = StreamingReply(message, "llama-fake")
+
+    async def scenario():
+        for _ in range(50):
+            await reply.feed("слово ")
+        await asyncio.sleep(0.06)
+        await reply.feed("конец ответа")
+
+    asyncio.run(scenario())
+    # 50 токенов пришли быстрее интервала правок: одно сообщение и одна правка после паузы
+    assert [kind for kind, _ in message.calls] == ["answer", "edit"]
+    assert "конец ответа" in message.calls[-1][1]
+
+
+def test_retry_after_postpones_next_edit():
+    message = FakeMessage(edit_errors=[TelegramRetryAfter(METHOD, "Too Many Requests", 30)])
+    reply = StreamingReply(message, "llama-fake")
+
+    async def scenario():
+        await reply.feed("x" * 20)
+        await asyncio.sleep(0.06)
+        await reply.feed("y" * 20)
+        await asyncio.sleep(0.06)
+        await reply.feed("z" * 20)
+
+    asyncio.run(scenario())
+    # После RetryAfter бот не правит сообщение, пока Telegram не разрешит
+    assert [kind for kind, _ in message.calls] == ["answer", "edit"]
+
+
+def test_finish_replaces_preview_with_first_chunk():
+    message = FakeMessage()
+    reply = StreamingReply(message, "llama-fake")
+
+    async def scenario():
+        await reply.feed("x" * 20)
+        return await reply.finish(["first", "second"])
+
+    assert asyncio.run(scenario()) == ["second"]
+    assert message.calls[-1] == ("edit", "first")
+
+
+@pytest.mark.parametrize("error", [
+    TelegramRetryAfter(METHOD, "Too Many Requests", 30),
+    TelegramNetworkError(METHOD, "connection reset"),
+    TelegramBadRequest(METHOD, "can't parse entities"),
+])
+def test_failed_final_edit_falls_back_to_new_messages(error):
+    message = FakeMessage(delete_error=TelegramNetworkError(METHOD, "connection reset"))
+    reply = StreamingReply(message, "llama-fake")
+
+    async def scenario():
+        await reply.feed("x" * 20)
+        message.edit_errors.append(error)
+        return await reply.finish(["first", "second"])
+
+    # Ответ модели не теряется: все части уйдут новыми сообщениями, даже если превью не удалилось
+    assert asyncio.run(scenario()) == ["first", "second"]
+    assert message.calls[-1][0] == "delete"
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import usage  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(usage, "redis", fakeredis.FakeAsyncRedis())
+
+
+def test_ledger_per_user_model_and_day():
+    async def scenario():
+        await usage.record_usage("1", "llama", 100, 50, 1.5)
+        await usage.record_usage("1", "llama", 10, 5, 0.5)
+        await usage.record_usage("1", "gemini-pro", 1000, 200, 4)
+        await usage.record_usage("2", "llama", 1, 1, 0.1)
+
+        mine = await usage.get_user_usage("1", days=7)
+        assert mine["llama"] == {"requests": 2, "prompt_tokens": 110, "completion_tokens": 55, "latency_ms": 2000}
+        assert mine["gemini-pro"]["completion_tokens"] == 200
+        assert "среднее время ответа 1.0 с" in usage.format_usage(mine)
+
+        models, top = await usage.get_usage_summary()
+        assert models["llama"]["requests"] == 3
+        assert top == [("1", 1365), ("2", 2)]
+
+    asyncio.run(scenario())
+
+
+def test_token_bucket(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(usage, "time", SimpleNamespace(time=lambda: now[0]))
+    monkeypatch.setattr(usage, "USER_TOKEN_BUCKET", 1000)
+    monkeypatch.setattr(usage, "USER_TOKENS_PER_MINUTE", 60)
+
+    async def scenario():
+        assert await usage.check_rate_limit("1") == 1000
+        # Ответ дороже остатка: бакет уходит в минус, следующий запрос ждет пополнения
+        await usage.record_usage("1", "llama", 1200, 300, 1)
+        tokens = await usage.check_rate_limit("1")
+        assert tokens == -500
+        assert usage.rate_limit_wait(tokens) == 501
+
+        now[0] += 600
+        assert await usage.check_rate_limit("1") == 100
+        # Пополнение не превышает емкость
+        now[0] += 10000
+        assert await usage.check_rate_limit("1") == 1000
+        # Другие пользователи не затронуты
+        assert await usage.check_rate_limit("2") == 1000
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_disabled_by_default():
+    assert asyncio.run(usage.check_rate_limit("1")) is None
+
+
+def test_extract_usage():
+    groq = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=10, completion_tokens=20))
+    assert usage.extract_usage(groq) == (10, 20)
+    last_chunk = SimpleNamespace(usage=None, x_groq=SimpleNamespace(usage=groq.usage))
+    assert usage.extract_usage(last_chunk) == (10, 20)
+    assert usage.extract_usage(SimpleNamespace(usage=None, x_groq=None)) is None
+    gemini = SimpleNamespace(usage_metadata=SimpleNamespace(prompt_token_count=7, candidates_token_count=3))
+    assert usage.extract_usage(gemini) == (7, 3)
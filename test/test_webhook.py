@@ -0,0 +1,99 @@
+import asyncio
+import os
+import sys
+import time
+
+import fakeredis
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+
+import webhook  # noqa: E402
+
+
+def make_update(update_id, text="Привет"):
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": 1, "type": "private", "first_name": "Test"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+        },
+    })
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(webhook, "redis", fakeredis.FakeAsyncRedis())
+
+
+def dispatcher(handler):
+    guard = webhook.UpdateGuard()
+    dp = Dispatcher()
+    dp.update.outer_middleware(guard)
+    dp.message()(handler)
+    return dp, guard, Bot("123:abc")
+
+
+def test_repeated_update_is_handled_once():
+    handled = []
+
+    async def handler(message):
+        handled.append(message.message_id)
+
+    async def scenario():
+        dp, _, bot = dispatcher(handler)
+        # Telegram повторил доставку, повтор мог прийти на другую реплику с тем же Redis
+        for update_id in (10, 10, 11):
+            await dp.feed_update(bot, make_update(update_id))
+        await bot.session.close()
+
+    asyncio.run(scenario())
+    assert handled == [10, 11]
+
+
+def test_drain_waits_for_handlers_in_progress():
+    finished = []
+
+    async def handler(message):
+        await asyncio.sleep(0.2)
+        finished.append(message.message_id)
+
+    async def scenario():
+        dp, guard, bot = dispatcher(handler)
+        tasks = [asyncio.create_task(dp.feed_update(bot, make_update(update_id))) for update_id in (1, 2)]
+        await asyncio.sleep(0.05)
+        assert guard.in_flight == 2
+        await guard.drain()
+        # Остановка продолжается только после ответа на все принятые обновления
+        assert sorted(finished) == [1, 2] and guard.in_flight == 0
+        await asyncio.gather(*tasks)
+        await bot.session.close()
+
+    asyncio.run(scenario())
+
+
+def test_drain_gives_up_after_timeout(monkeypatch):
+    monkeypatch.setattr(webhook, "SHUTDOWN_DRAIN_TIMEOUT", 0.05)
+    release = None
+
+    async def handler(message):
+        await release.wait()
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        dp, guard, bot = dispatcher(handler)
+        task = asyncio.create_task(dp.feed_update(bot, make_update(1)))
+        await asyncio.sleep(0.01)
+        start = time.monotonic()
+        await guard.drain()
+        assert time.monotonic() - start < 1 and guard.in_flight == 1
+        release.set()
+        await task
+        await bot.session.close()
+
+    asyncio.run(scenario())